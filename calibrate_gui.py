@@ -2,6 +2,7 @@ import cv2
 import numpy as np
 import sys
 import os
+import json
 
 # --- CONFIGURATION ---
 IMAGE_PATH = "omr_processing\Img7.jpeg" 
@@ -107,14 +108,14 @@ def main():
                  cv2.destroyWindow("Warped Preview")
         elif key == ord('s') and len(points) == 4:
             print("\n--- COORDINATES CAPTURED ---")
-            print("Copy the following line and paste it into 'omr_processing/processor.py',")
-            print("replacing the existing 'self.calibration_points' line:\n")
+            print("Copy the following line into your layout file in 'omr_processing/layouts/',")
+            print("replacing its existing \"calibration_points\" entry:\n")
             
             orig_h, orig_w = cv2.imread(IMAGE_PATH).shape[:2]
             scale_factor = orig_w / image.shape[1]
             scaled_points = (np.array(points) * scale_factor).astype(int)
 
-            print(f"self.calibration_points = np.array({scaled_points.tolist()})")
+            print(f'"calibration_points": {json.dumps(scaled_points.tolist())},')
             print("\nCalibration complete. Exiting.")
             break
 
@@ -0,0 +1,190 @@
+import cv2
+import numpy as np
+from . import utils
+
+# Marker detection runs on a copy no larger than this; phone photos are several times bigger.
+DETECTION_MAX_DIMENSION = 1000
+# Mean intensity (0-255) a cached marker location must stay below to count as still present.
+MARKER_DARK_LEVEL = 120
+# The marker quad must cover at least this share of the image; four filled bubbles huddle together.
+MIN_MARKER_SPREAD = 0.1
+# How far the marker quad's aspect ratio may stray from the layout's before perspective cannot explain it.
+MAX_MARKER_ASPECT_DEVIATION = 1.5
+
+_homography_cache = {}
+
+
+def downscale_gray(image, max_dimension=DETECTION_MAX_DIMENSION):
+    """Returns a grayscale copy no larger than max_dimension and the scale it was reduced by."""
+    h, w = image.shape[:2]
+    scale = min(1.0, max_dimension / float(max(h, w)))
+    if scale < 1.0:
+        image = cv2.resize(image, (int(round(w * scale)), int(round(h * scale))), interpolation=cv2.INTER_AREA)
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return gray, scale
+
+
+def markers_present(small_gray, marker_centers, marker_size):
+    """Cheap check that dark markers are still where they were found last time."""
+    half = max(1, int(marker_size / 4))
+    h, w = small_gray.shape[:2]
+    for cx, cy in np.round(marker_centers).astype(int):
+        if not (half <= cx < w - half and half <= cy < h - half):
+            return False
+        if small_gray[cy - half:cy + half + 1, cx - half:cx + half + 1].mean() >= MARKER_DARK_LEVEL:
+            return False
+    return True
+
+
+def _quad_area(points):
+    """Signed shoelace area; positive for TL, TR, BR, BL in image coordinates."""
+    x, y = np.asarray(points, dtype=np.float64).T
+    return (np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2
+
+
+def plausible_markers(centers, image_shape):
+    """
+    Whether four marker centers (TL, TR, BR, BL) can be the corners of a sheet:
+    they must form a convex quad in that order, spread over at least
+    MIN_MARKER_SPREAD of the image.
+    """
+    points = np.asarray(centers, dtype=np.float64)
+    edges = np.roll(points, -1, axis=0) - points
+    turns = edges[:, 0] * np.roll(edges, -1, axis=0)[:, 1] - edges[:, 1] * np.roll(edges, -1, axis=0)[:, 0]
+    if not (turns > 0).all():
+        return False
+    h, w = image_shape[:2]
+    return _quad_area(points) >= MIN_MARKER_SPREAD * h * w
+
+
+def markers_fit_layout(centers, marker_points):
+    """Whether the marker quad has roughly the proportions of the layout's marker rectangle."""
+    deviation = _quad_aspect(centers) / _quad_aspect(marker_points)
+    return 1 / MAX_MARKER_ASPECT_DEVIATION <= deviation <= MAX_MARKER_ASPECT_DEVIATION
+
+
+def locate_markers(image, use_cache=False):
+    """
+    Finds the four fiducial markers (TL, TR, BR, BL) on a downscaled copy of the
+    image. Returns a dict with their full-resolution "centers", the "method"
+    ("cached" or "markers"), and the downscaled "gray" image with its "scale", or
+    None when the markers cannot be found or do not look like a sheet's corners
+    (see plausible_markers).
+
+    With use_cache=True the last locations are remembered per image size, and
+    later sheets share them as long as the markers are still dark at the cached
+    spots, so detection only runs when the setup moves. That is only safe on a
+    fixed scanner or camera rig: a hand-held photo of the same size can shift by
+    a few pixels and still cover the old spots, so it is off by default.
+    """
+    small_gray, scale = downscale_gray(image)
+    cache_key = image.shape[:2]
+
+    cached = _homography_cache.get(cache_key) if use_cache else None
+    if cached is not None and markers_present(small_gray, cached["centers"], cached["size"]):
+        return {"centers": cached["centers"] / scale, "method": "cached", "gray": small_gray, "scale": scale}
+
+    markers = utils.find_fiducial_markers(small_gray)
+    if markers is None:
+        return None
+
+    corners = markers.reshape(4, -1, 2).astype(np.float32)
+    centers = corners.mean(axis=1)
+    if not plausible_markers(centers, small_gray.shape):
+        return None
+    size = float(np.median([cv2.boundingRect(c.astype(np.int32))[2] for c in corners]))
+    if use_cache:
+        _homography_cache[cache_key] = {"centers": centers, "size": size}
+    return {"centers": centers / scale, "method": "markers", "gray": small_gray, "scale": scale}
+
+
+def flatten_lighting(gray):
+    """Divides out the slowly varying illumination, so shadowed paper is white again and print stays dark."""
+    # The illumination is smooth, so it is estimated on an 8x smaller copy and scaled back up.
+    h, w = gray.shape[:2]
+    small = cv2.resize(gray, (max(1, w // 8), max(1, h // 8)), interpolation=cv2.INTER_AREA)
+    background = cv2.GaussianBlur(small, (0, 0), max(small.shape[:2]) / 40.0)
+    background = cv2.resize(background, (w, h), interpolation=cv2.INTER_LINEAR)
+    return cv2.divide(gray, background, scale=200)
+
+
+def locate_markers_relit(image):
+    """
+    Slower marker search for photos the plain search fails on: the same search
+    on a copy with the lighting flattened. Bypasses the cache; the "method" of
+    the result is "relit".
+    """
+    small_gray, scale = downscale_gray(image)
+    small_gray = flatten_lighting(small_gray)
+    markers = utils.find_fiducial_markers(small_gray)
+    if markers is None:
+        return None
+    centers = markers.reshape(4, -1, 2).astype(np.float32).mean(axis=1)
+    if not plausible_markers(centers, small_gray.shape):
+        return None
+    return {"centers": centers / scale, "method": "relit", "gray": small_gray, "scale": scale}
+
+
+def find_sheet_homography(image, marker_points, use_cache=False, located=None):
+    """
+    Returns the full-resolution homography that maps the sheet's fiducial markers
+    onto `marker_points` in the warped frame, along with how the markers were
+    found ("cached", "markers" or "relit"), or (None, None) when they cannot be found
+    or their quad does not have the proportions of `marker_points`.
+    `located` reuses a locate_markers() result for the same image.
+    """
+    located = located or locate_markers(image, use_cache)
+    if located is None or not markers_fit_layout(located["centers"], marker_points):
+        return None, None
+    dst = np.asarray(marker_points, dtype=np.float32).reshape(4, 2)
+    matrix = cv2.getPerspectiveTransform(located["centers"].astype(np.float32), dst)
+    return matrix, located["method"]
+
+
+def _quad_aspect(points):
+    points = np.asarray(points, dtype=np.float64)
+    width = np.linalg.norm(points[1] - points[0]) + np.linalg.norm(points[2] - points[3])
+    height = np.linalg.norm(points[3] - points[0]) + np.linalg.norm(points[2] - points[1])
+    return width / max(height, 1e-6)
+
+
+def read_code(located, template):
+    """Reads a layout's code cells (1 = dark) on the downscaled image, without warping it."""
+    small_gray, scale = located["gray"], located["scale"]
+    centers = (located["centers"] * scale).astype(np.float32)
+    matrix = cv2.getPerspectiveTransform(np.asarray(template.marker_points, dtype=np.float32), centers)
+    cells = np.asarray(template.code_cells, dtype=np.float32)
+    cell_centers = cv2.perspectiveTransform((cells[:, :2] + cells[:, 2:] / 2)[None], matrix)[0]
+    pixel_scale = np.linalg.norm(centers[1] - centers[0]) / max(template.marker_points[1][0] - template.marker_points[0][0], 1)
+    h, w = small_gray.shape[:2]
+    bits = []
+    for (cx, cy), (_, _, cw, ch) in zip(np.round(cell_centers).astype(int), template.code_cells):
+        half = max(1, int(min(cw, ch) * pixel_scale / 4))
+        if not (half <= cx < w - half and half <= cy < h - half):
+            return None
+        bits.append(int(small_gray[cy - half:cy + half + 1, cx - half:cx + half + 1].mean() < MARKER_DARK_LEVEL))
+    return tuple(bits)
+
+
+def route_sheet(image, templates, use_cache=False):
+    """
+    Picks the layout of a photographed sheet among compiled templates, using only
+    the marker search alignment does anyway: a layout whose code cells read back
+    its code wins; otherwise the layout without a code whose marker rectangle has
+    the closest aspect ratio. Without markers the first template is used.
+    Returns (template, located markers or None).
+    """
+    located = locate_markers(image, use_cache) if len(templates) > 1 else None
+    if located is None:
+        return templates[0], located
+    for template in templates:
+        if template.code and read_code(located, template) == template.code:
+            return template, located
+    uncoded = [t for t in templates if not t.code] or list(templates)
+    aspect = _quad_aspect(located["centers"])
+    best = min(uncoded, key=lambda t: abs(np.log(aspect / _quad_aspect(t.marker_points))))
+    return best, located
+
+
+def clear_homography_cache():
+    _homography_cache.clear()
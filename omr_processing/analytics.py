@@ -0,0 +1,203 @@
+import os
+import numpy as np
+from .answer_key import OPTION_LETTERS
+from .checkpoint import read_records
+from .fill_store import load_fills
+from .scoring import BUBBLE_THRESHOLD_RATIO, UNREADABLE, marked_options, _fit_key, _is_correct, _subject_totals
+
+# Share of the class, by total score, that forms the upper and lower groups of the discrimination index.
+GROUP_FRACTION = 0.27
+# Items outside these bounds are flagged for the exam board to look at.
+MIN_DIFFICULTY = 0.2
+MAX_DIFFICULTY = 0.9
+MIN_DISCRIMINATION = 0.2
+EXPORT_FORMATS = ("parquet", "csv")
+
+
+def load_marked(source, template, threshold=BUBBLE_THRESHOLD_RATIO):
+    """
+    Loads the marked option of every question of every stored sheet of one
+    layout as (sheets, marked): the list of {"hash", "source"} and a (sheets,
+    questions) int8 array (-1 blank, scoring.UNREADABLE unreadable). `source` is
+    a fill store directory (see fill_store), read in bulk and thresholded at
+    `threshold`, or a grade checkpoint (.jsonl) whose answers are used as graded.
+    A sheet stored more than once counts once, with its latest reading.
+    """
+    if os.path.isdir(source):
+        sheets, fills = load_fills(source, template.name)
+        if not sheets:
+            return [], np.empty((0, template.num_questions), dtype=np.int8)
+        return sheets, marked_options(fills, threshold)[:, :template.num_questions]
+
+    letters = {letter: i for i, letter in enumerate(OPTION_LETTERS)}
+    letters["None"] = -1
+    latest = {}
+    for record in read_records(source):
+        if record.get("error") or "answers" not in record:
+            continue
+        if (record.get("layout") or template.name) != template.name:
+            continue
+        latest[record["hash"]] = record
+    sheets = [{"hash": record["hash"], "source": record["filename"]} for record in latest.values()]
+    marked = np.full((len(sheets), template.num_questions), UNREADABLE, dtype=np.int8)
+    for row, record in zip(marked, latest.values()):
+        # Questions whose row could not be read are missing from the answers.
+        for q_num, letter in record["answers"].items():
+            if int(q_num) <= template.num_questions:
+                row[int(q_num) - 1] = letters[letter]
+    return sheets, marked
+
+
+def _correlate_columns(x, y):
+    """Pearson correlation of every column of x with the same column of y; NaN where either is constant."""
+    x = x - x.mean(axis=0)
+    y = y - y.mean(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (x * y).sum(axis=0) / np.sqrt((x * x).sum(axis=0) * (y * y).sum(axis=0))
+
+
+def _row_bincount(values, length):
+    """Counts of 0..length-1 in every row of a 2-D int array, as (rows, length), in one bincount."""
+    offsets = np.arange(values.shape[0])[:, None] * length
+    return np.bincount((values + offsets).ravel(), minlength=values.shape[0] * length).reshape(-1, length)
+
+
+def item_analysis(marked, key_indices, template, group_fraction=GROUP_FRACTION):
+    """
+    Classical item analysis of a (sheets, questions) matrix of marked options
+    against one key, all in vector operations over the whole matrix:
+    - "difficulty": the share of sheets answering each question correctly;
+    - "discrimination": that share in the top `group_fraction` of sheets by
+      total score minus the share in the bottom one;
+    - "point_biserial": the correlation of getting the question right with the
+      total score on the other questions;
+    - "choices": (questions, options + 2) shares of sheets marking each option,
+      leaving the question blank and having it unreadable;
+    - "flags": why a question needs a look, or "" if it does not.
+    Questions the key leaves open get NaN statistics. Per sheet, "totals" and
+    "subject_scores" are returned too, and per subject (see subject_summary)
+    "subjects" and "score_counts".
+    """
+    marked = np.asarray(marked)
+    num_sheets, num_questions = marked.shape
+    if not num_sheets:
+        raise ValueError("No graded sheets to analyse.")
+    key = _fit_key(key_indices, num_questions)
+    keyed = key >= 0
+    is_correct = _is_correct(marked, key)
+    totals = is_correct.sum(axis=1)
+    subject_scores = _subject_totals(is_correct, template)
+
+    correct = is_correct.astype(np.float32)
+    difficulty = correct.mean(axis=0)
+    group = max(1, int(round(group_fraction * num_sheets)))
+    order = np.argsort(totals, kind="stable")
+    discrimination = correct[order[-group:]].mean(axis=0) - correct[order[:group]].mean(axis=0)
+    point_biserial = _correlate_columns(correct, totals[:, None] - correct)
+    for stat in (difficulty, discrimination, point_biserial):
+        stat[~keyed] = np.nan
+
+    # Options, then blank, then unreadable.
+    num_options = template.num_options
+    outcomes = np.where(marked >= 0, marked, np.where(marked == UNREADABLE, num_options + 1, num_options))
+    choices = _row_bincount(outcomes.T.astype(np.int64), num_options + 2) / max(num_sheets, 1)
+
+    # Later flags take precedence; very easy or hard questions discriminate little by nature.
+    flags = np.full(num_questions, "", dtype=object)
+    flags[discrimination < MIN_DISCRIMINATION] = "low discrimination"
+    flags[difficulty > MAX_DIFFICULTY] = "too easy"
+    flags[difficulty < MIN_DIFFICULTY] = "too hard"
+    flags[discrimination < 0] = "negative discrimination"
+    # A wrong option chosen more often than the keyed one, on a question the weaker sheets get right
+    # more often, usually means the key is wrong.
+    best_choice = choices[:, :num_options].argmax(axis=1)
+    flags[keyed & (best_choice != key) & (discrimination < 0)] = "check key"
+
+    subjects, score_counts = subject_summary(subject_scores, template)
+    return {
+        "sheets": num_sheets,
+        "key": key,
+        "difficulty": difficulty,
+        "discrimination": discrimination,
+        "point_biserial": point_biserial,
+        "choices": choices,
+        "flags": flags,
+        "totals": totals,
+        "subject_scores": subject_scores,
+        "subjects": subjects,
+        "score_counts": score_counts,
+    }
+
+
+def subject_summary(subject_scores, template):
+    """
+    Distribution of every subject's scores: per subject the mean, standard
+    deviation, minimum, quartiles and maximum (a dict of (subjects,) arrays),
+    and the number of sheets at each score from 0 to questions_per_subject.
+    """
+    scores = np.asarray(subject_scores)
+    quartiles = np.percentile(scores, [0, 25, 50, 75, 100], axis=0)
+    stats = {"mean": scores.mean(axis=0), "std": scores.std(axis=0), "min": quartiles[0], "p25": quartiles[1],
+             "median": quartiles[2], "p75": quartiles[3], "max": quartiles[4]}
+    return stats, _row_bincount(scores.T.astype(np.int64), template.questions_per_subject + 1)
+
+
+def analysis_tables(sheets, marked, analysis, template):
+    """
+    The analysis as pandas DataFrames: "items" (one row per question), "sheets"
+    (scores and marked letters per sheet, replacing the per-sheet JSON files),
+    "subjects" and "score_distribution".
+    """
+    # pandas is only needed for export; grading never imports it.
+    import pandas as pd
+
+    num_questions, num_options = marked.shape[1], template.num_options
+    option_names = list(OPTION_LETTERS[:num_options]) + ["blank", "unreadable"]
+    questions = np.arange(1, num_questions + 1)
+    items = pd.DataFrame({
+        "question": questions,
+        "subject": [f"Subject_{(q - 1) // template.questions_per_subject + 1}" for q in questions],
+        "key": [OPTION_LETTERS[k] if k >= 0 else None for k in analysis["key"].tolist()],
+        "difficulty": analysis["difficulty"],
+        "discrimination": analysis["discrimination"],
+        "point_biserial": analysis["point_biserial"],
+        **{f"share_{name}": analysis["choices"][:, i] for i, name in enumerate(option_names)},
+        "flag": analysis["flags"],
+    })
+
+    letters = np.array(list(OPTION_LETTERS[:num_options]) + ["", None], dtype=object)
+    # Blank (-1) and unreadable (-2) index the last two entries.
+    marked_letters = letters[np.where(marked >= 0, marked, num_options - 1 - marked)]
+    sheet_table = pd.DataFrame({
+        "hash": [sheet["hash"] for sheet in sheets],
+        "source": [sheet["source"] for sheet in sheets],
+        "total_score": analysis["totals"],
+        **{f"Subject_{i+1}": analysis["subject_scores"][:, i] for i in range(template.num_subjects)},
+        **{f"Q{q}": marked_letters[:, q - 1] for q in questions},
+    })
+
+    subject_names = [f"Subject_{i+1}" for i in range(template.num_subjects)]
+    subjects = pd.DataFrame({"subject": subject_names, **analysis["subjects"]})
+    counts = analysis["score_counts"]
+    distribution = pd.DataFrame({
+        "subject": np.repeat(subject_names, counts.shape[1]),
+        "score": np.tile(np.arange(counts.shape[1]), len(subject_names)),
+        "sheets": counts.ravel(),
+    })
+    return {"items": items, "sheets": sheet_table, "subjects": subjects, "score_distribution": distribution}
+
+
+def export_tables(tables, directory, fmt="parquet"):
+    """Writes every table to `directory` as <name>.parquet (needs pyarrow) or <name>.csv; returns the paths."""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r}; expected one of {', '.join(EXPORT_FORMATS)}.")
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for name, table in tables.items():
+        path = os.path.join(directory, f"{name}.{fmt}")
+        if fmt == "parquet":
+            table.to_parquet(path, index=False)
+        else:
+            table.to_csv(path, index=False)
+        paths.append(path)
+    return paths
@@ -0,0 +1,134 @@
+import os
+import json
+import numpy as np
+from dataclasses import dataclass
+
+# Up to 8 options per question; a layout uses the first `options` letters.
+OPTION_LETTERS = "ABCDEFGH"
+# Written by scripts/convert_keys.py next to the JSON keys: every key of the
+# directory as one memory-mapped .npy of (name, JSON mtime, option indices) rows.
+KEY_BUNDLE_NAME = "answer_keys.npy"
+KEY_NAME_LENGTH = 64
+
+_key_cache = {}
+_bundle_cache = {}
+
+
+@dataclass(frozen=True, eq=False)
+class AnswerKey:
+    """
+    A parsed answer key. `indices[q - 1]` is the option index (0 = "A") of the
+    correct answer to question q, or -1 when the key has no answer for it.
+    Instances are immutable and cheap to pickle, so one key can be shared by
+    every evaluator and worker process in a batch.
+    """
+    path: str
+    mtime: int
+    indices: np.ndarray
+
+    def __post_init__(self):
+        indices = np.asarray(self.indices, dtype=np.int8)
+        # Read-only arrays (rows of a mapped key bundle) are used in place; anything else is copied.
+        if indices.flags.writeable:
+            indices = indices.copy()
+            indices.setflags(write=False)
+        object.__setattr__(self, "indices", indices)
+
+    @classmethod
+    def from_dict(cls, answers, total_questions, path=None, mtime=None, num_options=None):
+        """
+        Parses {question: letter}. With `num_options` a letter past the layout's
+        last option raises ValueError: that question could never be answered
+        correctly.
+        """
+        indices = np.full(total_questions, -1, dtype=np.int8)
+        letters = OPTION_LETTERS[:num_options] if num_options else OPTION_LETTERS
+        for question, letter in answers.items():
+            q = int(question)
+            letter = str(letter).upper()
+            if num_options and letter in OPTION_LETTERS and letter not in letters:
+                raise ValueError(f"{path or 'Answer key'}: question {q} is keyed {letter}, but the layout only has "
+                                 f"options {letters[0]}-{letters[-1]}.")
+            if 1 <= q <= total_questions and letter in letters:
+                indices[q - 1] = OPTION_LETTERS.index(letter)
+        return cls(path, mtime, indices)
+
+    def letter(self, question):
+        """The correct option letter for a 1-based question number, or None."""
+        if not 1 <= question <= len(self.indices):
+            return None
+        index = self.indices[question - 1]
+        return OPTION_LETTERS[index] if index >= 0 else None
+
+
+def save_key_bundle(path, keys):
+    """
+    Writes `keys` ({name: AnswerKey}) as a key bundle: a structured .npy with
+    one (name, mtime, indices) row per key, all with the same number of
+    questions, where mtime is that of the JSON file the key was read from. The
+    file is replaced atomically, so running workers never map half of it.
+    """
+    questions = {len(key.indices) for key in keys.values()}
+    if len(questions) > 1:
+        raise ValueError(f"Keys in one bundle must have the same number of questions, got {sorted(questions)}")
+    dtype = np.dtype([("name", f"U{KEY_NAME_LENGTH}"), ("mtime", np.int64),
+                      ("indices", np.int8, (questions.pop() if questions else 0,))])
+    bundle = np.array([(name, key.mtime or 0, key.indices) for name, key in sorted(keys.items())], dtype=dtype)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        np.save(f, bundle)
+    os.replace(temp_path, path)
+
+
+def load_key_bundle(path):
+    """
+    Maps a key bundle read-only and returns {name: row index} with the mapped
+    array; reused for as long as the file's modification time is unchanged.
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _bundle_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1], cached[2]
+    bundle = np.load(path, mmap_mode="r")
+    rows = {str(name): i for i, name in enumerate(bundle["name"])}
+    _bundle_cache[path] = (mtime, rows, bundle)
+    return rows, bundle
+
+
+def _bundled_key(path, mtime, total_questions, num_options=None):
+    """The key for a JSON key file from the bundle next to it, or None if the bundle lacks it or is out of date."""
+    try:
+        rows, bundle = load_key_bundle(os.path.join(os.path.dirname(path), KEY_BUNDLE_NAME))
+    except (OSError, ValueError):
+        return None
+    row = rows.get(os.path.splitext(os.path.basename(path))[0])
+    # A JSON key changed since it was compiled (edited by hand, checked out again) is read instead.
+    if row is None or bundle["mtime"][row] != mtime or bundle["indices"].shape[1] < total_questions:
+        return None
+    # A key with options past the layout's is parsed from JSON, which reports them.
+    if num_options and bundle["indices"][row, :total_questions].max(initial=-1) >= num_options:
+        return None
+    return AnswerKey(path, mtime, bundle["indices"][row, :total_questions])
+
+
+def load_answer_key(path, total_questions, num_options=None):
+    """
+    Loads an answer key JSON file, reusing the parsed key for as long as the
+    file's modification time is unchanged. When a key bundle compiled from the
+    same directory is present and up to date, the key is a row of the mapped
+    bundle and the JSON is not parsed. With `num_options` (the layout's) a key
+    answering with a later option raises ValueError.
+    """
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _key_cache.get((path, total_questions, num_options))
+    if cached is not None and cached.mtime == mtime:
+        return cached
+
+    key = _bundled_key(path, mtime, total_questions, num_options)
+    if key is None:
+        with open(path, 'r') as f:
+            answers = json.load(f)
+        key = AnswerKey.from_dict(answers, total_questions, path=path, mtime=mtime, num_options=num_options)
+    _key_cache[(path, total_questions, num_options)] = key
+    return key
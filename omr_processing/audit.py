@@ -0,0 +1,108 @@
+import os
+import json
+import cv2
+import numpy as np
+from .answer_key import OPTION_LETTERS
+from .template import DEFAULT_LAYOUT, load_template
+
+THUMBNAIL_SCALE = 0.5
+THUMBNAIL_QUALITY = 60
+
+
+def render_overlay(warped_image, processed_data, template):
+    """
+    Draws the grading result on a copy of the warped sheet: the correct answer in
+    green, a wrong mark in red and questions flagged for review outlined in orange. Works from a live result or a stored record
+    (whose question numbers have become strings in JSON).
+    """
+    overlay_image = warped_image.copy()
+    question_blocks, questions_per_block = template.question_blocks, template.questions_per_block
+    review = {int(q_num) for q_num in processed_data.get("review", ())}
+    for q_num, data in (processed_data.get("detected_answers") or {}).items():
+        q_num = int(q_num)
+        block_idx = (q_num - 1) // questions_per_block
+        if block_idx >= len(question_blocks) or len(data.get("coords", [])) != template.num_options:
+            continue
+
+        correct_answer_index = OPTION_LETTERS.find(data["correct"]) if data.get("correct") else -1
+        marked_answer_index = OPTION_LETTERS.find(data["marked"]) if data["marked"] != "None" else -1
+        block_x, block_y = data["block_origin"]
+        q_in_block = (q_num - 1) % questions_per_block
+        row_y = block_y + int(q_in_block * (question_blocks[block_idx][3] / questions_per_block))
+
+        if correct_answer_index != -1:
+            (cx, cy, cw, ch) = data["coords"][correct_answer_index]
+            abs_x, abs_y = block_x + cx, row_y + cy
+            cv2.rectangle(overlay_image, (abs_x, abs_y), (abs_x+cw, abs_y+ch), (0, 255, 0), 2)
+
+        if marked_answer_index != -1 and not data["is_correct"]:
+            (cx, cy, cw, ch) = data["coords"][marked_answer_index]
+            abs_x, abs_y = block_x + cx, row_y + cy
+            cv2.rectangle(overlay_image, (abs_x, abs_y), (abs_x+cw, abs_y+ch), (0, 0, 255), 2)
+
+        if q_num in review:
+            boxes = np.array(data["coords"])
+            x0, y0 = block_x + boxes[:, 0].min() - 4, row_y + boxes[:, 1].min() - 4
+            x1, y1 = block_x + (boxes[:, 0] + boxes[:, 2]).max() + 4, row_y + (boxes[:, 1] + boxes[:, 3]).max() + 4
+            cv2.rectangle(overlay_image, (int(x0), int(y0)), (int(x1), int(y1)), (0, 165, 255), 2)
+    return overlay_image
+
+
+def encode_thumbnail(warped_image, scale=THUMBNAIL_SCALE, quality=THUMBNAIL_QUALITY, ext=".jpg"):
+    """Low-quality JPEG (or ".webp") of the warped sheet, for the audit trail."""
+    if scale != 1.0:
+        warped_image = cv2.resize(warped_image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    flag = cv2.IMWRITE_WEBP_QUALITY if ext == ".webp" else cv2.IMWRITE_JPEG_QUALITY
+    ok, encoded = cv2.imencode(ext, warped_image, [flag, quality])
+    if not ok:
+        raise ValueError(f"Could not encode thumbnail as {ext}")
+    return encoded.tobytes()
+
+
+def audit_basename(name, content_hash):
+    """
+    File name stem for a sheet's audit files. Names from ZIP archives or directories
+    may contain sub-folders; the hash keeps different photos that share a file name
+    from overwriting each other's results.
+    """
+    base = os.path.splitext(name)[0].replace("/", "__").replace("\\", "__")
+    return f"{base}_{content_hash[:12]}"
+
+
+def build_audit_record(name, processed_data, thumbnail_file=None):
+    """
+    The compact record kept per sheet: scores, detected answers with their bubble
+    coordinates, and the homography that produced the warped sheet. Together with
+    the original photo (or the thumbnail) it is enough to redraw the overlay.
+    """
+    return {"source": name, "thumbnail": thumbnail_file, "result": processed_data}
+
+
+def save_audit_record(path, record):
+    with open(path, "w") as f:
+        json.dump(record, f, separators=(",", ":"))
+
+
+def load_audit_record(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def regenerate_overlay(record, original_image=None, thumbnail=None, template=None):
+    """
+    Redraws a sheet's overlay from its stored record. With the original photo the
+    stored homography reproduces the full-quality warped sheet; otherwise the
+    thumbnail bytes are scaled back up to the warped size. The sheet's layout is
+    taken from the record unless a template is given.
+    """
+    result = record["result"]
+    template = template or load_template(result.get("layout", DEFAULT_LAYOUT))
+    if original_image is not None and result.get("homography") is not None:
+        matrix = np.array(result["homography"], dtype=np.float64)
+        warped = cv2.warpPerspective(original_image, matrix, template.warped_size)
+    elif thumbnail is not None:
+        warped = cv2.imdecode(np.frombuffer(thumbnail, dtype=np.uint8), cv2.IMREAD_COLOR)
+        warped = cv2.resize(warped, template.warped_size, interpolation=cv2.INTER_LINEAR)
+    else:
+        raise ValueError("Need the original image or a thumbnail to regenerate the overlay.")
+    return render_overlay(warped, result, template)
@@ -0,0 +1,255 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+from .answer_key import load_answer_key
+from .audit import encode_thumbnail, regenerate_overlay
+from .ingest import content_hash
+from .memory import WarpBuffers, within_ceiling
+from .processor import OMREvaluator
+from .result_cache import ReadoutCache, DEFAULT_MAX_BYTES, layouts_fingerprint
+from .scoring import score_readout
+from .template import load_layouts
+from .timing import StageTimer
+from .utils import load_image
+
+# Set once per worker process by _init_worker so tasks only carry the image.
+_worker_state = {}
+
+
+def _init_worker(answer_keys, templates, options):
+    _worker_state["answer_keys"] = answer_keys
+    _worker_state["templates"] = templates
+    _worker_state["options"] = options
+    _worker_state["buffers"] = WarpBuffers() if options.get("max_memory") else None
+
+
+def _evaluate_sheet(name, image_source, answer_keys=None, templates=None, options=None, buffers=None):
+    """
+    Worker entry point. Never raises so one bad sheet cannot sink the batch.
+    With a memory ceiling in `options`, the record's "over_memory" tells whether
+    the process stayed above it after the sheet.
+    """
+    start = time.perf_counter()
+    if answer_keys is None:
+        answer_keys, templates, options, buffers = (_worker_state["answer_keys"], _worker_state["templates"],
+                                                    _worker_state["options"], _worker_state["buffers"])
+    timings = options["timings"]
+    thumbnail = readout = None
+    try:
+        evaluator = OMREvaluator(image_path=image_source, answer_key_path=answer_keys, layouts=templates, name=name,
+                                 timings=timings, second_pass=options["second_pass"], buffers=buffers,
+                                 marker_cache=options["marker_cache"])
+        result_data, overlay_image = evaluator.run_evaluation(render_overlay=options["render_overlay"])
+        error = None if result_data else "Sheet could not be evaluated."
+        if result_data:
+            readout = evaluator.readout
+            if options["thumbnails"]:
+                thumbnail = encode_thumbnail(evaluator.warped_image)
+    except Exception as e:
+        result_data, overlay_image, error = None, None, str(e)
+    seconds = time.perf_counter() - start
+    # The sheet's images are dropped before the process is measured against the memory ceiling.
+    evaluator = None
+    over_memory = not within_ceiling(options.get("max_memory"))
+    stage_timings = (result_data or {}).pop("timings", None) if timings else None
+    if stage_timings is not None:
+        stage_timings["sheet_total"] = seconds * 1000.0
+    return {
+        "source": name,
+        "result": result_data,
+        "overlay": overlay_image,
+        "thumbnail": thumbnail,
+        "readout": readout,
+        "error": error,
+        "seconds": seconds,
+        "timings": stage_timings,
+        "cached": False,
+        "over_memory": over_memory,
+    }
+
+
+def _score_cached(name, data, hit, answer_keys, templates, options):
+    """
+    Builds a sheet's record from a cached readout: a vector comparison, plus a warp
+    only if an overlay is wanted. Returns None if the readout's layout has no key.
+    """
+    start = time.perf_counter()
+    readout, thumbnail = hit
+    template = next((t for t in templates if t.name == readout.layout), None)
+    if template is None or answer_keys.get(template.name) is None:
+        return None
+    # The same stage names as OMREvaluator.run_evaluation, so cached and graded sheets share one report.
+    timer = StageTimer(enabled=options["timings"])
+    with timer.stage("score"):
+        result_data = score_readout(readout, answer_keys[template.name], template)
+    overlay_image = None
+    if options["render_overlay"]:
+        with timer.stage("overlay"):
+            overlay_image = regenerate_overlay({"result": result_data}, original_image=load_image(data),
+                                               template=template)
+    seconds = time.perf_counter() - start
+    stage_timings = None
+    if timer.enabled:
+        stage_timings = dict(timer.timings, sheet_total=seconds * 1000.0)
+    return {
+        "source": name,
+        "result": result_data,
+        "overlay": overlay_image,
+        "thumbnail": thumbnail,
+        "readout": readout,
+        "error": None,
+        "seconds": seconds,
+        "timings": stage_timings,
+        "cached": True,
+    }
+
+
+def _source_bytes(source):
+    if isinstance(source, np.ndarray):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    with open(os.fspath(source), "rb") as f:
+        return f.read()
+
+
+def _as_named(item):
+    """Accepts a path or a `(name, source)` pair, where source is a path, bytes or ndarray."""
+    if isinstance(item, tuple):
+        return item
+    return os.fspath(item), item
+
+
+def default_workers():
+    return max(1, (os.cpu_count() or 1) - 1)
+
+
+def _load_answer_keys(answer_key_path, templates):
+    """One AnswerKey per layout name; `answer_key_path` is a single key for every layout or a dict by layout name."""
+    if isinstance(answer_key_path, dict):
+        return {t.name: load_answer_key(answer_key_path[t.name], t.num_questions, t.num_options)
+                for t in templates if t.name in answer_key_path}
+    return {t.name: load_answer_key(answer_key_path, t.num_questions, t.num_options) for t in templates}
+
+
+def evaluate_batch(image_sources, answer_key_path, workers=None, total=None, timings=False,
+                   render_overlay=True, thumbnails=False, cache_dir=None, cache_max_bytes=DEFAULT_MAX_BYTES,
+                   layouts=None, second_pass=True, max_memory=None, marker_cache=False):
+    """
+    Grades a batch of sheets and yields one record per sheet as soon as it finishes.
+    `image_sources` may be any iterable (including a generator) of paths or
+    `(name, source)` pairs; it is consumed lazily with only a couple of sheets per
+    worker in flight, so memory stays flat however large the batch is.
+    Records arrive in completion order, not input order; each carries the running
+    `completed`/`total` counts (total is None for an unsized stream unless given)
+    and the batch throughput in `sheets_per_sec`. With timings=True each record
+    also carries its per-stage milliseconds under "timings" (see timing.summarize_timings).
+    With render_overlay=False no overlay image is drawn or shipped back from the
+    workers ("overlay" is None); thumbnails=True adds a small JPEG of the warped
+    sheet under "thumbnail" for the audit trail.
+    With cache_dir set, each sheet's key-independent readout is cached on disk by
+    image content hash (see result_cache.ReadoutCache); a sheet seen before is
+    only re-scored against the key and its record has "cached": True. Every
+    record carries the content hash under "hash" (None without a cache).
+    `layouts` names the sheet layouts to expect (all registered layouts by
+    default); with more than one, every sheet is routed to its own layout and
+    `answer_key_path` may be a dict of key paths by layout name.
+    second_pass=False skips re-reading unclear questions (see OMREvaluator.recheck).
+    marker_cache=True lets each grading process reuse the marker locations of
+    its last sheet of the same size (see alignment.locate_markers); only for
+    sheets from a fixed scanner or camera rig.
+    `max_memory` (bytes) bounds the resident memory of each grading process:
+    workers reuse preallocated warp buffers (see memory.WarpBuffers), only one
+    sheet per worker is in flight, and a process still above the ceiling after a
+    sheet releases its freed memory; if that is not enough, the pool is replaced
+    with fresh processes once its sheets in flight are done.
+    With workers=1 everything runs in the calling process. The answer keys and
+    compiled layouts are loaded once and handed to each worker at start-up.
+    """
+    if total is None and hasattr(image_sources, "__len__"):
+        total = len(image_sources)
+    templates = load_layouts(layouts)
+    answer_keys = _load_answer_keys(answer_key_path, templates)
+    workers = default_workers() if workers is None else max(1, int(workers))
+    options = {"timings": timings, "render_overlay": render_overlay, "thumbnails": thumbnails,
+               "second_pass": second_pass, "max_memory": max_memory, "marker_cache": marker_cache}
+    cache = None
+    if cache_dir is not None:
+        cache = ReadoutCache(cache_dir, cache_max_bytes, layouts_fingerprint(templates))
+    start = time.perf_counter()
+
+    def _with_progress(record, completed, digest=None):
+        elapsed = time.perf_counter() - start
+        record["hash"] = digest
+        record["completed"] = completed
+        record["total"] = total
+        record["sheets_per_sec"] = completed / elapsed if elapsed > 0 else 0.0
+        return record
+
+    def _lookup(items):
+        """Yields (name, source, digest, cached record or None); hits never reach a worker."""
+        for item in items:
+            name, source = _as_named(item)
+            if cache is None:
+                yield name, source, None, None
+                continue
+            source = _source_bytes(source)
+            digest = content_hash(source)
+            hit = cache.get(digest, need_thumbnail=thumbnails)
+            record = _score_cached(name, source, hit, answer_keys, templates, options) if hit else None
+            yield name, source, digest, record
+
+    def _store(record, digest):
+        if cache is not None and record["readout"] is not None:
+            cache.put(digest, record["readout"], record["thumbnail"])
+
+    if workers == 1 or total == 1:
+        buffers = WarpBuffers() if max_memory else None
+        for completed, (name, source, digest, record) in enumerate(_lookup(image_sources), start=1):
+            if record is None:
+                record = _evaluate_sheet(name, source, answer_keys, templates, options, buffers)
+                record.pop("over_memory")
+                _store(record, digest)
+            yield _with_progress(record, completed, digest)
+        return
+
+    sources = _lookup(image_sources)
+    max_in_flight = workers if max_memory else workers * 2
+    completed = 0
+    while True:
+        replace_pool = False
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(answer_keys, templates, options)) as pool:
+            pending = {}
+            while True:
+                # A pool due for replacement only finishes the sheets it has.
+                for name, source, digest, record in (() if replace_pool else sources):
+                    if record is not None:
+                        completed += 1
+                        yield _with_progress(record, completed, digest)
+                        continue
+                    pending[pool.submit(_evaluate_sheet, name, source)] = (name, digest)
+                    if len(pending) >= max_in_flight:
+                        break
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, digest = pending.pop(future)
+                    try:
+                        record = future.result()
+                    except Exception as e:
+                        # The worker process itself died (e.g. killed by the OS).
+                        record = {"source": name, "result": None, "overlay": None, "thumbnail": None,
+                                  "readout": None, "error": f"Worker failed: {e}", "seconds": 0.0, "timings": None,
+                                  "cached": False}
+                    replace_pool |= record.pop("over_memory", False)
+                    _store(record, digest)
+                    completed += 1
+                    yield _with_progress(record, completed, digest)
+        if not replace_pool:
+            break
@@ -0,0 +1,152 @@
+import cv2
+import numpy as np
+from .scoring import BUBBLE_THRESHOLD_RATIO, question_confidence
+
+# Plausible bubble size range (in pixels) on the 800x1000 warped sheet.
+MIN_BUBBLE_SIZE = (15, 20)
+MAX_BUBBLE_SIZE = (26, 34)
+# Second-pass reading: how far (pixels) a row's bubbles are searched for around
+# their expected place, and how much darker than its surroundings ink must be.
+RECHECK_SHIFT = 3
+ADAPTIVE_OFFSET = 8
+# Paper must be this much brighter (0-255) than the global threshold for a row's first reading to be trusted.
+PAPER_MARGIN = 20
+
+
+def _bubble_boxes(warped_gray):
+    thresh = cv2.adaptiveThreshold(warped_gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C,
+                                   cv2.THRESH_BINARY_INV, 31, 10)
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return np.empty((0, 4), dtype=np.int32)
+    boxes = np.array([cv2.boundingRect(c) for c in contours], dtype=np.int32)
+    w, h = boxes[:, 2], boxes[:, 3]
+    keep = ((w >= MIN_BUBBLE_SIZE[0]) & (w <= MAX_BUBBLE_SIZE[0]) &
+            (h >= MIN_BUBBLE_SIZE[1]) & (h <= MAX_BUBBLE_SIZE[1]))
+    return boxes[keep]
+
+
+def detect_bubble_grid(warped_gray, question_blocks, questions_per_block, num_options):
+    """
+    Derives the bubble layout of a sheet from a warped reference image.
+    Returns an int32 array of shape (questions, options, 4) holding (x, y, w, h)
+    boxes in warped-image coordinates. Rows and columns are fitted from all the
+    bubbles in a block, so a single missed bubble does not shift the grid.
+    """
+    boxes = _bubble_boxes(warped_gray)
+    centers = boxes[:, :2] + boxes[:, 2:] / 2.0
+    grid = []
+
+    for block_idx, (x, y, w, h) in enumerate(question_blocks):
+        in_block = ((centers[:, 0] >= x) & (centers[:, 0] < x + w) &
+                    (centers[:, 1] >= y) & (centers[:, 1] < y + h))
+        block_boxes, block_centers = boxes[in_block], centers[in_block]
+        if len(block_boxes) < num_options:
+            raise ValueError(f"Too few bubbles found in question block {block_idx + 1}.")
+
+        order = np.argsort(block_centers[:, 1])
+        block_boxes, block_centers = block_boxes[order], block_centers[order]
+        bubble_w, bubble_h = np.median(block_boxes[:, 2:], axis=0)
+
+        # Bubbles whose centres are less than half a bubble apart vertically share a row.
+        splits = np.where(np.diff(block_centers[:, 1]) > bubble_h / 2)[0] + 1
+        rows = [r for r in np.split(np.arange(len(block_boxes)), splits) if len(r) >= num_options - 1]
+        if len(rows) != questions_per_block:
+            raise ValueError(f"Expected {questions_per_block} rows in question block {block_idx + 1}, found {len(rows)}.")
+
+        # Question numbers printed left of the row can look like bubbles; the options are the rightmost ones.
+        full_rows = [r[np.argsort(block_centers[r, 0])][-num_options:] for r in rows if len(r) >= num_options]
+        col_x = np.median(np.array([block_centers[r, 0] for r in full_rows]), axis=0)
+        row_y = np.array([np.median(block_centers[r, 1]) for r in rows])
+
+        bx = np.round(col_x - bubble_w / 2).astype(np.int32)
+        by = np.round(row_y - bubble_h / 2).astype(np.int32)
+        block_grid = np.empty((questions_per_block, num_options, 4), dtype=np.int32)
+        block_grid[..., 0] = bx[None, :]
+        block_grid[..., 1] = by[:, None]
+        block_grid[..., 2] = int(round(bubble_w))
+        block_grid[..., 3] = int(round(bubble_h))
+        grid.append(block_grid)
+
+    return np.concatenate(grid)
+
+
+def sampling_windows(grid, frame_size, inset=0.25):
+    """
+    The integral-image windows (x0, y0, x1, y1, area) a fill ratio is read from:
+    the inner part of each bubble box (the printed outline is left out), clipped
+    to the warped frame of size (width, height). Computed once per layout.
+    """
+    x, y, w, h = np.moveaxis(np.asarray(grid), -1, 0)
+    dx, dy = (w * inset).astype(np.int32), (h * inset).astype(np.int32)
+    x0, y0 = x + dx, y + dy
+    x1 = np.clip(x + w - dx, 0, frame_size[0])
+    y1 = np.clip(y + h - dy, 0, frame_size[1])
+    x0, y0 = np.clip(x0, 0, x1), np.clip(y0, 0, y1)
+    area = np.maximum((x1 - x0) * (y1 - y0), 1)
+    return x0, y0, x1, y1, area
+
+
+def measure_fill_ratios(warped_gray, grid=None, inset=0.25, windows=None):
+    """
+    Scores every bubble in one pass. The sheet is binarised once, and each bubble's
+    fill ratio is read from an integral image over the inner part of its box.
+    Pass a layout's precompiled `windows` to skip recomputing them from `grid`.
+    Returns a float32 array of shape (questions, options).
+    """
+    thresh = cv2.threshold(warped_gray, 0, 1, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+    integral = cv2.integral(thresh)
+
+    if windows is None:
+        windows = sampling_windows(grid, (warped_gray.shape[1], warped_gray.shape[0]), inset)
+    x0, y0, x1, y1, area = windows
+    filled = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+    return (filled / area).astype(np.float32)
+
+
+def shadowed_rows(warped_gray, grid, margin=PAPER_MARGIN):
+    """
+    Flags the questions whose bubbles sit on paper too dark for the global
+    threshold of measure_fill_ratios, e.g. in a shadow across the sheet; their
+    blank bubbles can read as filled with full confidence. The paper level is
+    the local maximum brightness on an 8x smaller copy.
+    """
+    level = cv2.threshold(warped_gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[0]
+    small = cv2.resize(warped_gray, (warped_gray.shape[1] // 8, warped_gray.shape[0] // 8), interpolation=cv2.INTER_AREA)
+    paper = cv2.dilate(small, np.ones((5, 5), np.uint8))
+    grid = np.asarray(grid)
+    cx = np.clip((grid[..., 0] + grid[..., 2] // 2) // 8, 0, paper.shape[1] - 1)
+    cy = np.clip((grid[..., 1] + grid[..., 3] // 2) // 8, 0, paper.shape[0] - 1)
+    return (paper[cy, cx] < level + margin).any(axis=1)
+
+
+def remeasure_fill_ratios(warped_gray, grid, rows, shift=RECHECK_SHIFT, inset=0.25,
+                          threshold=BUBBLE_THRESHOLD_RATIO):
+    """
+    Slower, more robust reading of selected question rows. The sheet is binarised
+    against its local mean instead of one global threshold, so shadows and light
+    pencil survive, and each row's boxes are moved by up to `shift` pixels to
+    where they read most clearly, which absorbs a slightly off warp.
+    Returns a float32 array of shape (len(rows), options).
+    """
+    boxes = np.asarray(grid)[rows]
+    block = int(2 * np.median(boxes[..., 3])) | 1
+    thresh = cv2.adaptiveThreshold(warped_gray, 1, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV,
+                                   max(block, 3), ADAPTIVE_OFFSET)
+    integral = cv2.integral(thresh)
+    frame_size = (warped_gray.shape[1], warped_gray.shape[0])
+
+    # Nearest offsets first: a row only moves if that reads strictly clearer.
+    offsets = sorted(((dx, dy) for dy in range(-shift, shift + 1) for dx in range(-shift, shift + 1)),
+                     key=lambda offset: offset[0] ** 2 + offset[1] ** 2)
+    best = best_confidence = None
+    for dx, dy in offsets:
+        x0, y0, x1, y1, area = sampling_windows(boxes + np.array([dx, dy, 0, 0]), frame_size, inset)
+        fills = ((integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]) / area).astype(np.float32)
+        confidence = question_confidence(fills, threshold)
+        if best is None:
+            best, best_confidence = fills, confidence
+            continue
+        better = confidence > best_confidence
+        best[better], best_confidence[better] = fills[better], confidence[better]
+    return best
@@ -0,0 +1,59 @@
+import os
+import json
+
+
+def read_records(path):
+    """Yields the records of a JSONL checkpoint in the order they were written."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # A crash mid-write can leave a truncated last line; that sheet is simply graded again.
+                continue
+
+
+class Checkpoint:
+    """
+    Append-only JSONL log of graded sheets. Every record is flushed as soon as it
+    is written, so an interrupted run loses at most the sheets still in flight.
+    A record counts as done for its (content hash, answer key) pair, so the same
+    photos can be re-graded against another key into the same file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            for record in self.records():
+                if not record.get("error"):
+                    self.done.add((record["hash"], record.get("answer_key")))
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def records(self):
+        return read_records(self.path)
+
+    def is_done(self, content_hash, answer_key):
+        return (content_hash, answer_key) in self.done
+
+    def append(self, record):
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self._file.flush()
+        if not record.get("error"):
+            self.done.add((record["hash"], record.get("answer_key")))
+
+    def close(self):
+        if not self._file.closed:
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,379 @@
+import os
+import sys
+import csv
+import math
+import json
+import time
+import argparse
+import signal
+import multiprocessing
+import multiprocessing.connection
+from contextlib import nullcontext
+from datetime import datetime
+
+from .batch import evaluate_batch, default_workers
+from .answer_key import load_answer_key
+from .checkpoint import Checkpoint
+from .fill_store import FillStoreWriter, load_fills
+from .jobs import run_worker
+from .ingest import iter_directory_images, iter_zip_images, count_images, content_hash
+from .scoring import BUBBLE_THRESHOLD_RATIO, rescore as rescore_fills
+from .template import DEFAULT_LAYOUT, load_template
+from .timing import summarize_timings, format_timing_report
+from .video import is_video_name, iter_video_sheets
+
+DEFAULT_KEYS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "web_app", "answer_keys")
+# Seconds between progress lines.
+PROGRESS_INTERVAL = 1.0
+# Exit code of a worker process that stopped above its memory ceiling and should be replaced.
+WORKER_REPLACE_EXIT_CODE = 75
+
+
+def resolve_answer_key(value):
+    """Accepts a path to a key file or a key name such as "set_a" or "Set A"."""
+    if os.path.isfile(value):
+        return value
+    name = value.strip().lower().replace(" ", "_")
+    if not name.endswith(".json"):
+        name += ".json"
+    candidate = os.path.join(DEFAULT_KEYS_DIR, name)
+    if os.path.isfile(candidate):
+        return candidate
+    raise FileNotFoundError(f"Answer key not found: {value}")
+
+
+def _megabytes(value):
+    return value * 2**20 if value else None
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, rem = divmod(seconds, 3600)
+    minutes, seconds = divmod(rem, 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+
+def _pending_sheets(input_path, checkpoint, key_name, stats):
+    """Reads each image once, hashes it, and passes on only sheets the checkpoint has not seen."""
+    if input_path.lower().endswith(".zip"):
+        images = iter_zip_images(input_path)
+    elif is_video_name(input_path):
+        images = iter_video_sheets(input_path, stride=stats["stride"], stats=stats["video"])
+    else:
+        images = ((name, path) for name, path in iter_directory_images(input_path))
+
+    submitted = set()
+    for name, source in images:
+        if isinstance(source, str):
+            with open(source, "rb") as f:
+                source = f.read()
+        digest = content_hash(source)
+        if checkpoint.is_done(digest, key_name) or digest in submitted:
+            stats["skipped"] += 1
+            continue
+        submitted.add(digest)
+        stats["hashes"][name] = digest
+        yield name, source
+
+
+def _review_entry(entry, result, readout):
+    """A review queue line: the sheet and, per uncertain question, what was read and how clearly."""
+    answers = result["detected_answers"]
+    questions = []
+    for q_num in result["review"]:
+        answer = answers.get(q_num)
+        questions.append({
+            "question": q_num,
+            "marked": answer["marked"] if answer else None,
+            "confidence": answer["confidence"] if answer else 0.0,
+            "fill_ratios": [None if math.isnan(f) else round(f, 3) for f in readout.fill_ratios[q_num - 1].tolist()],
+        })
+    review = {"hash": entry["hash"], "filename": entry["filename"], "answer_key": entry["answer_key"],
+              "layout": result["layout"], "questions": questions}
+    if result.get("review_reason"):
+        review["reason"] = result["review_reason"]
+    return review
+
+
+def grade(args):
+    answer_key_path = resolve_answer_key(args.key)
+    key_name = os.path.splitext(os.path.basename(answer_key_path))[0]
+    input_path = args.input
+    if input_path.lower().endswith(".zip"):
+        total_images = count_images(zip_source=input_path)
+    elif os.path.isdir(input_path):
+        total_images = count_images(directory=input_path)
+    elif is_video_name(input_path) and os.path.isfile(input_path):
+        # Sheets are only known once the video has been scanned.
+        total_images = None
+    else:
+        print(f"Input must be a directory, a .zip archive or a video: {input_path}", file=sys.stderr)
+        return 2
+
+    checkpoint_path = args.checkpoint or os.path.join(
+        input_path if os.path.isdir(input_path) else os.path.dirname(os.path.abspath(input_path)),
+        "omr_results.jsonl")
+
+    review_path = args.review or os.path.splitext(checkpoint_path)[0] + "_review.jsonl"
+    # SIGTERM stops the run like Ctrl+C does, so the fill store still writes out its partial chunk.
+    signal.signal(signal.SIGTERM, _interrupt)
+    # The checkpoint marks sheets done as they finish while the fill store buffers whole chunks; it is
+    # flushed however the run ends, or a resumed run would skip sheets whose matrices were never stored.
+    with Checkpoint(checkpoint_path) as checkpoint, Checkpoint(review_path) as review_queue, \
+            (FillStoreWriter(args.fills) if args.fills else nullcontext()) as fill_store:
+        stats = {"skipped": 0, "hashes": {}, "stride": args.stride, "video": {}}
+        sheets = _pending_sheets(input_path, checkpoint, key_name, stats)
+        print(f"Grading {'the' if total_images is None else total_images} sheets from {input_path} with {key_name} "
+              f"using {args.workers} workers; checkpoint: {checkpoint_path}")
+
+        graded = failed = to_review = 0
+        stage_timings = []
+        start = last_report = time.perf_counter()
+        for record in evaluate_batch(sheets, answer_key_path, workers=args.workers, timings=bool(args.profile),
+                                     render_overlay=False, cache_dir=args.cache, layouts=args.layout,
+                                     max_memory=_megabytes(args.max_memory), marker_cache=args.fixed_camera):
+            result = record["result"]
+            if record["timings"]:
+                stage_timings.append(record["timings"])
+            digest = stats["hashes"].pop(record["source"])
+            entry = {
+                "hash": digest,
+                "filename": record["source"],
+                "answer_key": key_name,
+                "evaluated_at": datetime.now().isoformat(),
+                "error": record["error"],
+            }
+            if result:
+                entry.update({
+                    "total_score": result["total_score"],
+                    "subject_scores": result["subject_scores"],
+                    "answers": {q: data["marked"] for q, data in result["detected_answers"].items()},
+                    "alignment": result.get("alignment"),
+                    "layout": result["layout"],
+                    "review": result["review"],
+                })
+                if result.get("review_reason"):
+                    entry["review_reason"] = result["review_reason"]
+                if result["review"]:
+                    review_queue.append(_review_entry(entry, result, record["readout"]))
+                    to_review += 1
+                if fill_store is not None:
+                    fill_store.add(digest, record["source"], record["readout"].fill_ratios, result["layout"])
+                graded += 1
+            else:
+                failed += 1
+                print(f"Could not process {record['source']}: {record['error']}", file=sys.stderr)
+            checkpoint.append(entry)
+
+            now = time.perf_counter()
+            if now - last_report >= PROGRESS_INTERVAL:
+                last_report = now
+                done = graded + failed
+                rate = done / (now - start)
+                if total_images is None:
+                    print(f"[{stats['skipped'] + done}] {rate:.2f} sheets/sec")
+                else:
+                    remaining = max(total_images - stats["skipped"] - done, 0)
+                    eta = format_duration(remaining / rate) if rate > 0 else "?"
+                    print(f"[{stats['skipped'] + done}/{total_images}] {rate:.2f} sheets/sec, ETA {eta}")
+
+        elapsed = time.perf_counter() - start
+        rate = (graded + failed) / elapsed if elapsed > 0 else 0.0
+        print(f"Done: {graded} graded, {failed} failed, {stats['skipped']} already in checkpoint "
+              f"in {format_duration(elapsed)} ({rate:.2f} sheets/sec).")
+        video = stats["video"]
+        if video.get("seconds"):
+            print(f"Scanned {video['frames']} frames ({format_duration(video['video_seconds'])} of video) "
+                  f"and found {video['sheets']} sheets, "
+                  f"{video['video_seconds'] / video['seconds']:.1f}x faster than real time.")
+        if to_review:
+            print(f"{to_review} sheets have questions to check by hand; see {review_path}")
+
+    if args.profile and stage_timings:
+        report = summarize_timings(stage_timings)
+        print(format_timing_report(report))
+        with open(args.profile, "w") as f:
+            json.dump({"sheets": len(stage_timings), "workers": args.workers, "stages": report}, f, indent=2)
+        print(f"Timing report written to {args.profile}")
+    return 1 if failed else 0
+
+
+def rescore(args):
+    answer_key_path = resolve_answer_key(args.key)
+    template = load_template(args.layout)
+    answer_key = load_answer_key(answer_key_path, template.num_questions, template.num_options)
+    start = time.perf_counter()
+    sheets, fills = load_fills(args.fills, template.name)
+    if not sheets:
+        print(f"No stored {template.name} fill matrices in {args.fills}", file=sys.stderr)
+        return 2
+    _, _, totals, subject_scores = rescore_fills(fills, answer_key.indices, template, args.threshold)
+    elapsed = time.perf_counter() - start
+
+    output = args.output or os.path.join(args.fills, f"rescored_{os.path.splitext(os.path.basename(answer_key_path))[0]}.csv")
+    with open(output, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["hash", "filename", "total_score"] + [f"Subject_{i+1}" for i in range(template.num_subjects)])
+        for sheet, total, subjects in zip(sheets, totals.tolist(), subject_scores.tolist()):
+            writer.writerow([sheet["hash"], sheet["source"], total] + subjects)
+    print(f"Re-scored {len(sheets)} sheets against {answer_key_path} (threshold {args.threshold}) "
+          f"in {elapsed:.2f}s; mean score {totals.mean():.2f}. Results written to {output}")
+    return 0
+
+
+def analyze(args):
+    # Only this command needs pandas (and pyarrow for Parquet), so it is imported here.
+    from .analytics import load_marked, item_analysis, analysis_tables, export_tables
+
+    answer_key_path = resolve_answer_key(args.key)
+    template = load_template(args.layout)
+    answer_key = load_answer_key(answer_key_path, template.num_questions, template.num_options)
+    start = time.perf_counter()
+    sheets, marked = load_marked(args.source, template, args.threshold)
+    if not sheets:
+        print(f"No graded {template.name} sheets in {args.source}", file=sys.stderr)
+        return 2
+    analysis = item_analysis(marked, answer_key.indices, template)
+    output = args.output
+    if output is None:
+        output = (os.path.join(args.source, "analysis") if os.path.isdir(args.source)
+                  else os.path.splitext(args.source)[0] + "_analysis")
+    try:
+        paths = export_tables(analysis_tables(sheets, marked, analysis, template), output, args.format)
+    except ImportError as e:
+        print(f"Cannot write {args.format}: {e}", file=sys.stderr)
+        return 2
+    elapsed = time.perf_counter() - start
+
+    flagged = [(q + 1, flag) for q, flag in enumerate(analysis["flags"]) if flag]
+    print(f"Analysed {len(sheets)} sheets against {answer_key_path} in {elapsed:.2f}s; "
+          f"mean score {analysis['totals'].mean():.2f} of {int((analysis['key'] >= 0).sum())}.")
+    for q_num, flag in flagged:
+        print(f"  Q{q_num}: {flag} (difficulty {analysis['difficulty'][q_num - 1]:.2f}, "
+              f"discrimination {analysis['discrimination'][q_num - 1]:.2f})")
+    print(f"{len(paths)} tables written to {output}")
+    return 0
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def _run_worker_process(db_path, options):
+    try:
+        if run_worker(db_path, **options):
+            sys.exit(WORKER_REPLACE_EXIT_CODE)
+    except KeyboardInterrupt:
+        pass
+
+
+def _start_worker_process(db_path, options):
+    process = multiprocessing.Process(target=_run_worker_process, args=(db_path, options))
+    process.start()
+    return process
+
+
+def worker(args):
+    # SIGTERM (e.g. from a service manager) shuts the workers down like Ctrl+C does.
+    signal.signal(signal.SIGTERM, _interrupt)
+    options = {"cache_dir": args.cache, "exit_when_idle": args.exit_when_idle, "layouts": args.layout,
+               "max_memory": _megabytes(args.max_memory)}
+    print(f"Starting {args.workers} workers on {args.db}; press Ctrl+C to stop.")
+    if args.workers == 1 and not args.max_memory:
+        _run_worker_process(args.db, options)
+        return 0
+    processes = [_start_worker_process(args.db, options) for _ in range(args.workers)]
+    try:
+        while processes:
+            multiprocessing.connection.wait([process.sentinel for process in processes])
+            for process in [p for p in processes if p.exitcode is not None]:
+                processes.remove(process)
+                if process.exitcode == WORKER_REPLACE_EXIT_CODE:
+                    # It stopped above its memory ceiling; a fresh process takes its place.
+                    processes.append(_start_worker_process(args.db, options))
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m omr_processing", description="Headless OMR batch grading.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    grade_parser = subparsers.add_parser("grade", help="Grade a directory or ZIP archive of sheet images.")
+    grade_parser.add_argument("input", help="Directory of images (searched recursively), a .zip archive, "
+                                            "or a video of the sheets being flipped in front of the camera.")
+    grade_parser.add_argument("-k", "--key", required=True, help="Answer key file, or a key name such as set_a.")
+    grade_parser.add_argument("-w", "--workers", type=int, default=default_workers(), help="Worker processes.")
+    grade_parser.add_argument("-c", "--checkpoint",
+                              help="JSONL results file; sheets already in it are skipped "
+                                   "(default: omr_results.jsonl in the input directory).")
+    grade_parser.add_argument("--review", metavar="FILE",
+                              help="JSONL queue of sheets with questions still uncertain after the second pass "
+                                   "(default: <checkpoint>_review.jsonl).")
+    grade_parser.add_argument("--cache", metavar="DIR",
+                              help="Cache sheet readouts here by image content hash, so photos graded before "
+                                   "(e.g. against another key) are only re-scored.")
+    grade_parser.add_argument("--fills", metavar="DIR",
+                              help="Also store every sheet's fill-ratio matrix here, for the rescore command.")
+    grade_parser.add_argument("--layout", action="append", metavar="NAME",
+                              help="Sheet layout to expect (a name from omr_processing/layouts or a layout file); "
+                                   "repeat to route mixed batches. Default: every registered layout.")
+    grade_parser.add_argument("--profile", metavar="REPORT.json",
+                              help="Time each pipeline stage and write a p50/p95/p99 report to this file.")
+    grade_parser.add_argument("--max-memory", type=int, metavar="MB",
+                              help="Memory ceiling per grading process; a worker pool that stays above it "
+                                   "is replaced with fresh processes.")
+    grade_parser.add_argument("--fixed-camera", action="store_true",
+                              help="Sheets come from a fixed scanner or camera rig: reuse the last sheet's marker "
+                                   "locations while its markers are still there, instead of searching every photo.")
+    grade_parser.add_argument("--stride", type=int, default=2,
+                              help="For a video input, check every Nth frame for a sheet (default: 2).")
+    grade_parser.set_defaults(func=grade)
+
+    rescore_parser = subparsers.add_parser(
+        "rescore", help="Regrade stored fill matrices against a key or threshold, without the images.")
+    rescore_parser.add_argument("fills", help="Fill matrix store written by grade --fills.")
+    rescore_parser.add_argument("-k", "--key", required=True, help="Answer key file, or a key name such as set_a.")
+    rescore_parser.add_argument("-t", "--threshold", type=float, default=BUBBLE_THRESHOLD_RATIO,
+                                help="Fill ratio above which a bubble counts as marked.")
+    rescore_parser.add_argument("--layout", default=DEFAULT_LAYOUT,
+                                help="Layout whose stored sheets are regraded (default: %(default)s).")
+    rescore_parser.add_argument("-o", "--output", help="CSV to write (default: rescored_<key>.csv in the store).")
+    rescore_parser.set_defaults(func=rescore)
+
+    analyze_parser = subparsers.add_parser(
+        "analyze", help="Item analysis (difficulty, discrimination, choices) and subject distributions over graded sheets.")
+    analyze_parser.add_argument("source", help="Fill matrix store written by grade --fills, or a grade checkpoint (.jsonl).")
+    analyze_parser.add_argument("-k", "--key", required=True, help="Answer key file, or a key name such as set_a.")
+    analyze_parser.add_argument("-t", "--threshold", type=float, default=BUBBLE_THRESHOLD_RATIO,
+                                help="Fill ratio above which a bubble counts as marked (fill stores only).")
+    analyze_parser.add_argument("--layout", default=DEFAULT_LAYOUT,
+                                help="Layout of the sheets to analyse (default: %(default)s).")
+    analyze_parser.add_argument("--format", choices=("parquet", "csv"), default="parquet",
+                                help="Table format (default: parquet, which needs pyarrow).")
+    analyze_parser.add_argument("-o", "--output",
+                                help="Directory for the tables (default: analysis/ in the store, "
+                                     "or <checkpoint>_analysis/).")
+    analyze_parser.set_defaults(func=analyze)
+
+    worker_parser = subparsers.add_parser("worker", help="Run grading workers for the job queue used by the web app.")
+    worker_parser.add_argument("--db", required=True, help="Job queue database (created if missing).")
+    worker_parser.add_argument("-w", "--workers", type=int, default=default_workers(), help="Worker processes.")
+    worker_parser.add_argument("--cache", metavar="DIR", help="Readout cache directory shared by the workers.")
+    worker_parser.add_argument("--layout", action="append", metavar="NAME",
+                               help="Sheet layout to route among; repeatable. Default: every registered layout.")
+    worker_parser.add_argument("--max-memory", type=int, metavar="MB",
+                               help="Memory ceiling per worker process; a worker that stays above it "
+                                    "after a sheet is replaced with a fresh one.")
+    worker_parser.add_argument("--exit-when-idle", action="store_true", help="Stop once the queue is empty.")
+    worker_parser.set_defaults(func=worker)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
@@ -0,0 +1,108 @@
+import os
+import json
+import glob
+import numpy as np
+from .template import DEFAULT_LAYOUT
+
+DEFAULT_CHUNK_SIZE = 4096
+
+
+def _chunk_path(directory, kind, number, ext):
+    return os.path.join(directory, f"{kind}_{number:06d}{ext}")
+
+
+def _chunk_numbers(directory):
+    """Numbers of the complete chunks in a store, in order."""
+    names = glob.glob(os.path.join(directory, "fills_" + "[0-9]" * 6 + ".npy"))
+    return sorted(int(os.path.basename(name)[6:12]) for name in names)
+
+
+class FillStoreWriter:
+    """
+    Appends sheets' (questions, options) fill-ratio matrices to a columnar store:
+    every `chunk_size` sheets become one fills_NNNNNN.npy array of shape
+    (sheets, questions, options) plus a sheets_NNNNNN.json list of
+    {"hash", "source", "layout"} with the same order. Sheets of different
+    layouts are buffered apart, so every chunk holds a single matrix shape.
+    Chunks are written whole and never modified, so an interrupted run loses at
+    most the unflushed sheets.
+    """
+
+    def __init__(self, directory, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        os.makedirs(directory, exist_ok=True)
+        self._next_chunk = len(_chunk_numbers(directory))
+        # layout -> (fill matrices, index entries) not yet written.
+        self._pending = {}
+
+    def add(self, content_hash, source, fill_ratios, layout=None):
+        fills, sheets = self._pending.setdefault(layout, ([], []))
+        fills.append(np.asarray(fill_ratios, dtype=np.float32))
+        sheets.append({"hash": content_hash, "source": source, "layout": layout})
+        if len(fills) >= self.chunk_size:
+            self._write_chunk(layout)
+
+    def flush(self):
+        for layout in list(self._pending):
+            self._write_chunk(layout)
+
+    def _write_chunk(self, layout):
+        fills, sheets = self._pending.pop(layout, ([], []))
+        if not fills:
+            return
+        # The index is written first, and created exclusively so several writers can share a
+        # store; a chunk only counts once its fills file exists.
+        while True:
+            try:
+                f = open(_chunk_path(self.directory, "sheets", self._next_chunk, ".json"), "x")
+                break
+            except FileExistsError:
+                self._next_chunk += 1
+        with f:
+            json.dump(sheets, f, separators=(",", ":"))
+        fills_path = _chunk_path(self.directory, "fills", self._next_chunk, ".npy")
+        np.save(fills_path + ".tmp.npy", np.stack(fills))
+        os.replace(fills_path + ".tmp.npy", fills_path)
+        self._next_chunk += 1
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_fills(directory, layout=None):
+    """
+    Loads every chunk of a store as (sheets, fills): the list of {"hash", "source",
+    "layout"} and one (sheets, questions, options) float32 array. With `layout`
+    only that layout's chunks are loaded (chunks written before layouts were
+    recorded count as the default layout). A sheet stored more than once (graded
+    again) keeps only its latest matrix.
+    """
+    sheets, arrays = [], []
+    for number in _chunk_numbers(directory):
+        with open(_chunk_path(directory, "sheets", number, ".json")) as f:
+            chunk = json.load(f)
+        if layout is not None and chunk and (chunk[0].get("layout") or DEFAULT_LAYOUT) != layout:
+            continue
+        sheets.extend(chunk)
+        arrays.append(np.load(_chunk_path(directory, "fills", number, ".npy"), mmap_mode="r"))
+    if not arrays:
+        return [], np.empty((0, 0, 0), dtype=np.float32)
+    if len({a.shape[1:] for a in arrays}) > 1:
+        raise ValueError(f"{directory} holds sheets of several layouts; load one layout at a time.")
+
+    latest = {}
+    for i, sheet in enumerate(sheets):
+        latest[sheet["hash"]] = i
+    keep = np.array(sorted(latest.values()), dtype=np.int64)
+    fills = np.concatenate(arrays)
+    if len(keep) < len(sheets):
+        fills = fills[keep]
+        sheets = [sheets[i] for i in keep]
+    return sheets, fills
@@ -0,0 +1,60 @@
+import os
+import hashlib
+import zipfile
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def is_image_name(name):
+    base = os.path.basename(name)
+    # Skip hidden files and the resource forks macOS adds to archives.
+    return not base.startswith(".") and base.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def content_hash(data):
+    """Identifies an image by its bytes, so a renamed or re-uploaded photo is still recognised."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def iter_zip_images(zip_source):
+    """
+    Yields `(name, bytes)` for every image in a ZIP archive, reading one member
+    at a time so only the image being handed out is held in memory.
+    `zip_source` may be a path or a binary file-like object (e.g. a Streamlit upload).
+    """
+    with zipfile.ZipFile(zip_source) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or "__MACOSX/" in info.filename or not is_image_name(info.filename):
+                continue
+            yield info.filename, archive.read(info)
+
+
+def read_zip_image(zip_source, name):
+    """Re-reads a single member, e.g. to show the original next to its result."""
+    with zipfile.ZipFile(zip_source) as archive:
+        return archive.read(name)
+
+
+def iter_directory_images(directory, recursive=True):
+    """
+    Yields `(name, path)` for every image under a server-side directory in a
+    stable order. Paths are handed on as-is; whoever grades the sheet reads it.
+    """
+    directory = os.path.abspath(directory)
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(files):
+            if is_image_name(filename):
+                path = os.path.join(root, filename)
+                yield os.path.relpath(path, directory), path
+        if not recursive:
+            break
+
+
+def count_images(zip_source=None, directory=None):
+    """Counts images without reading them, so progress can be shown for a stream."""
+    if zip_source is not None:
+        with zipfile.ZipFile(zip_source) as archive:
+            return sum(1 for info in archive.infolist()
+                       if not info.is_dir() and "__MACOSX/" not in info.filename and is_image_name(info.filename))
+    return sum(1 for _ in iter_directory_images(directory))
@@ -0,0 +1,491 @@
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import subprocess
+from contextlib import contextmanager
+
+import numpy as np
+
+from .answer_key import load_answer_key
+from .audit import audit_basename, build_audit_record, save_audit_record
+from .batch import _evaluate_sheet, _score_cached
+from .fill_store import FillStoreWriter
+from .ingest import content_hash
+from .memory import WarpBuffers
+from .result_cache import ReadoutCache, DEFAULT_MAX_BYTES, layouts_fingerprint
+from .template import DEFAULT_LAYOUT, load_layouts, load_template
+from .video import iter_video_sheets
+
+# Sub-directories of a job's results_dir that workers write the audit trail into.
+AUDIT_SUBDIR = "json"
+THUMBNAIL_SUBDIR = "thumbnails"
+FILLS_SUBDIR = "fills"
+# A worker that has not been heard from for this long is considered gone.
+WORKER_TIMEOUT = 15.0
+# A task claimed this long ago by a worker that is gone is handed out again.
+STALE_TASK_SECONDS = 120.0
+SUBMIT_COMMIT_EVERY = 200
+# Task columns added since the first release; older databases get them when opened.
+ADDED_TASK_COLUMNS = {"layout": "TEXT", "review": "INTEGER NOT NULL DEFAULT 0", "kind": "TEXT NOT NULL DEFAULT 'sheet'"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    answer_key TEXT NOT NULL,
+    results_dir TEXT,
+    label TEXT,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    completed INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER NOT NULL REFERENCES jobs(id),
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    hash TEXT,
+    status TEXT NOT NULL DEFAULT 'queued',
+    worker TEXT,
+    claimed_at REAL,
+    finished_at REAL,
+    summary TEXT,
+    fill_ratios BLOB,
+    timings TEXT,
+    error TEXT,
+    cached INTEGER NOT NULL DEFAULT 0,
+    layout TEXT,
+    review INTEGER NOT NULL DEFAULT 0,
+    kind TEXT NOT NULL DEFAULT 'sheet'
+);
+CREATE INDEX IF NOT EXISTS tasks_queue ON tasks(status, position, job_id);
+CREATE INDEX IF NOT EXISTS tasks_job ON tasks(job_id, id);
+CREATE TABLE IF NOT EXISTS workers (
+    id TEXT PRIMARY KEY,
+    pid INTEGER,
+    host TEXT,
+    started_at REAL,
+    last_seen REAL,
+    processed INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+def _connect(db_path):
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def setup_database(db_path):
+    """
+    Creates the job database and its spool directory, or brings an older database
+    up to date. WAL mode is stored in the database file, so connections opened
+    afterwards need none of this.
+    """
+    db_path = os.path.abspath(db_path)
+    os.makedirs(os.path.join(os.path.dirname(db_path), "spool"), exist_ok=True)
+    conn = _connect(db_path)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        columns = [row["name"] for row in conn.execute("PRAGMA table_info(tasks)")]
+        for name, definition in ADDED_TASK_COLUMNS.items():
+            if name not in columns:
+                conn.execute(f"ALTER TABLE tasks ADD COLUMN {name} {definition}")
+    finally:
+        conn.close()
+
+
+class JobQueue:
+    """
+    Grading jobs in a local SQLite database, so no outside broker is needed. A job
+    is a batch of sheets graded against one answer key; each sheet is a task that
+    any worker process can claim. Tasks of concurrent jobs are handed out in turn
+    (first sheet of every job, then the second, ...), so one large batch does not
+    hold back the other evaluators. Uploaded images are spooled to files next to
+    the database, named by content hash. A video is queued as a single "video"
+    task, which the worker that claims it replaces with a task per sheet found.
+    With setup=False the database is assumed to be set up already (see
+    setup_database) and only a connection is opened.
+    """
+
+    def __init__(self, db_path, setup=True):
+        self.db_path = os.path.abspath(db_path)
+        self.spool_dir = os.path.join(os.path.dirname(self.db_path), "spool")
+        if setup:
+            setup_database(self.db_path)
+        self.conn = _connect(self.db_path)
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+    @contextmanager
+    def _write(self):
+        # IMMEDIATE takes the write lock up front, so two workers cannot claim the same task.
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def close(self):
+        self.conn.close()
+
+    def spool(self, name, data):
+        """Writes uploaded image bytes to the spool once per content; returns (path, hash)."""
+        digest = content_hash(data)
+        path = os.path.join(self.spool_dir, digest + os.path.splitext(name)[1].lower())
+        if not os.path.exists(path):
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return path, digest
+
+    def submit(self, answer_key_path, sheets, results_dir=None, label=None):
+        """
+        Queues a job and returns its id. `sheets` yields `(name, source)` pairs where
+        source is a file path (graded in place) or image bytes (spooled first).
+        Tasks are committed in groups while the sheets are read, so workers start on
+        a large batch before it is fully submitted.
+        """
+        with self._write() as conn:
+            job_id = conn.execute(
+                "INSERT INTO jobs (answer_key, results_dir, label, status, created_at) VALUES (?, ?, ?, 'submitting', ?)",
+                (os.path.abspath(answer_key_path), results_dir, label, time.time())).lastrowid
+        rows = []
+        total = 0
+        for name, source in sheets:
+            digest = None
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                path, digest = self.spool(name, bytes(source))
+            else:
+                path = os.path.abspath(os.fspath(source))
+            rows.append((job_id, total, name, path, digest))
+            total += 1
+            if len(rows) >= SUBMIT_COMMIT_EVERY:
+                self._insert_tasks(rows)
+                rows = []
+        self._insert_tasks(rows)
+        with self._write() as conn:
+            conn.execute("UPDATE jobs SET total = ?, status = 'queued' WHERE id = ?", (total, job_id))
+            finished = self._finish_if_complete(conn, job_id)
+        if finished:
+            # Workers graded every sheet before the submission was closed.
+            _export_fills(self, job_id)
+        return job_id
+
+    def submit_video(self, answer_key_path, name, data, results_dir=None, label=None):
+        """
+        Queues a job for a video of sheets and returns its id. Only the video is
+        spooled here; scanning it for sheets is left to a worker (see expand_video).
+        """
+        path, digest = self.spool(name, bytes(data))
+        with self._write() as conn:
+            job_id = conn.execute(
+                "INSERT INTO jobs (answer_key, results_dir, label, status, created_at) VALUES (?, ?, ?, 'submitting', ?)",
+                (os.path.abspath(answer_key_path), results_dir, label, time.time())).lastrowid
+            conn.execute("INSERT INTO tasks (job_id, position, name, path, hash, kind) VALUES (?, 0, ?, ?, ?, 'video')",
+                         (job_id, name, path, digest))
+        return job_id
+
+    def expand_video(self, task, worker_id, stride=2):
+        """
+        Scans a claimed video task for sheets and queues a task for each, as soon
+        as it is found, so other workers grade them while the scan goes on. The
+        video task is then removed and the job's submission closed; a video that
+        cannot be read stays behind as a failed task. A scan taken over from a
+        worker that died skips the sheets already queued. Returns True if the job
+        finished.
+        """
+        job_id = task["job_id"]
+        queued = self.conn.execute("SELECT COUNT(*) FROM tasks WHERE job_id = ? AND kind = 'sheet'",
+                                   (job_id,)).fetchone()[0]
+        total, error = queued, None
+        try:
+            for index, (name, data) in enumerate(iter_video_sheets(task["path"], stride, name=task["name"])):
+                if index < queued:
+                    continue
+                path, digest = self.spool(name, data)
+                with self._write() as conn:
+                    conn.execute("INSERT INTO tasks (job_id, position, name, path, hash) VALUES (?, ?, ?, ?, ?)",
+                                 (job_id, total, name, path, digest))
+                    # A long scan must not look like a dead worker.
+                    conn.execute("UPDATE workers SET last_seen = ? WHERE id = ?", (time.time(), worker_id))
+                total += 1
+        except Exception as e:
+            error = str(e)
+        with self._write() as conn:
+            if error:
+                conn.execute("UPDATE tasks SET status = 'error', error = ?, finished_at = ? WHERE id = ?",
+                             (error, time.time(), task["id"]))
+                conn.execute("UPDATE jobs SET failed = failed + 1 WHERE id = ?", (job_id,))
+                total += 1
+            else:
+                conn.execute("DELETE FROM tasks WHERE id = ?", (task["id"],))
+            conn.execute("UPDATE jobs SET total = ?, status = 'queued' WHERE id = ? AND status = 'submitting'",
+                         (total, job_id))
+            finished = self._finish_if_complete(conn, job_id)
+            spooled_elsewhere = conn.execute("SELECT 1 FROM tasks WHERE path = ? LIMIT 1", (task["path"],)).fetchone()
+        if not error and spooled_elsewhere is None:
+            try:
+                os.remove(task["path"])
+            except OSError:
+                pass
+        return finished
+
+    def _insert_tasks(self, rows):
+        if rows:
+            with self._write() as conn:
+                conn.executemany("INSERT INTO tasks (job_id, position, name, path, hash) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def _finish_if_complete(self, conn, job_id):
+        """Marks a fully submitted job done once every task is; returns True if it just finished."""
+        return conn.execute(
+            "UPDATE jobs SET status = 'done', finished_at = ? "
+            "WHERE id = ? AND status IN ('queued', 'running') AND completed + failed >= total",
+            (time.time(), job_id)).rowcount > 0
+
+    def claim(self, worker_id):
+        """Hands the next queued task to a worker, or returns None when the queue is empty."""
+        with self._write() as conn:
+            row = conn.execute(
+                "SELECT t.id, t.job_id, t.name, t.path, t.hash, t.kind, j.answer_key, j.results_dir "
+                "FROM tasks t JOIN jobs j ON j.id = t.job_id "
+                "WHERE t.status = 'queued' ORDER BY t.position, t.job_id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE tasks SET status = 'running', worker = ?, claimed_at = ? WHERE id = ?",
+                         (worker_id, time.time(), row["id"]))
+            conn.execute("UPDATE jobs SET status = 'running' WHERE id = ? AND status = 'queued'", (row["job_id"],))
+        return dict(row)
+
+    def complete(self, task, worker_id, record):
+        """Stores a task's outcome; returns True if it was the last task of its job."""
+        result = record["result"]
+        summary = None
+        if result:
+            summary = {"total_score": result["total_score"], "subject_scores": result["subject_scores"],
+                       "alignment": result.get("alignment"), "review": result["review"]}
+            if result.get("review_reason"):
+                summary["review_reason"] = result["review_reason"]
+            if record.get("readout"):
+                # Layouts differ in options per question; the fill blob is reshaped with this.
+                summary["options"] = record["readout"].fill_ratios.shape[1]
+            summary = json.dumps(summary)
+        fills = record["readout"].fill_ratios.astype(np.float32).tobytes() if record.get("readout") else None
+        failed = 0 if result else 1
+        with self._write() as conn:
+            conn.execute(
+                "UPDATE tasks SET status = ?, hash = ?, finished_at = ?, summary = ?, fill_ratios = ?, "
+                "timings = ?, error = ?, cached = ?, layout = ?, review = ? WHERE id = ?",
+                ("done" if result else "error", record.get("hash") or task["hash"], time.time(), summary, fills,
+                 json.dumps(record["timings"]) if record["timings"] else None, record["error"],
+                 int(record.get("cached", False)), result.get("layout") if result else None,
+                 len(result["review"]) if result else 0, task["id"]))
+            conn.execute("UPDATE jobs SET completed = completed + ?, failed = failed + ? WHERE id = ?",
+                         (1 - failed, failed, task["job_id"]))
+            conn.execute("UPDATE workers SET last_seen = ?, processed = processed + 1 WHERE id = ?",
+                         (time.time(), worker_id))
+            return self._finish_if_complete(conn, task["job_id"])
+
+    def requeue_stale(self, max_seconds=STALE_TASK_SECONDS):
+        """Hands out again the tasks of workers that died while grading them."""
+        now = time.time()
+        with self._write() as conn:
+            return conn.execute(
+                "UPDATE tasks SET status = 'queued', worker = NULL, claimed_at = NULL "
+                "WHERE status = 'running' AND claimed_at < ? "
+                "AND worker NOT IN (SELECT id FROM workers WHERE last_seen >= ?)",
+                (now - max_seconds, now - WORKER_TIMEOUT)).rowcount
+
+    def register_worker(self, worker_id):
+        now = time.time()
+        with self._write() as conn:
+            conn.execute("INSERT OR REPLACE INTO workers (id, pid, host, started_at, last_seen) VALUES (?, ?, ?, ?, ?)",
+                         (worker_id, os.getpid(), socket.gethostname(), now, now))
+
+    def heartbeat(self, worker_id):
+        with self._write() as conn:
+            conn.execute("UPDATE workers SET last_seen = ? WHERE id = ?", (time.time(), worker_id))
+
+    def unregister_worker(self, worker_id):
+        with self._write() as conn:
+            conn.execute("DELETE FROM workers WHERE id = ?", (worker_id,))
+
+    def live_workers(self):
+        return self.conn.execute("SELECT COUNT(*) FROM workers WHERE last_seen >= ?",
+                                 (time.time() - WORKER_TIMEOUT,)).fetchone()[0]
+
+    def queued_tasks(self):
+        return self.conn.execute("SELECT COUNT(*) FROM tasks WHERE status IN ('queued', 'running')").fetchone()[0]
+
+    def job(self, job_id):
+        row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def job_tasks(self, job_id):
+        """Finished tasks of a job in submission order, with summary, timings and fill ratios decoded."""
+        tasks = []
+        for row in self.conn.execute("SELECT * FROM tasks WHERE job_id = ? AND status IN ('done', 'error') "
+                                     "ORDER BY position", (job_id,)):
+            task = dict(row)
+            task["summary"] = json.loads(task["summary"]) if task["summary"] else None
+            task["timings"] = json.loads(task["timings"]) if task["timings"] else None
+            if task["fill_ratios"] is not None:
+                num_options = (task["summary"] or {}).get("options") or load_template(DEFAULT_LAYOUT).num_options
+                task["fill_ratios"] = np.frombuffer(task["fill_ratios"], dtype=np.float32).reshape(-1, num_options)
+            tasks.append(task)
+        return tasks
+
+    def review_queue(self, job_id=None):
+        """
+        Graded sheets with questions still uncertain after the second pass, for a
+        person to check: (task id, job id, name, path, hash, questions), oldest first.
+        """
+        query = "SELECT id, job_id, name, path, hash, summary FROM tasks WHERE review > 0"
+        params = ()
+        if job_id is not None:
+            query += " AND job_id = ?"
+            params = (job_id,)
+        queue = []
+        for row in self.conn.execute(query + " ORDER BY finished_at", params):
+            task = dict(row)
+            task["questions"] = json.loads(task.pop("summary"))["review"]
+            queue.append(task)
+        return queue
+
+    def delete_job(self, job_id):
+        """Removes a job, its tasks and the spooled images no other task uses."""
+        with self._write() as conn:
+            paths = [row[0] for row in conn.execute("SELECT DISTINCT path FROM tasks WHERE job_id = ?", (job_id,))]
+            conn.execute("DELETE FROM tasks WHERE job_id = ?", (job_id,))
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            unused = [path for path in paths if os.path.dirname(path) == self.spool_dir and
+                      conn.execute("SELECT 1 FROM tasks WHERE path = ? LIMIT 1", (path,)).fetchone() is None]
+        for path in unused:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _run_task(task, templates, options, cache, buffers=None):
+    """Grades one claimed task and writes its audit files; never raises."""
+    start = time.perf_counter()
+    try:
+        answer_keys = {t.name: load_answer_key(task["answer_key"], t.num_questions, t.num_options)
+                       for t in templates}
+        with open(task["path"], "rb") as f:
+            data = f.read()
+    except Exception as e:
+        return {"source": task["name"], "result": None, "readout": None, "thumbnail": None, "error": str(e),
+                "timings": None, "cached": False}
+    digest = task["hash"] or content_hash(data)
+    hit = cache.get(digest, need_thumbnail=True) if cache is not None else None
+    record = _score_cached(task["name"], data, hit, answer_keys, templates, options) if hit else None
+    if record is None:
+        record = _evaluate_sheet(task["name"], data, answer_keys, templates, options, buffers)
+        if cache is not None and record["readout"] is not None:
+            cache.put(digest, record["readout"], record["thumbnail"])
+    record["hash"] = digest
+
+    if record["result"] and task["results_dir"]:
+        timings = record["timings"]
+        filename_base = audit_basename(task["name"], digest)
+        write_start = time.perf_counter()
+        thumbnail_file = f"{filename_base}_thumb.jpg"
+        with open(os.path.join(task["results_dir"], THUMBNAIL_SUBDIR, thumbnail_file), "wb") as f:
+            f.write(record["thumbnail"])
+        timings["write_image"] = (time.perf_counter() - write_start) * 1000.0
+        write_start = time.perf_counter()
+        save_audit_record(os.path.join(task["results_dir"], AUDIT_SUBDIR, f"{filename_base}_result.json"),
+                          build_audit_record(task["name"], record["result"], thumbnail_file))
+        timings["write_json"] = (time.perf_counter() - write_start) * 1000.0
+        timings["sheet_total"] = (time.perf_counter() - start) * 1000.0
+    return record
+
+
+def _export_fills(queue, job_id):
+    """Appends a finished job's fill matrices to the fill store in its results directory."""
+    job = queue.job(job_id)
+    if not job or not job["results_dir"]:
+        return
+    with FillStoreWriter(os.path.join(job["results_dir"], FILLS_SUBDIR)) as store:
+        for task in queue.job_tasks(job_id):
+            if task["fill_ratios"] is not None:
+                store.add(task["hash"], task["name"], task["fill_ratios"], task["layout"])
+
+
+def run_worker(db_path, worker_id=None, cache_dir=None, cache_max_bytes=DEFAULT_MAX_BYTES,
+               poll_interval=0.5, exit_when_idle=False, layouts=None, max_memory=None):
+    """
+    Long-lived worker loop: claims tasks one at a time and grades them. The
+    compiled layouts, answer keys (cached by file) and OpenCV state stay loaded between
+    tasks. Sheets are routed among `layouts` (all registered layouts by default).
+    Runs until interrupted, or until the queue is empty with exit_when_idle.
+    With `max_memory` (bytes) the warp buffers are reused between sheets, and the
+    worker stops after a sheet that leaves it above the ceiling even once freed
+    memory is released; it then returns True so it can be replaced by a fresh process.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    queue = JobQueue(db_path)
+    templates = load_layouts(layouts)
+    options = {"timings": True, "render_overlay": False, "thumbnails": True, "second_pass": True,
+               "max_memory": max_memory, "marker_cache": False}
+    buffers = WarpBuffers() if max_memory else None
+    cache = None
+    if cache_dir:
+        cache = ReadoutCache(cache_dir, cache_max_bytes, layouts_fingerprint(templates))
+    queue.register_worker(worker_id)
+    try:
+        while True:
+            task = queue.claim(worker_id)
+            if task is None:
+                queue.heartbeat(worker_id)
+                queue.requeue_stale()
+                if exit_when_idle:
+                    break
+                time.sleep(poll_interval)
+                continue
+            if task["kind"] == "video":
+                if queue.expand_video(task, worker_id):
+                    _export_fills(queue, task["job_id"])
+                continue
+            if task["results_dir"]:
+                for subdir in (AUDIT_SUBDIR, THUMBNAIL_SUBDIR):
+                    os.makedirs(os.path.join(task["results_dir"], subdir), exist_ok=True)
+            record = _run_task(task, templates, options, cache, buffers)
+            if record["error"]:
+                print(f"Could not process {task['name']}: {record['error']}", file=sys.stderr)
+            # Completing a task also refreshes the worker's heartbeat.
+            if queue.complete(task, worker_id, record):
+                _export_fills(queue, task["job_id"])
+            if record.get("over_memory"):
+                print(f"Worker {worker_id} is above its memory ceiling of {max_memory // 2**20} MB; stopping.",
+                      file=sys.stderr)
+                return True
+    finally:
+        queue.unregister_worker(worker_id)
+        queue.close()
+    return False
+
+
+def start_workers(db_path, count, cache_dir=None, max_memory=None):
+    """Starts `count` worker processes in the background, detached from the caller."""
+    command = [sys.executable, "-m", "omr_processing", "worker", "--db", os.path.abspath(db_path),
+               "--workers", str(count)]
+    if cache_dir:
+        command += ["--cache", os.path.abspath(cache_dir)]
+    if max_memory:
+        command += ["--max-memory", str(max_memory // 2**20)]
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.Popen(command, cwd=package_root, start_new_session=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
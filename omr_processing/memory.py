@@ -0,0 +1,76 @@
+import gc
+import os
+import sys
+import ctypes
+import ctypes.util
+import cv2
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_libc_path = ctypes.util.find_library("c") if sys.platform.startswith("linux") else None
+_malloc_trim = getattr(ctypes.CDLL(_libc_path), "malloc_trim", None) if _libc_path else None
+
+
+def process_memory():
+    """Resident memory of this process in bytes (the peak so far where /proc is not available, 0 if unknown)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        if resource is None:
+            return 0
+        # ru_maxrss is in KiB on Linux and bytes on macOS.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def release_memory():
+    """Collects garbage and hands freed heap pages back to the OS (glibc only). Returns the resident memory after."""
+    gc.collect()
+    if _malloc_trim is not None:
+        _malloc_trim(0)
+    return process_memory()
+
+
+def within_ceiling(max_bytes):
+    """
+    Checked after each sheet: True if the process is within `max_bytes` of
+    resident memory, releasing freed memory first when it is not.
+    """
+    if not max_bytes or process_memory() <= max_bytes:
+        return True
+    return release_memory() <= max_bytes
+
+
+class WarpBuffers:
+    """
+    Preallocated outputs of the warp and grayscale stages, one pair per warped
+    size, written in place through OpenCV's dst= arguments so a worker does not
+    allocate two sheet-sized images per sheet. The arrays are overwritten by the
+    next sheet: anything that must outlive it has to be copied.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def _pair(self, size):
+        pair = self._buffers.get(size)
+        if pair is None:
+            w, h = size
+            pair = self._buffers[size] = (np.empty((h, w, 3), dtype=np.uint8), np.empty((h, w), dtype=np.uint8))
+        return pair
+
+    def warp(self, image, matrix, size):
+        return cv2.warpPerspective(image, matrix, size, dst=self._pair(size)[0])
+
+    def to_gray(self, image):
+        h, w = image.shape[:2]
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self._pair((w, h))[1])
+
+    @property
+    def nbytes(self):
+        return sum(color.nbytes + gray.nbytes for color, gray in self._buffers.values())
@@ -1,140 +1,272 @@
+import os
 import cv2
 import numpy as np
-import json
-from . import utils
-
-TOTAL_QUESTIONS = 100
-TOTAL_OPTIONS = 4
-QUESTIONS_PER_SUBJECT = 20
-NUM_SUBJECTS = 5
-BUBBLE_THRESHOLD_RATIO = 0.30 
+from . import audit, utils
+from .alignment import find_sheet_homography, locate_markers_relit, route_sheet
+from .answer_key import AnswerKey, load_answer_key
+from .bubble_grid import measure_fill_ratios, remeasure_fill_ratios, shadowed_rows
+from .scoring import SheetReadout, REVIEW_CONFIDENCE, question_confidence, score_readout
+from .timing import StageTimer
+from .template import SheetTemplate, load_template
 
 class OMREvaluator:
-    def __init__(self, image_path, answer_key_path):
+    def __init__(self, image_path, answer_key_path, scoring_mode="grid", template=None, name=None,
+                 alignment="auto", timings=False, reduced_decode=True, layouts=None, second_pass=True,
+                 buffers=None, marker_cache=False):
+        """
+        `image_path` may be a file path, encoded image bytes or a decoded ndarray;
+        `name` labels in-memory images in error messages.
+        `answer_key_path` may be a path, an already loaded AnswerKey, or a dict of
+        either by layout name; `template` a SheetTemplate (the default layout when
+        not given). Keys and templates are loaded once and cached, so creating an
+        evaluator per sheet is cheap.
+        With several compiled `layouts` each sheet is routed to its own layout
+        (see alignment.route_sheet) before it is warped.
+        With alignment="auto" the sheet is warped using its fiducial markers and the
+        calibration points are only used when no markers are found; "calibration"
+        always uses the calibration points.
+        With timings=True the result carries per-stage milliseconds under "timings".
+        With reduced_decode=True large JPEGs are decoded at 1/2, 1/4 or 1/8 size when
+        that still leaves more than enough pixels for the warp.
+        With second_pass=True questions read with low confidence get a slower second
+        look (see recheck()); clean sheets skip it.
+        With `buffers` (a memory.WarpBuffers) the warped image and its grayscale
+        copy are written into reused arrays, which the next sheet overwrites.
+        With marker_cache=True marker locations are reused from the last sheet of
+        the same size while its markers are still dark there (see
+        alignment.locate_markers); only for a fixed scanner or camera rig.
+        """
         self.image_path = image_path
-        with open(answer_key_path, 'r') as f:
-            self.answer_key = json.load(f)
+        if name is None:
+            name = os.fspath(image_path) if isinstance(image_path, (str, os.PathLike)) else "<in-memory image>"
+        self.name = name
+        self.scoring_mode = scoring_mode
+        self.alignment = alignment
+        self.marker_cache = marker_cache
+        self.timer = StageTimer(enabled=timings)
+        self.second_pass = second_pass
+        self.reduced_decode = reduced_decode
+        self.buffers = buffers
+        # Decoded size / original size; calibration points are in original pixels.
+        self.decode_scale = 1.0
+        self.answer_keys = answer_key_path
+        if layouts:
+            self.layouts = list(layouts)
+        else:
+            self.layouts = [template if isinstance(template, SheetTemplate) else load_template()]
         self.processed_data = {}
-        
-        self.calibration_points = np.array([[75, 167], [934, 164], [953, 904], [49, 900]])
-        
-        self.question_blocks = [
-            (4, 98, 152, 897),
-            (172, 101, 139, 888),
-            (325, 101, 149, 890),
-            (478, 104, 155, 891),
-            (632, 106, 161, 888),
-        ]
-
-    def run_evaluation(self):
+        self.readout = None
+        self.markers = None
+        self.use_template(self.layouts[0])
+
+    def use_template(self, template):
+        """Switches the evaluator to a layout, with the answer key that goes with it."""
+        self.template = template
+        self.calibration_points = template.calibration_points
+        self.question_blocks = template.question_blocks
+        key = self.answer_keys
+        if isinstance(key, dict):
+            key = key.get(template.name)
+        if key is None or isinstance(key, AnswerKey):
+            self.answer_key = key
+        else:
+            self.answer_key = load_answer_key(key, template.num_questions, template.num_options)
+
+    def run_evaluation(self, render_overlay=True):
+        """
+        Returns (result, overlay image). With render_overlay=False the overlay is
+        skipped and None is returned in its place; it can be drawn later from the
+        result with create_visual_overlay() or audit.regenerate_overlay().
+        """
         try:
-            original_img = cv2.imread(self.image_path)
+            timer = self.timer
+            with timer.stage("decode"):
+                if self.reduced_decode:
+                    target = max(t.warped_size for t in self.layouts)
+                    original_img, self.decode_scale = utils.load_image_for_warp(self.image_path, *target)
+                else:
+                    original_img = utils.load_image(self.image_path)
             if original_img is None: raise ValueError("Image could not be read.")
-            self.warped_image = utils.apply_perspective_transform(original_img, self.calibration_points)
-            self.warped_gray = cv2.cvtColor(self.warped_image, cv2.COLOR_BGR2GRAY)
-            self.extract_and_score_bubbles()
-            self.create_visual_overlay()
+            if len(self.layouts) > 1:
+                with timer.stage("route"):
+                    template, self.markers = route_sheet(original_img, self.layouts, self.marker_cache)
+                    self.use_template(template)
+            if self.answer_key is None:
+                raise ValueError(f"No answer key for layout {self.template.name}.")
+            warped_size = self.template.warped_size
+            with timer.stage("align"):
+                matrix = self.find_homography(original_img)
+            with timer.stage("warp"):
+                if self.buffers is not None:
+                    self.warped_image = self.buffers.warp(original_img, matrix, warped_size)
+                else:
+                    self.warped_image = cv2.warpPerspective(original_img, matrix, warped_size)
+            with timer.stage("grayscale"):
+                if self.buffers is not None:
+                    self.warped_gray = self.buffers.to_gray(self.warped_image)
+                else:
+                    self.warped_gray = cv2.cvtColor(self.warped_image, cv2.COLOR_BGR2GRAY)
+            with timer.stage("extract"):
+                self.extract_bubbles()
+            if self.second_pass:
+                with timer.stage("second_pass"):
+                    matrix = self.recheck(original_img, matrix)
+            self.readout.alignment = self.alignment_method
+            # Stored against the full-resolution photo so the overlay can be redrawn from the original.
+            self.readout.homography = matrix @ np.diag([self.decode_scale, self.decode_scale, 1.0])
+            with timer.stage("score"):
+                self.processed_data = score_readout(self.readout, self.answer_key, self.template)
+            self.overlay_image = None
+            if render_overlay:
+                with timer.stage("overlay"):
+                    self.create_visual_overlay()
+            if timer.enabled:
+                self.processed_data["timings"] = dict(timer.timings)
             return self.processed_data, self.overlay_image
         except Exception as e:
-            print(f"Error processing {self.image_path}: {e}")
+            print(f"Error processing {self.name}: {e}")
             return None, None
 
+    def find_homography(self, image):
+        if self.alignment == "auto":
+            matrix, method = find_sheet_homography(image, self.template.marker_points, self.marker_cache,
+                                                   located=self.markers)
+            if matrix is not None:
+                self.alignment_method = method
+                return matrix
+        self.alignment_method = "calibration"
+        points = np.asarray(self.calibration_points, dtype=np.float32) * self.decode_scale
+        return utils.get_perspective_matrix(points, *self.template.warped_size)
+
+    def recheck(self, image, matrix):
+        """
+        Second pass over what the fast path was unsure of. Rows below
+        REVIEW_CONFIDENCE are re-read with the layout's bubble grid (see
+        bubble_grid.remeasure_fill_ratios), keeping the clearer reading of each.
+        A sheet whose markers were not found is also aligned again from a marker
+        search on a relit copy; that reading, re-read the same way, is kept unless
+        it is less clear overall. Returns the homography in use.
+        """
+        confidence = self.reread_unclear_rows()
+        if self.alignment == "auto" and self.alignment_method == "calibration":
+            located = locate_markers_relit(image)
+            if located is not None:
+                relit_matrix, method = find_sheet_homography(image, self.template.marker_points, located=located)
+                previous = self.warped_image, self.warped_gray, self.readout
+                # Fresh arrays, not the reused buffers: the first reading may still be kept.
+                self.warped_image = cv2.warpPerspective(image, relit_matrix, self.template.warped_size)
+                self.warped_gray = cv2.cvtColor(self.warped_image, cv2.COLOR_BGR2GRAY)
+                self.extract_bubbles()
+                relit_confidence = self.reread_unclear_rows()
+                if relit_confidence.mean() >= confidence.mean():
+                    matrix, self.alignment_method = relit_matrix, method
+                else:
+                    self.warped_image, self.warped_gray, self.readout = previous
+        return matrix
+
+    def reread_unclear_rows(self):
+        """
+        Re-reads the readout's low-confidence and shadowed rows in place; returns
+        the per-question confidence after.
+        """
+        template, readout = self.template, self.readout
+        confidence = question_confidence(readout.fill_ratios)
+        if template.bubble_grid is None:
+            return confidence
+        low = np.flatnonzero((confidence < REVIEW_CONFIDENCE) | shadowed_rows(self.warped_gray, template.bubble_grid))
+        if not len(low):
+            return confidence
+        fills = remeasure_fill_ratios(self.warped_gray, template.bubble_grid, low)
+        fill_confidence = question_confidence(fills)
+        # Shadowed rows take the second reading outright; the first one cannot be trusted there.
+        better = (fill_confidence > confidence[low]) | (confidence[low] >= REVIEW_CONFIDENCE)
+        rows = low[better]
+        readout.fill_ratios[rows] = fills[better]
+        confidence[rows] = fill_confidence[better]
+        # Grid readouts already share the layout's boxes; contour readouts take them for the re-read rows.
+        if readout.coords is not template.bubble_coords:
+            readout.coords[rows] = template.bubble_coords[rows]
+            readout.block_origins[rows] = template.block_origins[rows]
+        readout.rechecked = len(low)
+        return confidence
+
     def extract_and_score_bubbles(self):
-        detected_answers = {}
-        total_score = 0
-        subject_scores = {f"Subject_{i+1}": 0 for i in range(NUM_SUBJECTS)}
+        self.extract_bubbles()
+        self.processed_data = score_readout(self.readout, self.answer_key, self.template)
+
+    def extract_bubbles(self):
+        """Reads the fill ratio of every bubble into self.readout, independent of the answer key."""
+        if self.scoring_mode == "grid" and self.template.bubble_grid is not None:
+            self.readout = self.read_with_grid()
+        else:
+            self.readout = self.read_with_contours()
+        self.readout.layout = self.template.name
+        return self.readout
+
+    def read_with_grid(self):
+        # The boxes, their row-relative coordinates and sampling windows are compiled with the layout.
+        template = self.template
+        fill_ratios = measure_fill_ratios(self.warped_gray, windows=template.windows)
+        return SheetReadout(fill_ratios, template.bubble_coords, template.block_origins)
+
+    def read_with_contours(self):
+        # Rows without four bubbles keep a NaN fill row and are reported as unreadable.
+        template = self.template
+        num_questions, num_options = template.num_questions, template.num_options
+        questions_per_block = template.questions_per_block
+        fill_ratios = np.full((num_questions, num_options), np.nan, dtype=np.float32)
+        coords = np.zeros((num_questions, num_options, 4), dtype=np.int32)
+        block_origins = np.zeros((num_questions, 2), dtype=np.int32)
         question_counter = 1
-        
+
         for block_idx, (x, y, w, h) in enumerate(self.question_blocks):
             block_roi = self.warped_gray[y:y+h, x:x+w]
-            row_h = h // QUESTIONS_PER_SUBJECT
-            
-            for i in range(QUESTIONS_PER_SUBJECT):
-                # We check the question counter to ensure we don't process more than 100 questions
-                if question_counter > TOTAL_QUESTIONS:
+            row_h = h // questions_per_block
+
+            for i in range(questions_per_block):
+                # We check the question counter to ensure we don't process more questions than the layout has
+                if question_counter > num_questions:
                     break
-                
+
                 row_y_start = i * row_h
                 row_roi = block_roi[row_y_start:row_y_start+row_h, :]
                 thresh = cv2.threshold(row_roi, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
                 contours, _ = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                
+
                 min_area = 50
                 possible_bubbles = [c for c in contours if cv2.contourArea(c) > min_area]
 
-                if len(possible_bubbles) >= TOTAL_OPTIONS:
+                if len(possible_bubbles) >= num_options:
                     possible_bubbles.sort(key=cv2.contourArea, reverse=True)
-                    bubble_contours = possible_bubbles[:TOTAL_OPTIONS]
+                    bubble_contours = possible_bubbles[:num_options]
                 else:
                     bubble_contours = []
 
-                if len(bubble_contours) != TOTAL_OPTIONS:
+                if len(bubble_contours) != num_options:
                     question_counter += 1
                     continue
 
                 bubble_contours, _ = utils.sort_contours(bubble_contours, method="left-to-right")
-                marked_bubble_index = -1
-                max_filled = -1
+                filled = np.zeros(num_options, dtype=np.float32)
 
                 for j, c in enumerate(bubble_contours):
                     mask = np.zeros(thresh.shape, dtype="uint8")
                     cv2.drawContours(mask, [c], -1, 255, -1)
                     mask = cv2.bitwise_and(thresh, thresh, mask=mask)
-                    total_pixels = cv2.countNonZero(mask)
-                    if total_pixels > max_filled:
-                        max_filled = total_pixels
-                        marked_bubble_index = j
-                
-                (cx, cy, cw, ch) = cv2.boundingRect(bubble_contours[marked_bubble_index])
+                    filled[j] = cv2.countNonZero(mask)
+
+                # All counts are divided by the fullest bubble's box area, so the fullest
+                # bubble is still the one with the most ink and its ratio is unchanged.
+                boxes = [cv2.boundingRect(c) for c in bubble_contours]
+                (cx, cy, cw, ch) = boxes[int(filled.argmax())]
                 bubble_area = cw * ch
-                fill_ratio = max_filled / float(bubble_area) if bubble_area > 0 else 0
-                marked_answer = -1
-                if fill_ratio > BUBBLE_THRESHOLD_RATIO:
-                    marked_answer = marked_bubble_index
-                    
-                correct_answer_char = self.answer_key.get(str(question_counter))
-                correct_answer_index = {"A": 0, "B": 1, "C": 2, "D": 3}.get(correct_answer_char, -1)
-                is_correct = (marked_answer == correct_answer_index)
-                if is_correct:
-                    total_score += 1
-                    subject_scores[f"Subject_{block_idx + 1}"] += 1
-
-                detected_answers[question_counter] = {
-                    "marked": {0: "A", 1: "B", 2: "C", 3: "D"}.get(marked_answer, "None"),
-                    "correct": correct_answer_char, "is_correct": is_correct,
-                    "coords": [cv2.boundingRect(c) for c in bubble_contours], "block_origin": (x,y)
-                }
+                q_idx = question_counter - 1
+                fill_ratios[q_idx] = filled / float(bubble_area) if bubble_area > 0 else 0
+                coords[q_idx] = boxes
+                block_origins[q_idx] = (x, y)
                 question_counter += 1
 
-        self.processed_data = {"total_score": total_score, "subject_scores": subject_scores, "detected_answers": detected_answers}
+        return SheetReadout(fill_ratios, coords, block_origins)
 
     def create_visual_overlay(self):
-        self.overlay_image = self.warped_image.copy()
-        if not self.processed_data.get("detected_answers"):
-            return
-        
-        for q_num, data in self.processed_data["detected_answers"].items():
-            # This is the FIX: Calculate block_idx based on the current question number
-            block_idx = (q_num - 1) // QUESTIONS_PER_SUBJECT
-            if block_idx >= len(self.question_blocks): continue # Safety check
-
-            correct_answer_char = data["correct"]
-            correct_answer_index = {"A": 0, "B": 1, "C": 2, "D": 3}.get(correct_answer_char, -1)
-            marked_answer_char = data["marked"]
-            marked_answer_index = {"A": 0, "B": 1, "C": 2, "D": 3}.get(marked_answer_char, -1)
-            block_x, block_y = data["block_origin"]
-            q_in_block = (q_num - 1) % QUESTIONS_PER_SUBJECT
-            row_h = (self.question_blocks[block_idx][3] / QUESTIONS_PER_SUBJECT)
-            
-            if len(data.get("coords", [])) != TOTAL_OPTIONS:
-                continue
-
-            if correct_answer_index != -1:
-                (cx, cy, cw, ch) = data["coords"][correct_answer_index]
-                abs_x, abs_y = block_x + cx, block_y + int(q_in_block * row_h) + cy
-                cv2.rectangle(self.overlay_image, (abs_x, abs_y), (abs_x+cw, abs_y+ch), (0, 255, 0), 2)
-            
-            if marked_answer_index != -1 and not data["is_correct"]:
-                (cx, cy, cw, ch) = data["coords"][marked_answer_index]
-                abs_x, abs_y = block_x + cx, block_y + int(q_in_block * row_h) + cy
-                cv2.rectangle(self.overlay_image, (abs_x, abs_y), (abs_x+cw, abs_y+ch), (0, 0, 255), 2)
\ No newline at end of file
+        self.overlay_image = audit.render_overlay(self.warped_image, self.processed_data, self.template)
@@ -0,0 +1,107 @@
+import os
+import numpy as np
+from .scoring import SheetReadout
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+ENTRY_SUFFIX = ".npz"
+
+
+def template_fingerprint(template):
+    """Readouts are only valid for the sheet layouts they were measured with."""
+    return f"{template.name}:{template.reference_image_path}:{template.mtime}"
+
+
+def layouts_fingerprint(templates):
+    return "|".join(template_fingerprint(t) for t in templates)
+
+
+class ReadoutCache:
+    """
+    On-disk cache of sheet readouts keyed by image content hash, so a photo that
+    is uploaded again (even renamed, or graded against another key) skips all
+    image work and is only re-scored. Each entry is one small .npz file holding
+    the fill ratios, bubble boxes, homography and optionally the audit thumbnail.
+    The directory is kept under `max_bytes` by evicting the least recently used
+    entries; a hit refreshes the entry's modification time. Several processes
+    may share a directory: entries are replaced atomically and eviction rescans it.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, fingerprint=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fingerprint = fingerprint or ""
+        os.makedirs(directory, exist_ok=True)
+        self._sizes = {}
+        for name in os.listdir(directory):
+            if name.endswith(ENTRY_SUFFIX):
+                self._sizes[name] = os.path.getsize(os.path.join(directory, name))
+        self.total_bytes = sum(self._sizes.values())
+        self.hits = self.misses = 0
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest + ENTRY_SUFFIX)
+
+    def get(self, digest, need_thumbnail=False):
+        """Returns (readout, thumbnail bytes or None), or None on a miss."""
+        path = self._path(digest)
+        try:
+            with np.load(path) as entry:
+                if str(entry["fingerprint"]) != self.fingerprint:
+                    raise ValueError("stale entry")
+                thumbnail = entry["thumbnail"].tobytes() if entry["thumbnail"].size else None
+                if need_thumbnail and thumbnail is None:
+                    raise ValueError("no thumbnail")
+                homography = entry["homography"] if entry["homography"].size else None
+                readout = SheetReadout(entry["fill_ratios"], entry["coords"], entry["block_origins"],
+                                       str(entry["layout"]) or None, str(entry["alignment"]) or None, homography,
+                                       int(entry["rechecked"]))
+        except (OSError, KeyError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(path)
+        self.hits += 1
+        return readout, thumbnail
+
+    def put(self, digest, readout, thumbnail=None):
+        path = self._path(digest)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, fill_ratios=readout.fill_ratios, coords=readout.coords,
+                     block_origins=readout.block_origins, layout=np.str_(readout.layout or ""),
+                     alignment=np.str_(readout.alignment or ""),
+                     homography=np.empty(0) if readout.homography is None else np.asarray(readout.homography),
+                     rechecked=np.int32(readout.rechecked),
+                     thumbnail=np.frombuffer(thumbnail or b"", dtype=np.uint8),
+                     fingerprint=np.str_(self.fingerprint))
+        # Replaced atomically, so a crash never leaves a half-written entry behind.
+        os.replace(tmp_path, path)
+        name = os.path.basename(path)
+        self.total_bytes += os.path.getsize(path) - self._sizes.get(name, 0)
+        self._sizes[name] = os.path.getsize(path)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Deletes least recently used entries until the cache fits in 90% of max_bytes.
+        The directory is rescanned, so entries written by other processes count too.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, name, stat.st_size))
+        self._sizes = {name: size for _, name, size in entries}
+        self.total_bytes = sum(self._sizes.values())
+        for _, name, size in sorted(entries):
+            if self.total_bytes <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            self.total_bytes -= self._sizes.pop(name)
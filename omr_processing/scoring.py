@@ -0,0 +1,171 @@
+import numpy as np
+from dataclasses import dataclass
+from typing import Optional
+from .answer_key import OPTION_LETTERS
+
+BUBBLE_THRESHOLD_RATIO = 0.30
+# Marked index for a question whose row of bubbles could not be read.
+UNREADABLE = -2
+# Fill-ratio margin at which a question's reading counts as fully certain.
+CONFIDENCE_MARGIN = 0.15
+# Questions below this confidence get a second pass, and are flagged for review if they stay below it.
+REVIEW_CONFIDENCE = 0.5
+# A sheet warped from the wrong points reads as mostly blank rows, each of them confidently so; past
+# either share of the keyed questions the whole sheet goes to review instead of its unclear rows.
+MAX_BLANK_SHARE = 0.4
+MAX_UNCLEAR_SHARE = 0.1
+
+
+@dataclass(eq=False)
+class SheetReadout:
+    """
+    Everything graded from a sheet that does not depend on the answer key:
+    the fill ratio of every bubble (a NaN row where no bubbles were found), the
+    bubble boxes relative to their question row as drawn by the overlay, each
+    question's block origin, the layout it was read with and how it was aligned.
+    `rechecked` counts the rows that needed a second pass.
+    """
+    fill_ratios: np.ndarray            # (questions, options) float32
+    coords: np.ndarray                 # (questions, options, 4) int32
+    block_origins: np.ndarray          # (questions, 2) int32
+    layout: Optional[str] = None
+    alignment: Optional[str] = None
+    homography: Optional[np.ndarray] = None  # 3x3, full-resolution photo -> warped sheet
+    rechecked: int = 0
+
+
+def marked_options(fill_ratios, threshold=BUBBLE_THRESHOLD_RATIO):
+    """
+    The marked option of every question: the fullest bubble if its fill ratio
+    exceeds `threshold`, -1 when none does and UNREADABLE for NaN rows. Works on
+    a single (questions, options) matrix or a stack of them.
+    """
+    readable = ~np.isnan(fill_ratios).any(axis=-1)
+    fills = np.where(readable[..., None], fill_ratios, 0)
+    best = fills.argmax(axis=-1)
+    best_fill = np.take_along_axis(fills, best[..., None], axis=-1)[..., 0]
+    marked = np.where(best_fill > threshold, best, -1)
+    return np.where(readable, marked, UNREADABLE).astype(np.int8)
+
+
+def question_confidence(fill_ratios, threshold=BUBBLE_THRESHOLD_RATIO):
+    """
+    How clearly every question was read, from 0 to 1: the fill-ratio margin of
+    its reading over CONFIDENCE_MARGIN. A mark needs the fullest bubble above
+    `threshold` and the next one below it, so double marks score 0; a blank row
+    needs every bubble below it. Unreadable (NaN) rows have confidence 0. Works
+    on stacks of sheets too.
+    """
+    readable = ~np.isnan(fill_ratios).any(axis=-1)
+    fills = np.sort(np.where(readable[..., None], fill_ratios, 0), axis=-1)
+    top, second = fills[..., -1], fills[..., -2]
+    margin = np.where(top > threshold, np.minimum(top - threshold, threshold - second), threshold - top)
+    return np.where(readable, np.clip(margin / CONFIDENCE_MARGIN, 0, 1), 0).astype(np.float32)
+
+
+def _fit_key(key_indices, num_questions):
+    """A key's indices cut or padded (with -1) to the layout's number of questions."""
+    key = np.asarray(key_indices)[..., :num_questions]
+    if key.shape[-1] < num_questions:
+        padding = [(0, 0)] * (key.ndim - 1) + [(0, num_questions - key.shape[-1])]
+        key = np.pad(key, padding, constant_values=-1)
+    return key
+
+
+def _is_correct(marked, key):
+    """
+    Whether each marked option is the keyed one. A question the key leaves open
+    (-1) scores for nobody, whatever is marked; grading, rescoring and item
+    analysis all count correct answers this way.
+    """
+    return (marked == key) & (key >= 0)
+
+
+def _subject_totals(is_correct, template):
+    """Sums correctness over consecutive groups of questions_per_subject questions."""
+    padded = np.zeros(is_correct.shape[:-1] + (template.num_subjects * template.questions_per_subject,), dtype=np.int32)
+    padded[..., :is_correct.shape[-1]] = is_correct
+    return padded.reshape(is_correct.shape[:-1] + (template.num_subjects, template.questions_per_subject)).sum(axis=-1)
+
+
+def tally(marked, key_indices, template):
+    """
+    Compares the marked option index of every question with the key in one
+    vector operation. Returns the per-question correctness, the total score and
+    the subject scores.
+    """
+    is_correct = _is_correct(marked, _fit_key(key_indices, len(marked)))
+    per_subject = _subject_totals(is_correct, template)
+    subject_scores = {f"Subject_{i+1}": int(score) for i, score in enumerate(per_subject)}
+    return is_correct, int(is_correct.sum()), subject_scores
+
+
+def sheet_review_reason(marked, confidence, key):
+    """
+    Why a sheet's reading as a whole should not be trusted, or None: too many of
+    the questions the key answers read as blank or unreadable, or as unclear.
+    """
+    keyed = key >= 0
+    if not keyed.any():
+        return None
+    blank = (marked[keyed] < 0).mean()
+    if blank > MAX_BLANK_SHARE:
+        return f"{blank:.0%} of the questions read as blank or unreadable"
+    unclear = (confidence[keyed] < REVIEW_CONFIDENCE).mean()
+    if unclear > MAX_UNCLEAR_SHARE:
+        return f"{unclear:.0%} of the questions read unclearly"
+    return None
+
+
+def score_readout(readout, answer_key, template, threshold=BUBBLE_THRESHOLD_RATIO):
+    """Grades a readout against an AnswerKey; returns the result dict of OMREvaluator."""
+    marked = marked_options(readout.fill_ratios, threshold)[:template.num_questions]
+    confidence = question_confidence(readout.fill_ratios, threshold)[:template.num_questions]
+    is_correct, total_score, subject_scores = tally(marked, answer_key.indices, template)
+
+    detected_answers = {}
+    for q_idx, marked_answer in enumerate(marked.tolist()):
+        if marked_answer == UNREADABLE:
+            # Rows without four bubbles stay unanswered and are left out of detected_answers.
+            continue
+        q_num = q_idx + 1
+        detected_answers[q_num] = {
+            "marked": OPTION_LETTERS[marked_answer] if marked_answer >= 0 else "None",
+            "correct": answer_key.letter(q_num), "is_correct": bool(is_correct[q_idx]),
+            "coords": [tuple(box) for box in readout.coords[q_idx].tolist()],
+            "block_origin": tuple(readout.block_origins[q_idx].tolist()),
+            "confidence": round(float(confidence[q_idx]), 3),
+        }
+
+    # Questions a person should look at: still uncertain after the second pass, or unreadable;
+    # every keyed question when the sheet as a whole looks misread (e.g. aligned from the wrong points).
+    key = _fit_key(answer_key.indices, len(marked))
+    review_reason = sheet_review_reason(marked, confidence, key)
+    if review_reason:
+        review = (np.flatnonzero(key >= 0) + 1).tolist()
+    else:
+        review = (np.flatnonzero(confidence < REVIEW_CONFIDENCE) + 1).tolist()
+    result = {"total_score": total_score, "subject_scores": subject_scores, "detected_answers": detected_answers,
+              "layout": template.name, "review": review, "rechecked": readout.rechecked}
+    if review_reason:
+        result["review_reason"] = review_reason
+    if readout.alignment is not None:
+        result["alignment"] = readout.alignment
+    if readout.homography is not None:
+        result["homography"] = np.asarray(readout.homography).tolist()
+    return result
+
+
+def rescore(fill_ratios, key_indices, template, threshold=BUBBLE_THRESHOLD_RATIO):
+    """
+    Regrades a stack of sheets of one layout in a single vectorized pass.
+    `fill_ratios` is (sheets, questions, options); `key_indices` is one key's
+    int8 indices, or one row per sheet. Returns the marked options (sheets,
+    questions), the per-question correctness, total scores (sheets,) and subject
+    scores (sheets, subjects).
+    """
+    fill_ratios = np.asarray(fill_ratios)[:, :template.num_questions]
+    marked = marked_options(fill_ratios, threshold)
+    is_correct = _is_correct(marked, _fit_key(key_indices, marked.shape[1]))
+    subject_scores = _subject_totals(is_correct, template)
+    return marked, is_correct, subject_scores.sum(axis=1), subject_scores
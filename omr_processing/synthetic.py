@@ -0,0 +1,128 @@
+import os
+import cv2
+import numpy as np
+from dataclasses import dataclass
+from .template import load_template
+
+TEMPLATE_IMAGE_PATH = os.path.join(os.path.dirname(__file__), "omr_template.png")
+# Blank paper around the answer grid, so the fiducial markers on its corners fit on the page.
+PAGE_MARGIN = 60
+MARKER_SIZE = 18
+
+
+@dataclass
+class SyntheticSheet:
+    image: np.ndarray    # BGR "photo" of the sheet
+    answers: np.ndarray  # marked option index per question, -1 for blank
+    corners: np.ndarray  # where the answer grid's corners landed in the photo (TL, TR, BR, BL)
+
+
+_paper_cache = {}
+
+
+def _paper_background(warped_size):
+    """The template photo with its print smoothed away, keeping its paper tone and lighting."""
+    paper = _paper_cache.get(warped_size)
+    if paper is None:
+        template_image = cv2.imread(TEMPLATE_IMAGE_PATH)
+        if template_image is None:
+            raise ValueError(f"Could not read template image: {TEMPLATE_IMAGE_PATH}")
+        size = (warped_size[0] + 2 * PAGE_MARGIN, warped_size[1] + 2 * PAGE_MARGIN)
+        paper = cv2.resize(template_image, size, interpolation=cv2.INTER_AREA)
+        paper = cv2.medianBlur(paper, 31)
+        paper = cv2.GaussianBlur(paper, (0, 0), 15)
+        _paper_cache[warped_size] = paper
+    return paper.copy()
+
+
+def render_sheet(answers, template=None):
+    """
+    Draws a clean, top-down sheet with the given marks. The bubbles sit where the
+    template's bubble grid expects them, the fiducial markers on the template's
+    marker points and the layout's code cells filled in, offset by PAGE_MARGIN.
+    """
+    template = template or load_template()
+    if template.bubble_grid is None:
+        raise ValueError("The sheet template has no bubble grid to draw from.")
+    page = _paper_background(template.warped_size)
+    ink = (70, 40, 60)
+
+    for q_idx, options in enumerate(template.bubble_grid):
+        for option, (x, y, w, h) in enumerate(options):
+            center = (int(x + w / 2) + PAGE_MARGIN, int(y + h / 2) + PAGE_MARGIN)
+            axes = (max(1, int(w / 2) - 1), max(1, int(h / 2) - 1))
+            cv2.ellipse(page, center, axes, 0, 0, 360, (90, 90, 90), 1, cv2.LINE_AA)
+            if answers[q_idx] == option:
+                cv2.ellipse(page, center, axes, 0, 0, 360, ink, -1, cv2.LINE_AA)
+
+    half = MARKER_SIZE // 2
+    for mx, my in template.marker_points:
+        cx, cy = int(mx) + PAGE_MARGIN, int(my) + PAGE_MARGIN
+        cv2.rectangle(page, (cx - half, cy - half), (cx + half, cy + half), (15, 15, 15), -1)
+    for (x, y, w, h), bit in zip(template.code_cells, template.code):
+        if bit:
+            cv2.rectangle(page, (x + PAGE_MARGIN, y + PAGE_MARGIN), (x + w + PAGE_MARGIN, y + h + PAGE_MARGIN),
+                          (15, 15, 15), -1)
+    return page
+
+
+def photograph(page, rng, photo_size=(1500, 1875), perspective=0.06, blur=1.5, noise=6.0,
+               lighting=0.25, background=(175, 180, 185)):
+    """
+    Simulates a phone photo of a rendered page: random perspective (corner jitter
+    as a fraction of the photo size), Gaussian blur up to `blur` sigma, sensor noise
+    with up to `noise` standard deviation, and a lighting gradient of up to
+    `lighting` relative strength. Returns the photo and where the grid corners went.
+    """
+    out_w, out_h = photo_size
+    page_h, page_w = page.shape[:2]
+    inset = 0.08
+    base = np.float32([[inset * out_w, inset * out_h], [(1 - inset) * out_w, inset * out_h],
+                       [(1 - inset) * out_w, (1 - inset) * out_h], [inset * out_w, (1 - inset) * out_h]])
+    jitter = rng.uniform(-perspective, perspective, size=(4, 2)) * np.float32([out_w, out_h])
+    src = np.float32([[0, 0], [page_w - 1, 0], [page_w - 1, page_h - 1], [0, page_h - 1]])
+    matrix = cv2.getPerspectiveTransform(src, (base + jitter).astype(np.float32))
+    photo = cv2.warpPerspective(page, matrix, (out_w, out_h), flags=cv2.INTER_LINEAR,
+                                borderMode=cv2.BORDER_CONSTANT, borderValue=background)
+
+    if lighting > 0:
+        angle = rng.uniform(0, 2 * np.pi)
+        xs, ys = np.meshgrid(np.linspace(-1, 1, out_w, dtype=np.float32), np.linspace(-1, 1, out_h, dtype=np.float32))
+        gradient = 1.0 + rng.uniform(0, lighting) * (np.cos(angle) * xs + np.sin(angle) * ys) / 2
+        photo = np.clip(photo * gradient[..., None], 0, 255)
+    if noise > 0:
+        photo = photo + rng.normal(0, rng.uniform(0, noise), size=photo.shape)
+    photo = np.clip(photo, 0, 255).astype(np.uint8)
+    sigma = rng.uniform(0, blur)
+    if sigma > 0.3:
+        photo = cv2.GaussianBlur(photo, (0, 0), sigma)
+
+    right, bottom = page_w - PAGE_MARGIN - 1, page_h - PAGE_MARGIN - 1
+    grid_corners = np.float32([[PAGE_MARGIN, PAGE_MARGIN], [right, PAGE_MARGIN], [right, bottom],
+                               [PAGE_MARGIN, bottom]])
+    corners = cv2.perspectiveTransform(grid_corners[None], matrix)[0]
+    return photo, corners
+
+
+def random_answers(rng, num_questions, num_options, blank_rate=0.1):
+    answers = rng.integers(0, num_options, size=num_questions).astype(np.int8)
+    answers[rng.random(num_questions) < blank_rate] = -1
+    return answers
+
+
+def generate_sheet(rng=None, template=None, blank_rate=0.1, **photo_options):
+    """Generates one synthetic sheet with random marks; see photograph() for the distortion options."""
+    rng = rng if rng is not None else np.random.default_rng()
+    template = template or load_template()
+    num_questions, num_options = template.bubble_grid.shape[:2]
+    answers = random_answers(rng, num_questions, num_options, blank_rate)
+    photo, corners = photograph(render_sheet(answers, template), rng, **photo_options)
+    return SyntheticSheet(photo, answers, corners)
+
+
+def generate_sheets(count, seed=0, template=None, **options):
+    """Yields `count` reproducible synthetic sheets."""
+    rng = np.random.default_rng(seed)
+    template = template or load_template()
+    for _ in range(count):
+        yield generate_sheet(rng, template, **options)
@@ -0,0 +1,210 @@
+import os
+import json
+import glob
+import cv2
+import numpy as np
+from dataclasses import dataclass
+from typing import Optional
+from . import utils
+from .answer_key import OPTION_LETTERS
+from .bubble_grid import detect_bubble_grid, sampling_windows
+
+# Every *.json layout in this directory is registered; layouts/examples holds layouts
+# that are only used when asked for by path.
+LAYOUTS_DIR = os.path.join(os.path.dirname(__file__), "layouts")
+DEFAULT_LAYOUT = "standard_100"
+
+_template_cache = {}
+
+
+@dataclass(frozen=True, eq=False)
+class SheetTemplate:
+    """
+    A compiled sheet layout: everything about a sheet that does not depend on the
+    image being graded. It is built once per layout file and shared by
+    evaluators and worker processes.
+    `bubble_grid` holds the (x, y, w, h) box of every bubble in the warped frame,
+    or is None when the layout could not be derived from its reference sheet;
+    scoring then falls back to the contour search. `bubble_coords` and
+    `block_origins` are the same boxes relative to their question row, as results
+    report them, and `windows` the integral-image windows their fill is read from.
+    `code_cells` and `code` optionally identify the layout on a photo: bar-shaped
+    cells that must be dark (1) or blank (0).
+    """
+    name: str
+    num_questions: int
+    num_options: int
+    questions_per_subject: int
+    questions_per_block: int
+    warped_size: tuple
+    calibration_points: np.ndarray
+    marker_points: tuple
+    question_blocks: tuple
+    bubble_grid: Optional[np.ndarray]
+    bubble_coords: Optional[np.ndarray] = None
+    block_origins: Optional[np.ndarray] = None
+    windows: Optional[tuple] = None
+    code_cells: tuple = ()
+    code: tuple = ()
+    layout_path: Optional[str] = None
+    reference_image_path: Optional[str] = None
+    mtime: Optional[tuple] = None
+
+    @property
+    def num_subjects(self):
+        return -(-self.num_questions // self.questions_per_subject)
+
+    @property
+    def warped_width(self):
+        return self.warped_size[0]
+
+    @property
+    def warped_height(self):
+        return self.warped_size[1]
+
+
+def _read_only(array):
+    array.setflags(write=False)
+    return array
+
+
+def _build_bubble_grid(reference_image_path, calibration_points, question_blocks, questions_per_block,
+                       num_options, warped_size):
+    image = cv2.imread(reference_image_path)
+    if image is None:
+        raise ValueError(f"Could not read reference image: {reference_image_path}")
+    warped = utils.apply_perspective_transform(image, calibration_points, *warped_size)
+    gray = cv2.cvtColor(warped, cv2.COLOR_BGR2GRAY)
+    return detect_bubble_grid(gray, question_blocks, questions_per_block, num_options)
+
+
+def _grid_from_spec(bubbles, question_blocks, questions_per_block, num_options):
+    """Bubble boxes laid out on a regular pitch inside every block, as declared in the layout."""
+    dx, dy = bubbles["offset"]
+    px, py = bubbles["pitch"]
+    w, h = bubbles["size"]
+    grid = np.empty((len(question_blocks), questions_per_block, num_options, 4), dtype=np.int32)
+    for block_idx, (x, y, _, _) in enumerate(question_blocks):
+        grid[block_idx, ..., 0] = x + dx + px * np.arange(num_options)[None, :]
+        grid[block_idx, ..., 1] = y + dy + py * np.arange(questions_per_block)[:, None]
+        grid[block_idx, ..., 2] = w
+        grid[block_idx, ..., 3] = h
+    return grid.reshape(-1, num_options, 4)
+
+
+def _row_relative(grid, question_blocks, questions_per_block):
+    """Boxes relative to their question's row, as the contour path reports them, and each row's block origin."""
+    q_idx = np.arange(len(grid))
+    blocks = np.asarray(question_blocks, dtype=np.int32)[q_idx // questions_per_block]
+    row_y = blocks[:, 1] + ((q_idx % questions_per_block) * (blocks[:, 3] / questions_per_block)).astype(np.int32)
+    coords = grid - np.stack([blocks[:, 0], row_y, np.zeros_like(row_y), np.zeros_like(row_y)], axis=1)[:, None, :]
+    return coords.astype(np.int32), blocks[:, :2].copy()
+
+
+def compile_layout(spec, layout_path=None, mtime=None):
+    """
+    Builds a SheetTemplate from a layout specification (the parsed JSON). The
+    bubble grid comes from the "bubbles" pitch if given, otherwise it is detected
+    on the "reference_image" sheet (a path relative to the layout file).
+    """
+    missing = [field for field in ("name", "questions", "options", "questions_per_block", "warped_size",
+                                   "calibration_points", "question_blocks") if field not in spec]
+    if missing:
+        raise ValueError(f"Layout {layout_path or spec.get('name')} is missing: {', '.join(missing)}")
+
+    num_questions, num_options = int(spec["questions"]), int(spec["options"])
+    questions_per_block = int(spec["questions_per_block"])
+    questions_per_subject = int(spec.get("questions_per_subject", questions_per_block))
+    warped_size = tuple(int(v) for v in spec["warped_size"])
+    question_blocks = tuple(tuple(int(v) for v in block) for block in spec["question_blocks"])
+    if not 2 <= num_options <= len(OPTION_LETTERS):
+        raise ValueError(f"Layout {spec['name']}: between 2 and {len(OPTION_LETTERS)} options are supported.")
+    if len(question_blocks) * questions_per_block < num_questions:
+        raise ValueError(f"Layout {spec['name']}: {len(question_blocks)} blocks of {questions_per_block} "
+                         f"cannot hold {num_questions} questions.")
+    calibration_points = _read_only(np.array(spec["calibration_points"], dtype=np.int32).reshape(4, 2))
+    width, height = warped_size
+    marker_points = tuple(tuple(p) for p in spec.get(
+        "marker_points", ((0, 0), (width - 1, 0), (width - 1, height - 1), (0, height - 1))))
+    code_cells = tuple(tuple(int(v) for v in cell) for cell in spec.get("code_cells", ()))
+    code = tuple(int(bit) for bit in spec.get("code", ()))
+    if len(code) != len(code_cells):
+        raise ValueError(f"Layout {spec['name']}: code has {len(code)} bits for {len(code_cells)} code cells.")
+    # A square dark cell would pass for a fiducial marker, so code cells are printed as bars.
+    if any(max(w, h) < 2 * min(w, h) for _, _, w, h in code_cells):
+        raise ValueError(f"Layout {spec['name']}: code cells must be at least twice as long as they are wide.")
+
+    reference_image_path = None
+    if "reference_image" in spec:
+        reference_image_path = os.path.normpath(os.path.join(os.path.dirname(layout_path or "."),
+                                                             spec["reference_image"]))
+    try:
+        if "bubbles" in spec:
+            grid = _grid_from_spec(spec["bubbles"], question_blocks, questions_per_block, num_options)
+        elif reference_image_path:
+            grid = _build_bubble_grid(reference_image_path, calibration_points, question_blocks,
+                                      questions_per_block, num_options, warped_size)
+        else:
+            raise ValueError("no bubbles pitch or reference_image given")
+    except ValueError as e:
+        print(f"Bubble grid unavailable for layout {spec['name']}, falling back to contour scoring: {e}")
+        grid = None
+
+    coords = origins = windows = None
+    if grid is not None:
+        grid = _read_only(grid[:num_questions])
+        coords, origins = (_read_only(a) for a in _row_relative(grid, question_blocks, questions_per_block))
+        windows = tuple(_read_only(a) for a in sampling_windows(grid, warped_size))
+
+    return SheetTemplate(spec["name"], num_questions, num_options, questions_per_subject, questions_per_block,
+                         warped_size, calibration_points, marker_points, question_blocks, grid, coords, origins,
+                         windows, code_cells, code, layout_path, reference_image_path, mtime)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def layout_path(layout):
+    """Accepts a registered layout name or a path to a layout file."""
+    if layout.endswith(".json") or os.sep in layout:
+        return os.path.abspath(layout)
+    return os.path.join(LAYOUTS_DIR, layout + ".json")
+
+
+def load_template(layout=DEFAULT_LAYOUT):
+    """
+    Returns the compiled template of a layout (a registered name or a file path),
+    recompiling only when the layout file or its reference image changes.
+    """
+    path = layout_path(layout)
+    if not os.path.exists(path):
+        # Results name their layout; one loaded from a file outside the registry is found by name.
+        loaded = next((t for t in _template_cache.values() if t.name == layout), None)
+        if loaded is not None:
+            return loaded
+    cached = _template_cache.get(path)
+    if cached is not None and cached.mtime == (_mtime(path), _mtime(cached.reference_image_path or "")):
+        return cached
+
+    with open(path, "r") as f:
+        spec = json.load(f)
+    reference = spec.get("reference_image")
+    reference_path = os.path.normpath(os.path.join(os.path.dirname(path), reference)) if reference else ""
+    template = compile_layout(spec, path, (_mtime(path), _mtime(reference_path)))
+    _template_cache[path] = template
+    return template
+
+
+def available_layouts(directory=LAYOUTS_DIR):
+    """Names of the registered layouts, the default first."""
+    names = sorted(os.path.splitext(os.path.basename(p))[0] for p in glob.glob(os.path.join(directory, "*.json")))
+    return sorted(names, key=lambda name: name != DEFAULT_LAYOUT)
+
+
+def load_layouts(layouts=None):
+    """Compiled templates for the given layout names or paths; all registered layouts by default."""
+    return [load_template(layout) for layout in (layouts or available_layouts())]
@@ -0,0 +1,92 @@
+import time
+import numpy as np
+
+PERCENTILES = (50, 95, 99)
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed_ms = (time.perf_counter() - self.start) * 1000.0
+        self.timer.timings[self.name] = self.timer.timings.get(self.name, 0.0) + elapsed_ms
+        return False
+
+
+class StageTimer:
+    """
+    Records wall-clock milliseconds per named pipeline stage:
+
+        with timer.stage("warp"):
+            ...
+
+    When disabled, stage() hands back one shared no-op context manager, so the
+    instrumentation can stay in the hot path for free.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.timings = {}
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def add(self, name, elapsed_ms):
+        if self.enabled:
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed_ms
+
+
+def summarize_timings(timing_dicts):
+    """
+    Aggregates per-sheet stage timings (dicts of stage -> ms) into a report of
+    count, mean, p50, p95, p99, max and total milliseconds per stage, with
+    stages ordered by the time they take overall.
+    """
+    samples = {}
+    for timings in timing_dicts:
+        for stage, elapsed_ms in (timings or {}).items():
+            samples.setdefault(stage, []).append(elapsed_ms)
+
+    report = {}
+    for stage, values in samples.items():
+        values = np.asarray(values, dtype=np.float64)
+        p50, p95, p99 = np.percentile(values, PERCENTILES)
+        report[stage] = {
+            "count": int(values.size),
+            "mean_ms": float(values.mean()),
+            "p50_ms": float(p50),
+            "p95_ms": float(p95),
+            "p99_ms": float(p99),
+            "max_ms": float(values.max()),
+            "total_ms": float(values.sum()),
+        }
+    return dict(sorted(report.items(), key=lambda item: item[1]["total_ms"], reverse=True))
+
+
+def format_timing_report(report):
+    lines = [f"{'stage':<16}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'total s':>10}"]
+    for stage, stats in report.items():
+        lines.append(f"{stage:<16}{stats['count']:>7}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}"
+                     f"{stats['p99_ms']:>10.2f}{stats['total_ms'] / 1000.0:>10.2f}")
+    return "\n".join(lines)
@@ -1,6 +1,107 @@
+import os
+import struct
 import cv2
 import numpy as np
 
+# Reduced JPEG decodes (libjpeg scales while decoding, so it is much cheaper than a full decode).
+REDUCED_DECODE_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+# The decoded image must keep this much resolution relative to the warp output, so the
+# sheet is never upsampled by the warp and grading matches a full decode.
+REDUCED_DECODE_MARGIN = 1.5
+# JPEG start-of-frame markers carry the image size; SOF4, SOF8 and SOF12 are other segments.
+_JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+_HEADER_BYTES = 256 * 1024
+
+def load_image(source):
+    """
+    Returns a BGR image from a file path, from encoded image bytes (decoded in
+    memory, never written to disk), or from an already decoded ndarray.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        image = cv2.imread(os.fspath(source))
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        image = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_COLOR)
+    elif isinstance(source, np.ndarray):
+        if source.ndim == 1:
+            image = cv2.imdecode(source, cv2.IMREAD_COLOR)
+        elif source.ndim == 2:
+            image = cv2.cvtColor(source, cv2.COLOR_GRAY2BGR)
+        else:
+            image = source
+    else:
+        raise TypeError(f"Unsupported image source: {type(source).__name__}")
+    return image
+
+def read_image_size(data):
+    """
+    Returns (format, width, height) from the header of encoded JPEG or PNG bytes
+    without decoding them, or None when the header is not recognised.
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        width, height = struct.unpack(">II", data[16:24])
+        return "png", width, height
+    if data[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        segment_length = struct.unpack(">H", data[i + 2:i + 4])[0]
+        if marker in _JPEG_SOF_MARKERS and i + 9 <= len(data):
+            height, width = struct.unpack(">HH", data[i + 5:i + 9])
+            return "jpeg", width, height
+        i += 2 + segment_length
+    return None
+
+def choose_reduction(width, height, target_width, target_height, margin=REDUCED_DECODE_MARGIN):
+    """Largest JPEG reduction factor (1, 2, 4 or 8) that keeps at least `margin` times the target resolution."""
+    needed_long = max(target_width, target_height) * margin
+    needed_short = min(target_width, target_height) * margin
+    long_side, short_side = max(width, height), min(width, height)
+    for factor in (8, 4, 2):
+        if long_side / factor >= needed_long and short_side / factor >= needed_short:
+            return factor
+    return 1
+
+def load_image_for_warp(source, target_width=800, target_height=1000):
+    """
+    Like load_image, but decodes large JPEGs at 1/2, 1/4 or 1/8 resolution when
+    that still leaves more pixels than the warp to target_width x target_height
+    needs. Returns (image, scale), where scale is decoded size / original size,
+    so coordinates measured on the full-resolution photo can be rescaled.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(os.fspath(source), "rb") as f:
+            header = f.read(_HEADER_BYTES)
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        header = bytes(source[:_HEADER_BYTES])
+    else:
+        return load_image(source), 1.0
+
+    info = read_image_size(header)
+    factor = 1
+    if info is not None and info[0] == "jpeg":
+        factor = choose_reduction(info[1], info[2], target_width, target_height)
+    if factor == 1:
+        return load_image(source), 1.0
+
+    if isinstance(source, (str, os.PathLike)):
+        image = cv2.imread(os.fspath(source), REDUCED_DECODE_FLAGS[factor])
+    else:
+        image = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), REDUCED_DECODE_FLAGS[factor])
+    if image is None:
+        return None, 1.0
+    # Measured rather than 1/factor: libjpeg rounds odd sizes up, and EXIF rotation may swap the axes.
+    scale = max(image.shape[:2]) / float(max(info[1], info[2]))
+    return image, scale
+
 def preprocess_image(image_path):
     image = cv2.imread(image_path)
     if image is None:
@@ -31,12 +132,14 @@ def find_fiducial_markers(gray_image):
             (x, y, w, h) = cv2.boundingRect(approx)
             aspect_ratio = w / float(h)
             
-            # Filter by aspect ratio and a reasonable area to find squares
-            if 0.9 <= aspect_ratio <= 1.1 and cv2.contourArea(c) > 100:
+            # Filter by aspect ratio and a reasonable area to find squares.
+            # The range is loose because perspective squashes squares on angled photos.
+            if 0.75 <= aspect_ratio <= 1.33 and cv2.contourArea(c) > 100:
                 marker_contours.append(approx)
 
-    # We expect exactly 4 markers
-    if len(marker_contours) == 4:
+    # We expect 4 markers; if stray square-ish marks also pass, the markers are the largest
+    if len(marker_contours) >= 4:
+        marker_contours = sorted(marker_contours, key=cv2.contourArea, reverse=True)[:4]
         # Sort contours by their y-coordinate
         marker_contours = sorted(marker_contours, key=lambda c: cv2.boundingRect(c)[1])
         
@@ -49,7 +152,7 @@ def find_fiducial_markers(gray_image):
         
     return None
 
-def apply_perspective_transform(image, pts, width=800, height=1000):
+def get_perspective_matrix(pts, width=800, height=1000):
     rect = pts.reshape(4, 2).astype("float32")
     
     # The destination points for the transform
@@ -59,8 +162,11 @@ def apply_perspective_transform(image, pts, width=800, height=1000):
         [width - 1, height - 1],
         [0, height - 1]], dtype="float32")
 
+    return cv2.getPerspectiveTransform(rect, dst)
+
+def apply_perspective_transform(image, pts, width=800, height=1000):
     # Compute the perspective transform matrix and apply it
-    M = cv2.getPerspectiveTransform(rect, dst)
+    M = get_perspective_matrix(pts, width, height)
     warped = cv2.warpPerspective(image, M, (width, height))
     return warped
 
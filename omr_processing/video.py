@@ -0,0 +1,138 @@
+import os
+import time
+import cv2
+import numpy as np
+from . import utils
+from .alignment import downscale_gray, plausible_markers, DETECTION_MAX_DIMENSION
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".m4v", ".avi", ".mkv", ".webm")
+# The area inside the markers is warped to VIEW_SIZE to measure sharpness, and
+# shrunk to THUMBNAIL_SIZE to tell sheets apart.
+VIEW_SIZE = (160, 200)
+THUMBNAIL_SIZE = (40, 50)
+# Mean absolute difference (0-255) between two thumbnails above which they show different sheets.
+SHEET_CHANGE_LEVEL = 6.0
+# Sharpness below which the view holds no print (a sheet mid-flip, or stray marks taken for markers).
+MIN_SHARPNESS = 20.0
+# Checked frames without a sheet tolerated inside one sheet, and checked frames a sheet needs to count.
+MAX_GAP = 3
+MIN_FRAMES = 3
+FRAME_JPEG_QUALITY = 95
+
+
+def is_video_name(name):
+    return os.path.basename(name).lower().endswith(VIDEO_EXTENSIONS)
+
+
+def _sheet_view(small_gray, markers):
+    """The sheet inside the markers, warped upright to VIEW_SIZE; it looks the same however the camera moved."""
+    centers = markers.reshape(4, -1, 2).mean(axis=1).astype(np.float32)
+    w, h = VIEW_SIZE
+    dst = np.float32([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]])
+    return cv2.warpPerspective(small_gray, cv2.getPerspectiveTransform(centers, dst), VIEW_SIZE)
+
+
+def sharpness(gray):
+    """Variance of the Laplacian: high for crisp print, low for motion blur or defocus."""
+    return float(cv2.Laplacian(gray, cv2.CV_32F).var())
+
+
+def _thumbnail(view):
+    thumbnail = cv2.resize(view, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+    # Brightness changes (a hand's shadow) shift the whole thumbnail; only the pattern is compared.
+    return thumbnail - thumbnail.mean()
+
+
+def _same_sheet(a, b):
+    return float(np.abs(a - b).mean()) <= SHEET_CHANGE_LEVEL
+
+
+def iter_video_sheets(video_path, stride=2, stats=None, name=None):
+    """
+    Yields `(name, JPEG bytes)` for the sharpest frame of every sheet in a video
+    of sheets being flipped in front of the camera. Every `stride`-th frame is
+    checked on a downscaled copy: frames without all four fiducial markers, or
+    too blurred to show print between them, are skipped, and consecutive frames
+    with markers form one sheet until the view inside the markers changes or no
+    sheet is seen for more than MAX_GAP checks. A sheet that reappears right after being hidden (a hand over a
+    marker) continues its run. Only one full-size frame per sheet is kept.
+    Skipped frames are grabbed without being converted, which keeps the scan
+    faster than real time. With `stats` (a dict), the frames read and checked,
+    sheets found, video and scan seconds are filled in. The sheets are named
+    after `name` (default: the video's file name).
+    """
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video: {video_path}")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    base = os.path.splitext(os.path.basename(name or video_path))[0]
+    stats = stats if stats is not None else {}
+    stats.update(frames=0, checked=0, sheets=0)
+    start = time.perf_counter()
+
+    def _encode(sheet):
+        stats["sheets"] += 1
+        ok, encoded = cv2.imencode(".jpg", sheet["frame"], [cv2.IMWRITE_JPEG_QUALITY, FRAME_JPEG_QUALITY])
+        if not ok:
+            raise ValueError(f"Could not encode frame {sheet['index']} of {video_path}")
+        return f"{base}_sheet{stats['sheets']:04d}_frame{sheet['index']:06d}.jpg", encoded.tobytes()
+
+    # `current` is the sheet in view; `ended` the last one whose markers were lost, held back
+    # until the next sheet shows it is not the same one again.
+    current = ended = None
+    gap = 0
+    try:
+        while True:
+            index = stats["frames"]
+            if index % stride:
+                if not capture.grab():
+                    break
+                stats["frames"] += 1
+                continue
+            ok, frame = capture.read()
+            if not ok:
+                break
+            stats["frames"] += 1
+            stats["checked"] += 1
+
+            small_gray, _ = downscale_gray(frame, DETECTION_MAX_DIMENSION)
+            markers = utils.find_fiducial_markers(small_gray)
+            if markers is not None and not plausible_markers(markers.reshape(4, -1, 2).mean(axis=1), small_gray.shape):
+                markers = None
+            view = None if markers is None else _sheet_view(small_gray, markers)
+            score = 0.0 if view is None else sharpness(view)
+            if score < MIN_SHARPNESS:
+                gap += 1
+                if current is not None and gap > MAX_GAP:
+                    if ended is not None and ended["frames"] >= MIN_FRAMES:
+                        yield _encode(ended)
+                    current, ended = None, current
+                continue
+            gap = 0
+
+            thumbnail = _thumbnail(view)
+            if current is None and ended is not None and _same_sheet(thumbnail, ended["thumbnail"]):
+                current, ended = ended, None
+            elif current is not None and not _same_sheet(thumbnail, current["thumbnail"]):
+                if ended is not None and ended["frames"] >= MIN_FRAMES:
+                    yield _encode(ended)
+                current, ended = None, current
+            if current is None:
+                if ended is not None:
+                    if ended["frames"] >= MIN_FRAMES:
+                        yield _encode(ended)
+                    ended = None
+                current = {"frames": 0, "score": -1.0}
+
+            current["frames"] += 1
+            current["thumbnail"] = thumbnail
+            if score > current["score"]:
+                current.update(score=score, frame=frame, index=index)
+
+        for sheet in (ended, current):
+            if sheet is not None and sheet["frames"] >= MIN_FRAMES:
+                yield _encode(sheet)
+    finally:
+        capture.release()
+        stats["video_seconds"] = stats["frames"] / fps
+        stats["seconds"] = time.perf_counter() - start
@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import platform
+import resource
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from omr_processing.answer_key import OPTION_LETTERS
+from omr_processing.batch import evaluate_batch, default_workers
+from omr_processing.synthetic import generate_sheets
+from omr_processing.template import load_template
+from omr_processing.timing import summarize_timings
+
+DEFAULT_KEY = os.path.join(os.path.dirname(__file__), "..", "web_app", "answer_keys", "set_a.json")
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS; it is the peak so far, not the current size.
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / divisor
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / divisor
+    return own, children
+
+
+def marked_indices(result, num_questions):
+    marked = np.full(num_questions, -1, dtype=np.int8)
+    for q_num, data in result["detected_answers"].items():
+        if data["marked"] != "None":
+            marked[int(q_num) - 1] = OPTION_LETTERS.index(data["marked"])
+    return marked
+
+
+def build_pool(count, seed, photo_size, jpeg_quality, layouts=None, lighting=0.25):
+    """
+    Pre-renders distinct sheets as JPEG bytes; larger batches cycle through them.
+    With several layouts the pool is split between them and interleaved.
+    """
+    templates = [load_template(layout) for layout in layouts] if layouts else [None]
+    per_layout = []
+    for i, template in enumerate(templates):
+        count_i = len(range(i, count, len(templates)))
+        per_layout.append(list(generate_sheets(count_i, seed=seed + i, template=template, photo_size=photo_size,
+                                                   lighting=lighting)))
+    pool = []
+    for sheets in itertools.zip_longest(*per_layout):
+        for sheet in filter(None, sheets):
+            ok, encoded = cv2.imencode(".jpg", sheet.image, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+            pool.append((encoded.tobytes(), sheet.answers))
+    return pool
+
+
+def run_batch(pool, size, answer_key_path, workers, layouts=None, second_pass=True, max_memory=None):
+    sources = ((f"sheet_{i:06d}", pool[i % len(pool)][0]) for i in range(size))
+    correct_questions = total_questions = exact_sheets = failed = flagged_sheets = 0
+    stage_timings = []
+
+    start = time.perf_counter()
+    for record in evaluate_batch(sources, answer_key_path, workers=workers, total=size, timings=True,
+                                 render_overlay=False, layouts=layouts, second_pass=second_pass,
+                                 max_memory=max_memory):
+        if not record["result"]:
+            failed += 1
+            continue
+        truth = pool[int(record["source"].split("_")[1]) % len(pool)][1]
+        marked = marked_indices(record["result"], len(truth))
+        matches = int((marked == truth).sum())
+        correct_questions += matches
+        total_questions += len(truth)
+        exact_sheets += matches == len(truth)
+        flagged_sheets += bool(record["result"]["review"])
+        stage_timings.append(record["timings"])
+    elapsed = time.perf_counter() - start
+
+    own_rss, worker_rss = peak_rss_mb()
+    return {
+        "batch_size": size,
+        "workers": workers,
+        "seconds": elapsed,
+        "sheets_per_sec": size / elapsed if elapsed > 0 else 0.0,
+        "failed": failed,
+        "question_accuracy": correct_questions / total_questions if total_questions else 0.0,
+        "sheet_accuracy": exact_sheets / (size - failed) if size > failed else 0.0,
+        "review_rate": flagged_sheets / (size - failed) if size > failed else 0.0,
+        "peak_rss_mb": own_rss,
+        "peak_worker_rss_mb": worker_rss,
+        "stages": summarize_timings(stage_timings),
+    }
+
+
+def compare(previous_path, runs):
+    with open(previous_path) as f:
+        previous = {run["batch_size"]: run for run in json.load(f)["runs"]}
+    print(f"\nCompared with {previous_path}:")
+    for run in runs:
+        old = previous.get(run["batch_size"])
+        if not old:
+            continue
+        speedup = run["sheets_per_sec"] / old["sheets_per_sec"] if old["sheets_per_sec"] else float("nan")
+        print(f"  batch {run['batch_size']:>6}: {old['sheets_per_sec']:.2f} -> {run['sheets_per_sec']:.2f} sheets/sec "
+              f"(x{speedup:.2f}), accuracy {old['question_accuracy']:.4f} -> {run['question_accuracy']:.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput, latency, memory and accuracy benchmark on synthetic sheets.")
+    parser.add_argument("--sizes", default="1,10,100,1000", help="Comma-separated batch sizes, e.g. 1,10,100,1000,10000.")
+    parser.add_argument("--workers", type=int, default=default_workers())
+    parser.add_argument("--pool", type=int, default=50, help="Distinct synthetic sheets to render and cycle through.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--photo-size", default="1500x1875", help="Synthetic photo size as WIDTHxHEIGHT.")
+    parser.add_argument("--jpeg-quality", type=int, default=90)
+    parser.add_argument("--key", default=DEFAULT_KEY, help="Answer key used for the grading path.")
+    parser.add_argument("--layouts", help="Comma-separated layout names or files to mix in the pool; "
+                                          "sheets are then routed to their layout.")
+    parser.add_argument("--no-second-pass", action="store_true", help="Skip re-reading unclear questions.")
+    parser.add_argument("--lighting", type=float, default=0.25, help="Strength of the synthetic lighting gradient.")
+    parser.add_argument("--max-memory", type=int, metavar="MB", help="Memory ceiling per grading process.")
+    parser.add_argument("--output", default=f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    parser.add_argument("--compare", help="A previous benchmark JSON to compare against.")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    photo_size = tuple(int(v) for v in args.photo_size.lower().split("x"))
+    layouts = [name.strip() for name in args.layouts.split(",") if name.strip()] if args.layouts else None
+
+    print(f"Rendering {args.pool} synthetic sheets at {photo_size[0]}x{photo_size[1]}...")
+    pool = build_pool(min(args.pool, max(sizes)), args.seed, photo_size, args.jpeg_quality, layouts, args.lighting)
+
+    runs = []
+    for size in sizes:
+        run = run_batch(pool, size, args.key, args.workers, layouts, not args.no_second_pass,
+                        args.max_memory * 2**20 if args.max_memory else None)
+        runs.append(run)
+        total = run["stages"].get("sheet_total", {})
+        print(f"batch {size:>6}: {run['sheets_per_sec']:8.2f} sheets/sec, "
+              f"p50 {total.get('p50_ms', 0):.1f} ms, p95 {total.get('p95_ms', 0):.1f} ms, "
+              f"accuracy {run['question_accuracy']:.4f}, review {run['review_rate']:.3f}, failed {run['failed']}, "
+              f"peak RSS {run['peak_rss_mb']:.0f} MB (workers {run['peak_worker_rss_mb']:.0f} MB)")
+
+    report = {
+        "created": datetime.now().isoformat(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "cpu_count": os.cpu_count(),
+        "config": {"workers": args.workers, "pool": len(pool), "seed": args.seed,
+                   "photo_size": photo_size, "jpeg_quality": args.jpeg_quality, "layouts": layouts,
+                   "second_pass": not args.no_second_pass, "lighting": args.lighting,
+                   "max_memory_mb": args.max_memory},
+        "runs": runs,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        compare(args.compare, runs)
+
+
+if __name__ == "__main__":
+    main()
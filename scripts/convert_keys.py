@@ -1,44 +1,199 @@
-import pandas as pd
-import json
 import os
 import re
+import sys
+import json
+import time
+import argparse
 
-def convert_csv_to_json(csv_path, json_path):
-    df = pd.read_csv(csv_path, header=0)
-    answer_key = {}
+import numpy as np
+import pandas as pd
 
-    for col in df.columns:
-        for item in df[col].dropna():
-            item = str(item).strip()
-            match = re.match(r'(\d+)\s*[-.]?\s*([a-zA-Z])', item)
-            if match:
-                question_num = match.group(1)
-                answer = match.group(2).upper()
-                answer_key[question_num] = answer
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT)
+from omr_processing.answer_key import (OPTION_LETTERS, KEY_BUNDLE_NAME, KEY_NAME_LENGTH,
+                                       load_answer_key, save_key_bundle)
+from omr_processing.template import DEFAULT_LAYOUT, load_template
 
-    sorted_answer_key = {k: v for k, v in sorted(answer_key.items(), key=lambda item: int(item[0]))}
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "source_keys")
+OUTPUT_DIR = os.path.join(ROOT, "web_app", "answer_keys")
+SOURCE_EXTENSIONS = (".csv", ".xlsx", ".xls")
+# A question number, an optional separator and one or more option letters: "12 - b", "81. a", "16 - a,b,c,d".
+CELL_PATTERN = r"\d+\s*[-.:)]?\s*[A-Za-z](?:\s*,\s*[A-Za-z])*"
+# Errors of one kind listed per key before the rest are only counted.
+MAX_LISTED = 5
 
-    with open(json_path, 'w') as f:
-        json.dump(sorted_answer_key, f, indent=4)
-    print(f"Successfully converted {csv_path} to {json_path}")
 
-if __name__ == "__main__":
-    base_dir = os.path.dirname(__file__)
-    source_dir = os.path.join(base_dir, "source_keys")
-    output_dir = os.path.join(base_dir, "..", "web_app", "answer_keys")
+def key_name(label):
+    """
+    The key's file name for a sheet: "Key (Set A and B).xlsx - Set - A.csv" (a
+    spreadsheet tab exported to CSV) or a workbook tab named "Set - A" give set_a.
+    """
+    label = re.split(r"\.xlsx?\s*-\s*", os.path.splitext(os.path.basename(label))[0])[-1]
+    return re.sub(r"[^a-z0-9]+", "_", label.lower()).strip("_")
+
+
+def read_sources(path):
+    """Yields (key name, raw cells DataFrame) for a CSV file or for every tab of a workbook."""
+    if path.lower().endswith(".csv"):
+        yield key_name(path), pd.read_csv(path, header=None, dtype=str, skip_blank_lines=True)
+    else:
+        # Reading workbooks needs openpyxl (or xlrd for .xls).
+        for sheet_name, frame in pd.read_excel(path, sheet_name=None, header=None, dtype=str).items():
+            yield key_name(sheet_name), frame
+
+
+def _listed(values):
+    values = list(values)
+    shown = ", ".join(str(v) for v in values[:MAX_LISTED])
+    return shown + (f" and {len(values) - MAX_LISTED} more" if len(values) > MAX_LISTED else "")
+
+
+def parse_key(frame, num_questions, num_options):
+    """
+    Parses every cell of a key sheet at once with pandas string operations.
+    Returns (indices, errors, warnings): the option index of every question
+    (int8, -1 where missing) and lists of messages. Cells without a digit
+    (subject headers) are ignored; any other cell that does not read as
+    "<question> <option>" is an error, as are questions outside
+    1..num_questions, options past the layout's last one, questions keyed
+    twice with different answers and questions not keyed at all.
+    """
+    cells = pd.Series(frame.to_numpy().ravel()).dropna().astype(str).str.strip()
+    cells = cells[cells.str.contains(r"\d")]
+    errors, warnings = [], []
+
+    # Matching and replacing run natively on Arrow-backed strings; str.extract would loop in Python.
+    readable = cells.str.fullmatch(CELL_PATTERN).to_numpy(dtype=bool)
+    if not readable.all():
+        errors.append(f"unreadable cells: {_listed(repr(c) for c in cells[~readable])}")
+    cells = cells[readable]
+    questions = cells.str.replace(r"\D.*", "", regex=True).astype(int).to_numpy()
+    letters = cells.str.replace(r"^\d+\s*[-.:)]?|[\s,]", "", regex=True).str.upper()
+    options = letters.str[0].map({letter: i for i, letter in enumerate(OPTION_LETTERS[:num_options])})
+
+    in_range = (questions >= 1) & (questions <= num_questions)
+    if not in_range.all():
+        errors.append(f"questions outside 1-{num_questions}: {_listed(np.unique(questions[~in_range]))}")
+    valid_option = options.notna().to_numpy()
+    if not valid_option.all():
+        errors.append(f"options other than {OPTION_LETTERS[0]}-{OPTION_LETTERS[num_options - 1]}: "
+                      f"{_listed(f'Q{q} {letter}' for q, letter in zip(questions[~valid_option], letters[~valid_option]))}")
+    keep = in_range & valid_option
+    questions, options, letters = questions[keep], options.to_numpy()[keep].astype(np.int8), letters[keep]
 
-    os.makedirs(output_dir, exist_ok=True)
+    answers = pd.DataFrame({"question": questions, "option": options})
+    conflicting = answers.groupby("question")["option"].nunique()
+    conflicting = conflicting.index[conflicting > 1]
+    if len(conflicting):
+        errors.append(f"questions keyed with different answers: {_listed(f'Q{q}' for q in conflicting)}")
+    missing = np.setdiff1d(np.arange(1, num_questions + 1), questions)
+    if len(missing):
+        errors.append(f"{len(missing)} questions missing: {_listed(f'Q{q}' for q in missing)}")
 
-    files_to_convert = {
-        "Key (Set A and B).xlsx - Set - A.csv": "set_a.json",
-        "Key (Set A and B).xlsx - Set - B.csv": "set_b.json",
-    }
+    # An answer key holds one correct option per question; cells listing several keep the first.
+    several = (letters.str.len() > 1).to_numpy()
+    if several.any():
+        warnings.append("several answers listed, only the first is keyed: "
+                        + _listed(f"Q{q} {letter}" for q, letter in zip(questions[several], letters[several])))
 
-    for csv_file, json_file in files_to_convert.items():
-        csv_input_path = os.path.join(source_dir, csv_file)
-        json_output_path = os.path.join(output_dir, json_file)
+    indices = np.full(num_questions, -1, dtype=np.int8)
+    indices[questions - 1] = options
+    return indices, errors, warnings
 
-        if os.path.exists(csv_input_path):
-            convert_csv_to_json(csv_input_path, json_output_path)
-        else:
-            print(f"Warning: Source file not found at {csv_input_path}")
\ No newline at end of file
+
+def write_json_key(path, indices):
+    answers = {str(q + 1): OPTION_LETTERS[i] for q, i in enumerate(indices.tolist()) if i >= 0}
+    with open(path, 'w') as f:
+        json.dump(answers, f, indent=4)
+
+
+def write_bundle(output_dir, num_questions, num_options):
+    """
+    Bundles every JSON key in `output_dir`, including ones not compiled by this
+    run. Returns the bundle's path, the number of keys bundled and the number of
+    keys left out because they do not fit the layout.
+    """
+    keys, rejected = {}, 0
+    for f in sorted(os.listdir(output_dir)):
+        name = os.path.splitext(f)[0]
+        if not f.endswith(".json"):
+            continue
+        if len(name) > KEY_NAME_LENGTH:
+            print(f"Warning: key name {name!r} is longer than {KEY_NAME_LENGTH} characters; left out of the bundle.")
+            continue
+        try:
+            key = load_answer_key(os.path.join(output_dir, f), num_questions, num_options)
+        except (OSError, ValueError) as e:
+            print(f"Error: could not bundle {f}: {e}", file=sys.stderr)
+            rejected += 1
+            continue
+        keys[name] = key
+    path = os.path.join(output_dir, KEY_BUNDLE_NAME)
+    save_key_bundle(path, keys)
+    return path, len(keys), rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile answer key sheets (CSV, or every tab of an XLSX workbook) "
+                                                 "into validated JSON keys and a memory-mapped key bundle.")
+    parser.add_argument("sources", nargs="*",
+                        help=f"Key sheets to compile (default: every CSV/XLSX file in {SOURCE_DIR}).")
+    parser.add_argument("-o", "--output-dir", default=OUTPUT_DIR, help="Where the keys are written (default: %(default)s).")
+    parser.add_argument("--layout", default=DEFAULT_LAYOUT,
+                        help="Sheet layout whose question and option counts the keys must match (default: %(default)s).")
+    parser.add_argument("--check", action="store_true", help="Only validate the sheets; write nothing.")
+    args = parser.parse_args()
+
+    sources = args.sources or sorted(os.path.join(SOURCE_DIR, f) for f in os.listdir(SOURCE_DIR)
+                                     if f.lower().endswith(SOURCE_EXTENSIONS))
+    if not sources:
+        print(f"No key sheets found in {SOURCE_DIR}", file=sys.stderr)
+        return 2
+    template = load_template(args.layout)
+    start = time.perf_counter()
+
+    compiled, invalid = {}, 0
+    for source in sources:
+        try:
+            sheets = list(read_sources(source))
+        except (OSError, ValueError, ImportError) as e:
+            print(f"Error: could not read {source}: {e}", file=sys.stderr)
+            invalid += 1
+            continue
+        for name, frame in sheets:
+            indices, errors, warnings = parse_key(frame, template.num_questions, template.num_options)
+            if name in compiled:
+                errors.append(f"a key named {name} was already read from {compiled[name][0]}")
+            for warning in warnings:
+                print(f"Warning: {name} ({source}): {warning}")
+            if errors:
+                invalid += 1
+                for error in errors:
+                    print(f"Error: {name} ({source}): {error}", file=sys.stderr)
+                continue
+            compiled[name] = (source, indices)
+    elapsed = time.perf_counter() - start
+
+    if args.check:
+        print(f"{len(compiled)} valid and {invalid} invalid keys for {template.name} ({elapsed * 1000:.1f} ms).")
+        return 1 if invalid else 0
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for name, (source, indices) in compiled.items():
+        json_path = os.path.join(args.output_dir, f"{name}.json")
+        write_json_key(json_path, indices)
+        print(f"Successfully converted {source} to {json_path}")
+    rejected = 0
+    if compiled:
+        bundle_path, bundled, rejected = write_bundle(args.output_dir, template.num_questions, template.num_options)
+        print(f"{bundled} keys bundled in {bundle_path}")
+    if invalid:
+        print(f"{invalid} keys were not written; fix the sheets above and run again.", file=sys.stderr)
+    if rejected:
+        print(f"{rejected} keys in {args.output_dir} do not fit {template.name} and were left out of the bundle.",
+              file=sys.stderr)
+    return 1 if invalid or rejected else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
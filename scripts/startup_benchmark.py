@@ -0,0 +1,149 @@
+import os
+import sys
+import json
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import cv2
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(ROOT)
+from omr_processing.jobs import JobQueue
+from omr_processing.synthetic import generate_sheets
+
+DEFAULT_KEY = os.path.join(ROOT, "web_app", "answer_keys", "set_a.json")
+APP_PATH = os.path.join(ROOT, "web_app", "app.py")
+# Modules a grading process should never need to load.
+HEAVY_MODULES = ("pandas", "streamlit", "pyarrow", "matplotlib", "scipy")
+
+# Each probe runs in a fresh interpreter and prints one JSON line of milliseconds.
+IMPORT_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+print(json.dumps({{"import_ms": (time.perf_counter() - start) * 1000,
+                  "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+FIRST_SHEET_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+from omr_processing.processor import OMREvaluator
+imported = time.perf_counter()
+with open({image!r}, "rb") as f:
+    data = f.read()
+OMREvaluator(data, {key!r}).run_evaluation(render_overlay=False)
+first = time.perf_counter()
+OMREvaluator(data, {key!r}).run_evaluation(render_overlay=False)
+second = time.perf_counter()
+print(json.dumps({{"import_ms": (imported - start) * 1000, "first_sheet_ms": (first - imported) * 1000,
+                  "warm_sheet_ms": (second - first) * 1000}}))
+"""
+
+APP_PROBE = """
+import sys, time, json
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file({app!r}, default_timeout=60)
+start = time.perf_counter()
+app.run()
+first = time.perf_counter()
+app.run()
+second = time.perf_counter()
+print(json.dumps({{"first_run_ms": (first - start) * 1000, "rerun_ms": (second - first) * 1000,
+                  "heavy": [m for m in {heavy!r} if m in sys.modules and m != "streamlit"]}}))
+"""
+
+
+def run_probe(code):
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True,
+                            env={**os.environ, "PYTHONPATH": ROOT})
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def median_of(samples):
+    """Median of every numeric field over repeated probes; other fields are taken from the last one."""
+    summary = dict(samples[-1])
+    for field, value in samples[-1].items():
+        if isinstance(value, (int, float)):
+            summary[field] = statistics.median(sample[field] for sample in samples)
+    return summary
+
+
+def worker_first_sheet(image_path, answer_key_path):
+    """Wall time from launching `python -m omr_processing worker` to it exiting after grading one queued sheet."""
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "jobs.db")
+        queue = JobQueue(db_path)
+        queue.submit(answer_key_path, [("sheet.jpg", image_path)])
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "omr_processing", "worker", "--db", db_path, "--workers", "1",
+                        "--exit-when-idle"], cwd=ROOT, capture_output=True, check=True)
+        elapsed = (time.perf_counter() - start) * 1000
+        completed = queue.job(1)["completed"]
+        queue.close()
+    return {"worker_ms": elapsed, "graded": completed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start benchmark: imports, first-sheet latency and app start-up, "
+                                                 "each measured in fresh processes.")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh processes per measurement (the median is kept).")
+    parser.add_argument("--key", default=DEFAULT_KEY, help="Answer key used for the grading probes.")
+    parser.add_argument("--no-app", action="store_true", help="Skip the web app probe (needs streamlit).")
+    parser.add_argument("--output", default=f"startup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    parser.add_argument("--compare", help="A previous startup benchmark JSON to compare against.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        image_path = os.path.join(tmp, "sheet.jpg")
+        cv2.imwrite(image_path, next(generate_sheets(1, seed=0)).image)
+
+        probes = {
+            "interpreter": "import json; print(json.dumps({'import_ms': 0.0}))",
+            "import_cli": IMPORT_PROBE.format(module="omr_processing.cli", heavy=HEAVY_MODULES),
+            "import_jobs": IMPORT_PROBE.format(module="omr_processing.jobs", heavy=HEAVY_MODULES),
+            "first_sheet": FIRST_SHEET_PROBE.format(image=image_path, key=args.key),
+        }
+        if not args.no_app:
+            probes["web_app"] = APP_PROBE.format(app=APP_PATH, heavy=HEAVY_MODULES)
+
+        results = {}
+        for name, code in probes.items():
+            start = time.perf_counter()
+            results[name] = median_of([run_probe(code) for _ in range(args.repeat)])
+            results[name]["process_ms"] = (time.perf_counter() - start) * 1000 / args.repeat
+            print(f"{name:>12}: " + ", ".join(f"{k} {v:.1f}" if isinstance(v, float) else f"{k} {v}"
+                                              for k, v in results[name].items()))
+        results["worker"] = median_of([worker_first_sheet(image_path, args.key) for _ in range(args.repeat)])
+        print(f"{'worker':>12}: launch to first sheet graded and exit {results['worker']['worker_ms']:.1f} ms")
+
+    report = {
+        "created": datetime.now().isoformat(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["results"]
+        print(f"\nCompared with {args.compare}:")
+        for name, fields in results.items():
+            for field, value in fields.items():
+                old = previous.get(name, {}).get(field)
+                if field.endswith("_ms") and isinstance(old, (int, float)):
+                    print(f"  {name}.{field}: {old:.1f} -> {value:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
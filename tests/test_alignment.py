@@ -0,0 +1,56 @@
+import os
+import cv2
+import numpy as np
+from omr_processing import alignment, synthetic
+from omr_processing.processor import OMREvaluator
+from omr_processing.template import load_template
+
+SAMPLE_SHEET = os.path.join(os.path.dirname(__file__), "..", "omr_processing", "Img7.jpeg")
+ANSWER_KEY = os.path.join(os.path.dirname(__file__), "..", "web_app", "answer_keys", "set_a.json")
+
+
+def test_filled_bubbles_are_not_taken_for_markers():
+    # Img7 has no fiducial markers; enlarged, its filled bubbles pass the square-contour test.
+    image = cv2.imread(SAMPLE_SHEET)
+    image = cv2.resize(image, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+    alignment.clear_homography_cache()
+    assert alignment.locate_markers(image, use_cache=False) is None
+
+    result, _ = OMREvaluator(image, ANSWER_KEY).run_evaluation(render_overlay=False)
+    assert result["alignment"] == "calibration"
+    # The calibration points are measured at native size, so the enlarged sheet is misread; it must not pass unseen.
+    assert result["review_reason"]
+
+
+def test_markers_on_synthetic_sheets_are_found():
+    template = load_template()
+    for sheet in synthetic.generate_sheets(5, seed=0, template=template):
+        matrix, method = alignment.find_sheet_homography(sheet.image, template.marker_points, use_cache=False)
+        assert method == "markers"
+
+
+def test_marker_quad_checks():
+    shape = (1000, 800)
+    corners = np.float32([[100, 100], [700, 100], [700, 900], [100, 900]])
+    assert alignment.plausible_markers(corners, shape)
+    # Out of order (self-intersecting), huddled together, or the wrong proportions.
+    assert not alignment.plausible_markers(corners[[0, 2, 1, 3]], shape)
+    assert not alignment.plausible_markers(corners / 10, shape)
+    assert alignment.markers_fit_layout(corners, load_template().marker_points)
+    assert not alignment.markers_fit_layout(corners * [3, 1], load_template().marker_points)
+
+
+def test_shifted_sheet_of_the_same_size_is_searched_again():
+    sheet = next(synthetic.generate_sheets(1, seed=4))
+    shifted = cv2.warpAffine(sheet.image, np.float32([[1, 0, 6], [0, 1, 4]]), sheet.image.shape[1::-1],
+                             borderMode=cv2.BORDER_REPLICATE)
+    alignment.clear_homography_cache()
+    first = alignment.locate_markers(sheet.image)
+    second = alignment.locate_markers(shifted)
+    assert second["method"] == "markers"
+    np.testing.assert_allclose(second["centers"] - first["centers"], [[6, 4]] * 4, atol=1.5)
+
+    # A fixed rig opts in, and then the old spots are taken while the markers still cover them.
+    alignment.locate_markers(sheet.image, use_cache=True)
+    assert alignment.locate_markers(shifted, use_cache=True)["method"] == "cached"
+    alignment.clear_homography_cache()
@@ -0,0 +1,17 @@
+import os
+import cv2
+from omr_processing import synthetic
+from omr_processing.batch import evaluate_batch
+
+ANSWER_KEY = os.path.join(os.path.dirname(__file__), "..", "web_app", "answer_keys", "set_a.json")
+
+
+def test_cached_sheets_report_overlay_time_under_overlay(tmp_path):
+    sheet = next(synthetic.generate_sheets(1, seed=0))
+    sources = [("sheet.png", cv2.imencode(".png", sheet.image)[1].tobytes())]
+    for _ in evaluate_batch(sources, ANSWER_KEY, workers=1, cache_dir=str(tmp_path)):
+        pass
+    record, = evaluate_batch(sources, ANSWER_KEY, workers=1, timings=True, cache_dir=str(tmp_path))
+    assert record["cached"]
+    assert set(record["timings"]) == {"score", "overlay", "sheet_total"}
+    assert record["timings"]["overlay"] > record["timings"]["score"]
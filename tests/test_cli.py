@@ -0,0 +1,72 @@
+import os
+import csv
+import signal
+import cv2
+import numpy as np
+import pytest
+from omr_processing import cli, synthetic
+from omr_processing.checkpoint import read_records
+from omr_processing.fill_store import load_fills
+from omr_processing.answer_key import load_answer_key
+from omr_processing.scoring import SheetReadout, score_readout
+from omr_processing.template import load_template
+
+
+@pytest.fixture
+def sheet_dir(tmp_path):
+    directory = tmp_path / "sheets"
+    directory.mkdir()
+    for i, sheet in enumerate(synthetic.generate_sheets(6, seed=3)):
+        cv2.imwrite(str(directory / f"sheet_{i}.jpg"), sheet.image)
+    return directory
+
+
+@pytest.fixture(autouse=True)
+def restore_sigterm():
+    handler = signal.getsignal(signal.SIGTERM)
+    yield
+    signal.signal(signal.SIGTERM, handler)
+
+
+def test_interrupted_grade_keeps_fills_and_resumes(sheet_dir, tmp_path, monkeypatch):
+    checkpoint, store = str(tmp_path / "results.jsonl"), str(tmp_path / "fills")
+    argv = ["grade", str(sheet_dir), "-k", "set_a", "-w", "1", "-c", checkpoint, "--fills", store]
+    evaluate_batch = cli.evaluate_batch
+
+    def interrupted_batch(*args, **kwargs):
+        for completed, record in enumerate(evaluate_batch(*args, **kwargs), start=1):
+            yield record
+            if completed == 4:
+                raise KeyboardInterrupt
+
+    monkeypatch.setattr(cli, "evaluate_batch", interrupted_batch)
+    with pytest.raises(KeyboardInterrupt):
+        cli.main(argv)
+    sheets, _ = load_fills(store)
+    assert len(sheets) == len(list(read_records(checkpoint))) == 4
+
+    monkeypatch.setattr(cli, "evaluate_batch", evaluate_batch)
+    assert cli.main(argv) == 0
+    sheets, fills = load_fills(store)
+    assert len(sheets) == len(fills) == len(os.listdir(sheet_dir))
+    assert {s["hash"] for s in sheets} == {r["hash"] for r in read_records(checkpoint)}
+
+
+def test_rescore_matches_grading_the_stored_fills(sheet_dir, tmp_path):
+    store, output = str(tmp_path / "fills"), str(tmp_path / "rescored.csv")
+    assert cli.main(["grade", str(sheet_dir), "-k", "set_a", "-w", "1", "-c", str(tmp_path / "results.jsonl"),
+                     "--fills", store]) == 0
+    assert cli.main(["rescore", store, "-k", "set_a", "-t", "0.5", "-o", output]) == 0
+
+    template = load_template()
+    key = load_answer_key(cli.resolve_answer_key("set_a"), template.num_questions, template.num_options)
+    sheets, fills = load_fills(store, template.name)
+    with open(output, newline="") as f:
+        rows = {row["hash"]: row for row in csv.DictReader(f)}
+    assert len(rows) == len(sheets)
+    for sheet, sheet_fills in zip(sheets, fills):
+        result = score_readout(SheetReadout(np.asarray(sheet_fills), template.bubble_coords, template.block_origins),
+                               key, template, threshold=0.5)
+        row = rows[sheet["hash"]]
+        assert int(row["total_score"]) == result["total_score"]
+        assert [int(row[f"Subject_{i + 1}"]) for i in range(template.num_subjects)] == list(result["subject_scores"].values())
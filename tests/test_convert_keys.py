@@ -0,0 +1,42 @@
+import os
+import sys
+import json
+import subprocess
+import numpy as np
+from omr_processing.answer_key import KEY_BUNDLE_NAME
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SCRIPT = os.path.join(ROOT, "scripts", "convert_keys.py")
+SET_A = os.path.join(ROOT, "scripts", "source_keys", "Key (Set A and B).xlsx - Set - A.csv")
+
+
+def convert(*args):
+    return subprocess.run([sys.executable, SCRIPT, *args], capture_output=True, text=True)
+
+
+def test_key_missing_a_question_is_not_written(tmp_path):
+    with open(SET_A) as f:
+        text = f.read()
+    source = tmp_path / "Set - A.csv"
+    source.write_text(text.replace("42 - c", ""))
+    output = tmp_path / "keys"
+
+    run = convert(str(source), "-o", str(output))
+    assert run.returncode != 0
+    assert "Q42" in run.stderr
+    assert not output.exists() or not [f for f in os.listdir(output) if f.endswith(".json")]
+
+
+def test_key_with_options_past_the_layout_is_rejected(tmp_path):
+    output = tmp_path / "keys"
+    output.mkdir()
+    answers = {str(q): "A" for q in range(1, 101)}
+    answers["7"] = "E"
+    (output / "hand_made.json").write_text(json.dumps(answers))
+
+    run = convert(SET_A, "-o", str(output))
+    assert run.returncode != 0
+    assert "hand_made.json" in run.stderr
+    assert (output / "set_a.json").exists()
+    bundle = np.load(output / KEY_BUNDLE_NAME)
+    assert list(bundle["name"]) == ["set_a"]
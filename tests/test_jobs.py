@@ -0,0 +1,52 @@
+import os
+import cv2
+import numpy as np
+import pytest
+from omr_processing import synthetic
+from omr_processing.jobs import JobQueue, run_worker
+from omr_processing.video import iter_video_sheets
+
+ANSWER_KEY = os.path.join(os.path.dirname(__file__), "..", "web_app", "answer_keys", "set_a.json")
+
+
+@pytest.fixture
+def video_path(tmp_path):
+    path = str(tmp_path / "stack.mp4")
+    size = (750, 938)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 10, size)
+    if not writer.isOpened():
+        pytest.skip("No MPEG-4 encoder in this OpenCV build.")
+    for sheet in synthetic.generate_sheets(3, seed=1, photo_size=size):
+        for _ in range(8):
+            writer.write(sheet.image)
+        for _ in range(12):
+            writer.write(np.full((size[1], size[0], 3), 180, dtype=np.uint8))
+    writer.release()
+    return path
+
+
+def test_video_job_is_expanded_by_a_worker(video_path, tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs" / "jobs.db"))
+    with open(video_path, "rb") as f:
+        job_id = queue.submit_video(ANSWER_KEY, "stack.mp4", f.read())
+    # Submitting only spools the video; nothing is scanned until a worker claims it.
+    assert queue.job(job_id)["status"] == "submitting"
+
+    run_worker(queue.db_path, exit_when_idle=True)
+    job = queue.job(job_id)
+    expected = [name for name, _ in iter_video_sheets(video_path, name="stack.mp4")]
+    assert expected
+    assert job["status"] == "done" and job["total"] == job["completed"] == len(expected)
+    assert [task["name"] for task in queue.job_tasks(job_id)] == expected
+    assert not [name for name in os.listdir(queue.spool_dir) if name.endswith(".mp4")]
+    queue.close()
+
+
+def test_unreadable_video_fails_its_job(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs" / "jobs.db"))
+    job_id = queue.submit_video(ANSWER_KEY, "broken.mp4", b"not a video")
+    run_worker(queue.db_path, exit_when_idle=True)
+    job = queue.job(job_id)
+    assert job["status"] == "done" and job["failed"] == 1
+    assert queue.job_tasks(job_id)[0]["error"]
+    queue.close()
@@ -0,0 +1,44 @@
+import os
+import cv2
+import numpy as np
+from omr_processing import synthetic
+from omr_processing.bubble_grid import measure_fill_ratios
+from omr_processing.processor import OMREvaluator
+from omr_processing.scoring import UNREADABLE, marked_options
+from omr_processing.template import load_template
+
+ANSWER_KEY = os.path.join(os.path.dirname(__file__), "..", "web_app", "answer_keys", "set_a.json")
+
+
+def _marked(image, scoring_mode):
+    evaluator = OMREvaluator(image, ANSWER_KEY, scoring_mode=scoring_mode, second_pass=False)
+    evaluator.run_evaluation(render_overlay=False)
+    return marked_options(evaluator.readout.fill_ratios)
+
+
+def test_grid_pass_matches_reading_each_bubble():
+    template = load_template()
+    answers = synthetic.random_answers(np.random.default_rng(1), template.num_questions, template.num_options)
+    page = synthetic.render_sheet(answers, template)
+    margin = synthetic.PAGE_MARGIN
+    warped = cv2.cvtColor(page[margin:-margin, margin:-margin], cv2.COLOR_BGR2GRAY)
+
+    thresh = cv2.threshold(warped, 0, 1, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+    expected = np.empty((template.num_questions, template.num_options), dtype=np.float32)
+    for q, o in np.ndindex(expected.shape):
+        x0, y0, x1, y1, area = (int(w[q, o]) for w in template.windows)
+        expected[q, o] = thresh[y0:y1, x0:x1].sum() / area
+
+    fills = measure_fill_ratios(warped, windows=template.windows)
+    np.testing.assert_allclose(fills, expected, atol=1e-6)
+    np.testing.assert_array_equal(marked_options(fills), answers)
+
+
+def test_grid_and_contour_readings_agree_on_a_synthetic_sheet():
+    # The contour reader finds few rows of thin printed outlines; the rows it reads must agree.
+    sheet = next(synthetic.generate_sheets(1, seed=0))
+    grid, contour = _marked(sheet.image, "grid"), _marked(sheet.image, "contour")
+    np.testing.assert_array_equal(grid, sheet.answers)
+    read = contour != UNREADABLE
+    assert read.any()
+    np.testing.assert_array_equal(contour[read], grid[read])
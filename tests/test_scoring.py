@@ -0,0 +1,49 @@
+import os
+import numpy as np
+from omr_processing.analytics import item_analysis
+from omr_processing.answer_key import AnswerKey, load_answer_key
+from omr_processing.scoring import SheetReadout, rescore, score_readout
+from omr_processing.template import load_template
+
+ANSWER_KEY = os.path.join(os.path.dirname(__file__), "..", "web_app", "answer_keys", "set_a.json")
+
+
+def _readout(template, marked):
+    fills = np.full((template.num_questions, template.num_options), 0.05, dtype=np.float32)
+    rows = np.flatnonzero(marked >= 0)
+    fills[rows, marked[rows]] = 0.8
+    return SheetReadout(fills, template.bubble_coords, template.block_origins)
+
+
+def test_clean_sheet_has_nothing_to_review():
+    template = load_template()
+    key = load_answer_key(ANSWER_KEY, template.num_questions)
+    marked = np.where(np.arange(template.num_questions) % 10 == 0, -1, key.indices)
+    result = score_readout(_readout(template, marked), key, template)
+    assert result["review"] == [] and "review_reason" not in result
+
+
+def test_mostly_blank_sheet_goes_to_review_whole():
+    # A sheet warped from the wrong points reads as confidently blank rows.
+    template = load_template()
+    key = load_answer_key(ANSWER_KEY, template.num_questions)
+    marked = np.where(np.arange(template.num_questions) % 2 == 0, -1, key.indices)
+    result = score_readout(_readout(template, marked), key, template)
+    assert "blank" in result["review_reason"]
+    assert result["review"] == (np.flatnonzero(key.indices[:template.num_questions] >= 0) + 1).tolist()
+
+
+def test_grading_rescoring_and_item_analysis_agree_on_an_incomplete_key():
+    template = load_template()
+    key = load_answer_key(ANSWER_KEY, template.num_questions)
+    open_key = key.indices.copy()
+    open_key[:10] = -1
+    marked = np.where(np.arange(template.num_questions) < 20, -1, key.indices)
+    readout = _readout(template, marked)
+
+    result = score_readout(readout, AnswerKey(None, None, open_key), template)
+    _, _, totals, subject_scores = rescore(readout.fill_ratios[None], open_key, template)
+    analysis = item_analysis(marked[None], open_key, template)
+    # Blank answers to the ten questions the key leaves open score nothing.
+    assert result["total_score"] == totals[0] == analysis["totals"][0] == template.num_questions - 20
+    assert list(result["subject_scores"].values()) == subject_scores[0].tolist()
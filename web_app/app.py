@@ -1,13 +1,22 @@
 import streamlit as st
 import os
 import sys
-import pandas as pd
 import json
 import cv2
+import time
+import zipfile
+import numpy as np
+from contextlib import closing
 from datetime import datetime
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from omr_processing.processor import OMREvaluator
+from omr_processing.batch import default_workers
+from omr_processing.ingest import iter_zip_images, iter_directory_images, count_images
+from omr_processing.jobs import JobQueue, setup_database, start_workers, AUDIT_SUBDIR, THUMBNAIL_SUBDIR, FILLS_SUBDIR
+from omr_processing.timing import summarize_timings
+from omr_processing.video import VIDEO_EXTENSIONS
+from omr_processing.audit import audit_basename, load_audit_record, regenerate_overlay
+from omr_processing.template import load_layouts
 
 st.set_page_config(
     page_title="Innomatics OMR Evaluation System",
@@ -16,18 +25,25 @@ st.set_page_config(
 )
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-UPLOADS_DIR = os.path.join(BASE_DIR, "uploads")
 RESULTS_DIR = os.path.join(BASE_DIR, "results")
 CSV_DIR = os.path.join(RESULTS_DIR, "csv")
-JSON_DIR = os.path.join(RESULTS_DIR, "json")
-IMG_DIR = os.path.join(RESULTS_DIR, "processed_images")
+# Workers write each sheet's audit record and thumbnail here, and the fill-ratio
+# matrices of finished jobs (for `python -m omr_processing rescore`) under fills/.
+JSON_DIR = os.path.join(RESULTS_DIR, AUDIT_SUBDIR)
+IMG_DIR = os.path.join(RESULTS_DIR, THUMBNAIL_SUBDIR)
+FILLS_DIR = os.path.join(RESULTS_DIR, FILLS_SUBDIR)
+# Graded-image archives prepared for download.
+EXPORT_DIR = os.path.join(RESULTS_DIR, "exports")
+# Readouts of every sheet graded so far, by image content hash; re-uploads are only re-scored.
+CACHE_DIR = os.path.join(RESULTS_DIR, "cache")
+# Jobs are graded by separate worker processes (`python -m omr_processing worker --db ...`);
+# uploads are spooled next to the database until their job is removed.
+JOBS_DB = os.path.join(RESULTS_DIR, "jobs", "jobs.db")
+# A worker process still above this after a sheet is replaced with a fresh one.
+WORKER_MAX_MEMORY = 1024 * 2**20
+POLL_SECONDS = 1.0
 KEYS_DIR = os.path.join(BASE_DIR, "answer_keys")
 
-os.makedirs(UPLOADS_DIR, exist_ok=True)
-os.makedirs(CSV_DIR, exist_ok=True)
-os.makedirs(JSON_DIR, exist_ok=True)
-os.makedirs(IMG_DIR, exist_ok=True)
-
 def get_answer_keys():
     keys = {}
     if not os.path.exists(KEYS_DIR):
@@ -38,13 +54,191 @@ def get_answer_keys():
             keys[key_name] = os.path.join(KEYS_DIR, f)
     return keys
 
+@st.cache_resource
+def get_engine():
+    """
+    Set up once per server and shared by every session, instead of on each
+    rerun: the results directories, the job database schema, the answer keys
+    on offer and the compiled sheet layouts used to redraw overlays.
+    """
+    for directory in (CSV_DIR, JSON_DIR, IMG_DIR, EXPORT_DIR, os.path.dirname(JOBS_DB)):
+        os.makedirs(directory, exist_ok=True)
+    setup_database(JOBS_DB)
+    return {"answer_keys": get_answer_keys(), "templates": {t.name: t for t in load_layouts()}}
+
+engine = get_engine()
+
+def open_queue():
+    """
+    A job queue connection for one use, closed afterwards: SQLite connections
+    belong to the thread that opened them, so none is kept between runs.
+    """
+    return closing(JobQueue(JOBS_DB, setup=False))
+
+def load_job_batch(job):
+    """Collects a finished job's results from the queue, in submission order."""
+    results_list, failed, stage_timings, originals = [], [], [], {}
+    cached_sheets = 0
+    to_review, review_reasons = {}, {}
+    with open_queue() as queue:
+        tasks = queue.job_tasks(job["id"])
+    for task in tasks:
+        originals[task["name"]] = task["path"]
+        if task["timings"]:
+            stage_timings.append(task["timings"])
+        if not task["summary"]:
+            failed.append(task["name"])
+            continue
+        cached_sheets += task["cached"]
+        if task["summary"].get("review"):
+            to_review[task["name"]] = task["summary"]["review"]
+        if task["summary"].get("review_reason"):
+            review_reasons[task["name"]] = task["summary"]["review_reason"]
+        results_list.append({
+            "filename": task["name"],
+            "layout": task["layout"],
+            "total_score": task["summary"]["total_score"],
+            "review": len(task["summary"].get("review", [])),
+            **task["summary"]["subject_scores"],
+            "evaluated_at": datetime.fromtimestamp(task["finished_at"]).isoformat(),
+            "hash": task["hash"],
+        })
+    return {
+        "job_id": job["id"],
+        "results": results_list,
+        "failed": failed,
+        "cached": cached_sheets,
+        "review": to_review,
+        "review_reasons": review_reasons,
+        "originals": originals,
+        "timing_report": summarize_timings(stage_timings) if stage_timings else None,
+        "finished_at": datetime.fromtimestamp(job["finished_at"]).strftime('%Y%m%d_%H%M%S'),
+    }
+
+def load_original(batch, filename):
+    """Fetches a sheet's original photo again (spooled upload or server file), or None if it is gone."""
+    path = batch["originals"].get(filename)
+    if path and os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+    return None
+
+def render_graded_image(result, batch):
+    """Draws a sheet's overlay on demand from its stored record, at full quality when the original is still available."""
+    filename = result["filename"]
+    filename_base = audit_basename(filename, result["hash"])
+    record = load_audit_record(os.path.join(JSON_DIR, f"{filename_base}_result.json"))
+    template = engine["templates"].get(result["layout"])
+    original = load_original(batch, filename)
+    if original is not None:
+        original_image = cv2.imdecode(np.frombuffer(original, dtype=np.uint8), cv2.IMREAD_COLOR)
+        return original, regenerate_overlay(record, original_image=original_image, template=template)
+    with open(os.path.join(IMG_DIR, record["thumbnail"]), "rb") as f:
+        return None, regenerate_overlay(record, thumbnail=f.read(), template=template)
+
+@st.fragment(run_every=POLL_SECONDS)
+def show_job_progress(job_id):
+    """Polls a queued job; only this fragment reruns, and the page refreshes once the job is done."""
+    with open_queue() as queue:
+        job = queue.job(job_id)
+    if job is None:
+        return
+    done = job["completed"] + job["failed"]
+    total = job["total"] if job["status"] != "submitting" else max(job["total"], done)
+    rate = done / max(time.time() - job["created_at"], 1e-6)
+    st.progress(min(done / max(total, 1), 1.0),
+                text=f"Job {job_id} · {job['label']} · {done}/{total} sheets · {rate:.2f} sheets/sec · {job['status']}")
+    if job["status"] == "done":
+        st.rerun()
+
+def show_results(batch):
+    # pandas takes longer to import than the rest of the app; it is only needed once there are results.
+    import pandas as pd
+
+    results_list = batch["results"]
+    for filename in batch["failed"]:
+        st.warning(f"Could not process `{filename}`. It might be distorted or unclear.")
+    if batch["review"]:
+        st.warning(f"{len(batch['review'])} sheets have questions the grader is unsure of; "
+                   "they are marked 🚩 below and outlined in orange on the graded image.")
+    if batch["cached"]:
+        st.caption(f"Re-scored from the readout cache without image processing: {batch['cached']} of {len(results_list)} sheets.")
+    if batch["timing_report"]:
+        with st.expander("⏱️ Performance Report (per-stage latency)"):
+            st.dataframe(pd.DataFrame(batch["timing_report"]).T.round(2))
+            st.download_button(
+                label="📥 Download Timing Report as JSON",
+                data=json.dumps({"sheets": len(results_list), "stages": batch["timing_report"]}, indent=2),
+                file_name=f"omr_timings_{batch['finished_at']}.json",
+                mime="application/json",
+            )
+
+    if not results_list:
+        return
+
+    results_df = pd.DataFrame(results_list)
+    st.dataframe(results_df)
+
+    csv_data = results_df.to_csv(index=False).encode('utf-8')
+    st.download_button(
+        label="📥 Download Results as CSV",
+        data=csv_data,
+        file_name=f"omr_results_{batch['finished_at']}.csv",
+        mime="text/csv",
+    )
+
+    if st.button("🖼️ Prepare Graded Images for Download"):
+        # Written to disk one overlay at a time, so only the finished archive is ever read back.
+        archive_name = f"omr_graded_{batch['finished_at']}.zip"
+        archive_path = os.path.join(EXPORT_DIR, archive_name)
+        with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_STORED) as zf:
+            for result in results_list:
+                _, overlay_image = render_graded_image(result, batch)
+                ok, encoded = cv2.imencode(".jpg", overlay_image, [cv2.IMWRITE_JPEG_QUALITY, 85])
+                zf.writestr(f"{audit_basename(result['filename'], result['hash'])}_graded.jpg", encoded.tobytes())
+        with open(archive_path, "rb") as f:
+            st.download_button(
+                label="📥 Download Graded Images (ZIP)",
+                data=f,
+                file_name=archive_name,
+                mime="application/zip",
+            )
+
+    st.subheader("🔍 Detailed Review")
+    only_review = bool(batch["review"]) and st.checkbox("Only sheets to review", key=f"only_review_{batch['finished_at']}")
+    for i, result in enumerate(results_list):
+        review = batch["review"].get(result["filename"])
+        if only_review and not review:
+            continue
+        flag = "🚩 " if review else ""
+        with st.expander(f"{flag}View details for **{result['filename']}**"):
+            reason = batch["review_reasons"].get(result["filename"])
+            if reason:
+                st.caption(f"Check the whole sheet by hand: {reason}, so it may have been aligned wrongly.")
+            elif review:
+                st.caption(f"Check questions {', '.join(str(q) for q in review)} by hand.")
+            # Images are only loaded and overlays only drawn for the sheets someone actually opens.
+            if st.checkbox("Show images", key=f"show_images_{batch['finished_at']}_{i}"):
+                original, overlay_image = render_graded_image(result, batch)
+                col1, col2 = st.columns(2)
+                with col1:
+                    if original is not None:
+                        st.image(original, caption="Original Image")
+                    else:
+                        st.caption("The original image is no longer uploaded.")
+                with col2:
+                    st.image(overlay_image, channels="BGR", caption="Processed & Graded Image")
+
 st.title("📝 Automated OMR Evaluation System")
 st.markdown("### Welcome to the Innomatics Research Labs OMR evaluation portal.")
 
 with st.sidebar:
     st.header("⚙️ Settings")
     
-    available_keys = get_answer_keys()
+    available_keys = engine["answer_keys"]
+    if st.button("🔄 Reload answer keys", help="Picks up key files added since the server started."):
+        get_engine.clear()
+        st.rerun()
     if not available_keys:
         st.error("No answer keys found. Please run the key conversion script first.")
         selected_key_name = None
@@ -56,73 +250,112 @@ with st.sidebar:
         )
         answer_key_path = available_keys.get(selected_key_name)
 
-    uploaded_files = st.file_uploader(
-        "Upload OMR Sheet Images",
-        type=["png", "jpg", "jpeg"],
-        accept_multiple_files=True
+    input_mode = st.radio(
+        "Input Source",
+        options=["Image files", "ZIP archive", "Video", "Server directory"]
     )
-    
+    uploaded_files, uploaded_zip, uploaded_video, server_dir = [], None, None, ""
+    if input_mode == "Image files":
+        uploaded_files = st.file_uploader(
+            "Upload OMR Sheet Images",
+            type=["png", "jpg", "jpeg"],
+            accept_multiple_files=True
+        )
+    elif input_mode == "ZIP archive":
+        uploaded_zip = st.file_uploader("Upload a ZIP of OMR Sheet Images", type=["zip"])
+    elif input_mode == "Video":
+        uploaded_video = st.file_uploader(
+            "Upload a video of the sheets being flipped in front of the camera",
+            type=[ext.lstrip(".") for ext in VIDEO_EXTENSIONS],
+            help="The sharpest frame of each sheet is graded."
+        )
+    else:
+        server_dir = st.text_input("Directory on the grading server")
+
+    num_workers = st.slider(
+        "Worker Processes",
+        min_value=1,
+        max_value=max(2, os.cpu_count() or 1),
+        value=default_workers(),
+        help="Started with the first job when no workers are running; they are shared by all evaluators."
+    )
+    with open_queue() as queue:
+        st.caption(f"{queue.live_workers()} workers running · {queue.queued_tasks()} sheets waiting")
+
     start_button = st.button("🚀 Start Evaluation", use_container_width=True, disabled=(not available_keys))
 
-if start_button and uploaded_files:
+has_input = bool(uploaded_files) or uploaded_zip is not None or uploaded_video is not None or bool(server_dir)
+
+if start_button and server_dir and not os.path.isdir(server_dir):
+    st.error(f"Directory `{server_dir}` does not exist on the server.")
+elif start_button and has_input:
     if not answer_key_path:
         st.error("Please select a valid answer key.")
     else:
-        st.info(f"Processing {len(uploaded_files)} sheets using **{selected_key_name}**...")
-        
-        progress_bar = st.progress(0)
-        results_list = []
-        
-        for i, uploaded_file in enumerate(uploaded_files):
-            file_path = os.path.join(UPLOADS_DIR, uploaded_file.name)
-            with open(file_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
-
-            evaluator = OMREvaluator(image_path=file_path, answer_key_path=answer_key_path)
-            result_data, overlay_image = evaluator.run_evaluation()
-            
-            if result_data:
-                flat_data = {
-                    "filename": uploaded_file.name,
-                    "total_score": result_data["total_score"],
-                    **result_data["subject_scores"],
-                    "evaluated_at": datetime.now().isoformat()
-                }
-                results_list.append(flat_data)
-
-                filename_base = os.path.splitext(uploaded_file.name)[0]
-                cv2.imwrite(os.path.join(IMG_DIR, f"{filename_base}_processed.png"), overlay_image)
-                with open(os.path.join(JSON_DIR, f"{filename_base}_result.json"), 'w') as f:
-                    json.dump(result_data, f, indent=4)
+        # Uploads are spooled once by content hash; server files are graded in place.
+        if uploaded_files:
+            sheet_sources = ((f.name, f.getvalue()) for f in uploaded_files)
+            total_sheets = len(uploaded_files)
+        elif uploaded_zip is not None:
+            sheet_sources = iter_zip_images(uploaded_zip)
+            total_sheets = count_images(zip_source=uploaded_zip)
+        elif uploaded_video is not None:
+            # The video is only spooled; a worker scans it for sheets and queues them.
+            sheet_sources, total_sheets = None, None
+        else:
+            sheet_sources = iter_directory_images(server_dir)
+            total_sheets = count_images(directory=server_dir)
+        label = f"{selected_key_name}, " + (uploaded_video.name if uploaded_video is not None else f"{total_sheets} sheets")
+
+        with open_queue() as queue, st.spinner("Queueing sheets..."):
+            if queue.live_workers() == 0:
+                start_workers(JOBS_DB, num_workers, cache_dir=CACHE_DIR, max_memory=WORKER_MAX_MEMORY)
+            if uploaded_video is not None:
+                job_id = queue.submit_video(answer_key_path, uploaded_video.name, uploaded_video.getbuffer(),
+                                            results_dir=RESULTS_DIR, label=label)
             else:
-                 st.warning(f"Could not process `{uploaded_file.name}`. It might be distorted or unclear.")
+                job_id = queue.submit(answer_key_path, sheet_sources, results_dir=RESULTS_DIR, label=label)
+        # The session only remembers its job ids; the results live in the queue.
+        st.session_state.setdefault("jobs", []).insert(0, job_id)
+        if uploaded_video is not None:
+            st.info(f"Job {job_id} queued: the video is scanned for sheets by a worker, using **{selected_key_name}**.")
+        else:
+            st.info(f"Job {job_id} queued: {total_sheets} sheets using **{selected_key_name}**.")
 
-            progress_bar.progress((i + 1) / len(uploaded_files))
+elif start_button and not has_input:
+    st.warning("Please upload at least one OMR sheet image, a ZIP archive, a video or a server directory.")
 
-        st.success("✅ Evaluation complete!")
+with open_queue() as queue:
+    jobs = [job for job in (queue.job(job_id) for job_id in st.session_state.get("jobs", [])) if job]
+    live_workers = queue.live_workers()
+pending_jobs = [job for job in jobs if job["status"] != "done"]
+finished_jobs = [job for job in jobs if job["status"] == "done"]
 
-        if results_list:
-            results_df = pd.DataFrame(results_list)
-            st.dataframe(results_df)
+if pending_jobs:
+    st.subheader("⏳ Jobs in Progress")
+    if live_workers == 0:
+        st.warning("No workers are running.")
+        if st.button("Start Workers"):
+            start_workers(JOBS_DB, num_workers, cache_dir=CACHE_DIR, max_memory=WORKER_MAX_MEMORY)
+            st.rerun()
+    for job in pending_jobs:
+        show_job_progress(job["id"])
 
-            csv_data = results_df.to_csv(index=False).encode('utf-8')
-            st.download_button(
-                label="📥 Download Results as CSV",
-                data=csv_data,
-                file_name=f"omr_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                mime="text/csv",
-            )
-            
-            st.subheader("🔍 Detailed Review")
-            for result in results_list:
-                with st.expander(f"View details for **{result['filename']}**"):
-                    col1, col2 = st.columns(2)
-                    filename_base = os.path.splitext(result['filename'])[0]
-                    
-                    with col1:
-                        st.image(os.path.join(UPLOADS_DIR, result['filename']), caption="Original Image")
-                    with col2:
-                        st.image(os.path.join(IMG_DIR, f"{filename_base}_processed.png"), caption="Processed & Graded Image")
-
-elif start_button and not uploaded_files:
-    st.warning("Please upload at least one OMR sheet image.")
\ No newline at end of file
+if finished_jobs:
+    st.subheader("✅ Finished Jobs")
+    selected_job = st.selectbox(
+        "Job",
+        options=finished_jobs,
+        format_func=lambda job: f"Job {job['id']} · {job['label']} · {job['failed']} failed"
+    )
+    # Reviewing a sheet reruns the script; the job's results are only read from the queue once.
+    cache_key = f"job_batch_{selected_job['id']}"
+    if cache_key not in st.session_state:
+        st.session_state[cache_key] = load_job_batch(selected_job)
+    show_results(st.session_state[cache_key])
+    if st.button("🗑️ Remove Job", help="Forgets the job and deletes its spooled uploads; result files are kept."):
+        with open_queue() as queue:
+            queue.delete_job(selected_job["id"])
+        st.session_state["jobs"].remove(selected_job["id"])
+        del st.session_state[cache_key]
+        st.rerun()
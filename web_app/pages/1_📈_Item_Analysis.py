@@ -0,0 +1,114 @@
+import streamlit as st
+import os
+import sys
+from datetime import datetime
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from omr_processing.analytics import load_marked, item_analysis, analysis_tables, export_tables
+from omr_processing.answer_key import load_answer_key
+from omr_processing.jobs import FILLS_SUBDIR
+from omr_processing.scoring import BUBBLE_THRESHOLD_RATIO
+from omr_processing.template import load_layouts
+
+st.set_page_config(
+    page_title="Item Analysis - Innomatics OMR Evaluation System",
+    page_icon="📈",
+    layout="wide"
+)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BASE_DIR, "results")
+# Fill matrices every finished job appends to (see app.py).
+FILLS_DIR = os.path.join(RESULTS_DIR, FILLS_SUBDIR)
+ANALYSIS_DIR = os.path.join(RESULTS_DIR, "analysis")
+KEYS_DIR = os.path.join(BASE_DIR, "answer_keys")
+
+@st.cache_resource
+def get_templates():
+    return {t.name: t for t in load_layouts()}
+
+@st.cache_data(show_spinner="Analysing graded sheets...")
+def analyse(layout, answer_key_path, threshold, store_version):
+    """The whole analysis, recomputed only when the key, threshold or fill store changes (`store_version`)."""
+    template = get_templates()[layout]
+    sheets, marked = load_marked(FILLS_DIR, template, threshold)
+    if not sheets:
+        return None
+    answer_key = load_answer_key(answer_key_path, template.num_questions, template.num_options)
+    analysis = item_analysis(marked, answer_key.indices, template)
+    return analysis_tables(sheets, marked, analysis, template)
+
+def store_version():
+    """Changes whenever a job appends a chunk to the fill store."""
+    if not os.path.isdir(FILLS_DIR):
+        return None
+    return tuple(sorted((entry.name, entry.stat().st_mtime_ns) for entry in os.scandir(FILLS_DIR)
+                        if entry.name.endswith(".json")))
+
+st.title("📈 Item Analysis")
+st.markdown("Difficulty, discrimination and answer choices of every question, over all sheets graded so far.")
+
+keys = {os.path.splitext(f)[0].replace("_", " ").title(): os.path.join(KEYS_DIR, f)
+        for f in sorted(os.listdir(KEYS_DIR)) if f.endswith(".json")} if os.path.isdir(KEYS_DIR) else {}
+templates = get_templates()
+
+with st.sidebar:
+    st.header("⚙️ Settings")
+    if not keys:
+        st.error("No answer keys found. Please run the key conversion script first.")
+        st.stop()
+    selected_key_name = st.selectbox("Answer Key Version", options=list(keys))
+    layout = st.selectbox("Sheet Layout", options=sorted(templates))
+    threshold = st.slider("Bubble fill threshold", 0.05, 0.95, float(BUBBLE_THRESHOLD_RATIO), 0.01,
+                          help="Fill ratio above which a bubble counts as marked.")
+
+version = store_version()
+tables = analyse(layout, keys[selected_key_name], threshold, version) if version else None
+if tables is None:
+    st.info("No graded sheets of this layout yet. Grade a batch on the main page first.")
+    st.stop()
+
+items, sheets, subjects = tables["items"], tables["sheets"], tables["subjects"]
+flagged = items[items["flag"] != ""]
+col1, col2, col3, col4 = st.columns(4)
+col1.metric("Sheets", f"{len(sheets):,}")
+col2.metric("Mean score", f"{sheets['total_score'].mean():.1f}")
+col3.metric("Mean difficulty", f"{items['difficulty'].mean():.2f}")
+col4.metric("Questions flagged", len(flagged))
+
+st.subheader("Questions")
+st.caption("Difficulty is the share answering correctly; discrimination is that share in the top 27% "
+           "of sheets minus the bottom 27%.")
+st.bar_chart(items.set_index("question")[["difficulty", "discrimination"]])
+if len(flagged):
+    st.markdown("**Flagged questions**")
+    st.dataframe(flagged[["question", "subject", "key", "difficulty", "discrimination", "point_biserial", "flag"]],
+                 hide_index=True)
+with st.expander("Answer choices per question"):
+    st.dataframe(items.drop(columns=["flag"]).round(3), hide_index=True)
+
+st.subheader("Subjects")
+st.dataframe(subjects.round(2), hide_index=True)
+distribution = tables["score_distribution"].pivot(index="score", columns="subject", values="sheets")
+st.bar_chart(distribution)
+
+st.subheader("📥 Export")
+col1, col2 = st.columns(2)
+with col1:
+    for name in ("items", "subjects"):
+        st.download_button(
+            label=f"Download {name.title()} as CSV",
+            data=tables[name].to_csv(index=False).encode('utf-8'),
+            file_name=f"omr_{name}.csv",
+            mime="text/csv",
+        )
+with col2:
+    # The per-sheet table can be large, so it is written server-side rather than sent to the browser.
+    if st.button("Export all tables as Parquet"):
+        directory = os.path.join(ANALYSIS_DIR, datetime.now().strftime('%Y%m%d_%H%M%S'))
+        try:
+            paths = export_tables(tables, directory, "parquet")
+        except ImportError as e:
+            st.error(f"Cannot write Parquet: {e}")
+        else:
+            st.success(f"{len(paths)} tables written to `{directory}`.")